@@ -0,0 +1,77 @@
+'''Benchmarks the throughput of each available hash algorithm on a single core
+'''
+import argparse
+import time
+from pathlib import Path
+from random import randbytes
+from tempfile import TemporaryDirectory
+from typing import List
+
+from e4e_deduplication.hasher import HASH_ALGORITHMS, compute_digest
+
+
+def time_algorithm(paths: List[Path], algorithm: str) -> float:
+    """Times hashing the paths with the specified algorithm
+
+    Args:
+        paths (List[Path]): Paths to hash
+        algorithm (str): Hash algorithm
+
+    Returns:
+        float: Elapsed seconds
+    """
+    start = time.perf_counter()
+    for path in paths:
+        compute_digest(path, algorithm)
+    return time.perf_counter() - start
+
+
+def main():
+    """CLI Interface
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the throughput of each available hash algorithm'
+    )
+    parser.add_argument('--directory',
+                        type=Path,
+                        default=None,
+                        help='Directory of files to hash, defaults to random files in a '
+                        'temporary directory')
+    parser.add_argument('--total_bytes',
+                        type=int,
+                        default=256*1024*1024,
+                        help='Approximate bytes to hash')
+    parser.add_argument('--repeats',
+                        type=int,
+                        default=3,
+                        help='Number of times to hash the files per algorithm, the fastest is '
+                        'reported')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmpdir:
+        if args.directory is None:
+            path = Path(tmpdir).joinpath('random.bin')
+            with open(path, 'wb') as handle:
+                for _ in range(max(1, args.total_bytes // (16*1024*1024))):
+                    handle.write(randbytes(16*1024*1024))
+            paths = [path]
+        else:
+            paths = []
+            n_bytes = 0
+            for path in sorted(args.directory.rglob('*')):
+                if n_bytes >= args.total_bytes:
+                    break
+                if path.is_file():
+                    paths.append(path)
+                    n_bytes += path.stat().st_size
+        n_bytes = sum(path.stat().st_size for path in paths)
+
+        print(f'Hashing {len(paths)} files ({n_bytes} bytes)')
+        print(f'{"algorithm":>12} {"time (s)":>10} {"MB/s":>10}')
+        for algorithm in HASH_ALGORITHMS:
+            elapsed = min(time_algorithm(paths, algorithm) for _ in range(args.repeats))
+            print(f'{algorithm:>12} {elapsed:>10.3f} {n_bytes / elapsed / 1e6:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
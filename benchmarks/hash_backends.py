@@ -0,0 +1,108 @@
+'''Benchmarks the ParallelHasher backends across file sizes to find the size below which the
+process pool outperforms threads, and the effect of prefetching with the pipeline backend
+'''
+import argparse
+import time
+from pathlib import Path
+from random import randbytes
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional
+
+from e4e_deduplication.parallel_hasher import ParallelHasher
+
+
+def create_files(directory: Path, n_files: int, file_size: int) -> List[Path]:
+    """Creates files of random data
+
+    Args:
+        directory (Path): Directory to create the files in
+        n_files (int): Number of files
+        file_size (int): Size of each file in bytes
+
+    Returns:
+        List[Path]: Created files
+    """
+    paths = []
+    for idx in range(n_files):
+        path = directory.joinpath(f'{idx:08d}.bin')
+        with open(path, 'wb') as handle:
+            handle.write(randbytes(file_size))
+        paths.append(path)
+    return paths
+
+
+def time_backend(paths: List[Path], backend: str, in_flight: Optional[int] = None) -> float:
+    """Times hashing the paths with the specified backend
+
+    Args:
+        paths (List[Path]): Paths to hash
+        backend (str): ParallelHasher backend
+        in_flight (Optional[int], optional): Files prefetched at once by the pipeline backend.
+        Defaults to None.
+
+    Returns:
+        float: Elapsed seconds
+    """
+    results: Dict[Path, str] = {}
+    hasher = ParallelHasher(results.__setitem__, None, backend=backend, n_in_flight=in_flight)
+    start = time.perf_counter()
+    hasher.run(paths, len(paths))
+    elapsed = time.perf_counter() - start
+    assert len(results) == len(paths)
+    return elapsed
+
+
+def main():
+    """CLI Interface
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the threads, processes and pipeline hashing backends'
+    )
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[1024, 16*1024, 256*1024, 1024*1024, 16*1024*1024],
+                        help='File sizes to benchmark in bytes')
+    parser.add_argument('--total_bytes',
+                        type=int,
+                        default=256*1024*1024,
+                        help='Approximate bytes to hash per size')
+    parser.add_argument('--max_files',
+                        type=int,
+                        default=8192,
+                        help='Maximum number of files per size')
+    parser.add_argument('--in_flight',
+                        type=int,
+                        default=None,
+                        help='Files prefetched at once by the pipeline backend')
+    parser.add_argument('--directory',
+                        type=Path,
+                        default=None,
+                        help='Directory to create the test files in, defaults to a temporary '
+                        'directory')
+    args = parser.parse_args()
+
+    print(f'{"size":>12} {"files":>8} {"threads (s)":>12} {"processes (s)":>14} '
+          f'{"pipeline (s)":>13} {"faster":>10}')
+    crossover = None
+    for file_size in sorted(args.sizes):
+        n_files = max(1, min(args.max_files, args.total_bytes // max(file_size, 1)))
+        with TemporaryDirectory(dir=args.directory) as tmpdir:
+            paths = create_files(Path(tmpdir), n_files, file_size)
+            thread_time = time_backend(paths, 'threads')
+            process_time = time_backend(paths, 'processes')
+            pipeline_time = time_backend(paths, 'pipeline', args.in_flight)
+        faster = 'processes' if process_time < thread_time else 'threads'
+        if faster == 'processes':
+            crossover = file_size
+        print(f'{file_size:>12} {n_files:>8} {thread_time:>12.3f} {process_time:>14.3f} '
+              f'{pipeline_time:>13.3f} {faster:>10}')
+    if crossover is None:
+        print('Threads were faster at every size')
+    else:
+        print(f'Processes were last faster at {crossover} bytes, compare with '
+              f'ParallelHasher.AUTO_MAX_MEAN_SIZE = {ParallelHasher.AUTO_MAX_MEAN_SIZE}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''Benchmarks hashing with a new bytes object per read against reading into a reused buffer
+'''
+import argparse
+import hashlib
+import time
+import tracemalloc
+from pathlib import Path
+from random import randbytes
+from tempfile import TemporaryDirectory
+from typing import Callable, List, Tuple
+
+from e4e_deduplication.hasher import compute_digest
+
+
+def hash_with_read(path: Path, block_size: int) -> str:
+    """Hashes the file with a new bytes object per read, as before buffers were reused
+
+    Args:
+        path (Path): Path to hash
+        block_size (int): Size of each read in bytes
+
+    Returns:
+        str: Digest
+    """
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        while blob := handle.read(block_size):
+            hasher.update(blob)
+    return hasher.hexdigest()
+
+
+def hash_with_readinto(path: Path, block_size: int) -> str:
+    """Hashes the file with compute_digest, reading instead of memory mapping
+
+    Args:
+        path (Path): Path to hash
+        block_size (int): Size of each read in bytes
+
+    Returns:
+        str: Digest
+    """
+    return compute_digest(path, 'sha256', block_size=block_size, mmap_min_size=None)
+
+
+def measure(paths: List[Path], hash_fn: Callable[[Path, int], str], block_size: int
+            ) -> Tuple[float, int]:
+    """Measures hashing the paths
+
+    Args:
+        paths (List[Path]): Paths to hash
+        hash_fn (Callable[[Path, int], str]): Hash function
+        block_size (int): Size of each read in bytes
+
+    Returns:
+        Tuple[float, int]: Elapsed seconds, and peak traced allocation in bytes
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    for path in paths:
+        hash_fn(path, block_size)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    """CLI Interface
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks read and readinto based hashing'
+    )
+    parser.add_argument('--block_sizes',
+                        type=int,
+                        nargs='+',
+                        default=[64*1024, 256*1024, 2*1024*1024, 8*1024*1024],
+                        help='Read sizes to benchmark in bytes')
+    parser.add_argument('--file_size',
+                        type=int,
+                        default=64*1024*1024,
+                        help='Size of each test file in bytes')
+    parser.add_argument('--n_files',
+                        type=int,
+                        default=4,
+                        help='Number of test files')
+    parser.add_argument('--directory',
+                        type=Path,
+                        default=None,
+                        help='Directory to create the test files in, defaults to a temporary '
+                        'directory')
+    args = parser.parse_args()
+
+    with TemporaryDirectory(dir=args.directory) as tmpdir:
+        paths = []
+        for idx in range(args.n_files):
+            path = Path(tmpdir).joinpath(f'{idx:04d}.bin')
+            path.write_bytes(randbytes(args.file_size))
+            paths.append(path)
+        n_bytes = args.n_files * args.file_size
+
+        print(f'{"block size":>12} {"method":>10} {"MB/s":>10} {"peak alloc (B)":>16}')
+        for block_size in args.block_sizes:
+            for name, hash_fn in [('read', hash_with_read), ('readinto', hash_with_readinto)]:
+                elapsed, peak = measure(paths, hash_fn, block_size)
+                print(f'{block_size:>12} {name:>10} {n_bytes / elapsed / 1e6:>10.1f} '
+                      f'{peak:>16}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,54 +3,517 @@
 from __future__ import annotations
 
 import logging
+import os
 import re
 import socket
+import time
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List, Set, Tuple
+from typing import (Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple,
+                    Union)
 
 from tqdm import tqdm
 
-from e4e_deduplication.hasher import compute_sha256
-from e4e_deduplication.job_cache import JobCache
+from e4e_deduplication.digest_index import DigestIndex
+from e4e_deduplication.file_filter import IgnoreFilter
+from e4e_deduplication.file_walker import walk_files
+from e4e_deduplication.hasher import (DEFAULT_ALGORITHM, HASH_ALGORITHMS, compute_digest,
+                                     compute_partial_digest, compute_partial_sha256,
+                                     compute_sha256)
+from e4e_deduplication.job_cache import CacheRecord, Checkpoint, FileStat, JobCache
 from e4e_deduplication.parallel_hasher import ParallelHasher
+from e4e_deduplication.remote_hasher import Coordinator, RemoteHasher
+
+
+def _outermost(directories: Sequence[Path]) -> List[Path]:
+    """Removes duplicate directories and directories inside another directory of the sequence
+
+    Args:
+        directories (Sequence[Path]): Resolved directories
+
+    Returns:
+        List[Path]: Outermost directories, in their original order
+    """
+    unique = set(directories)
+    roots: List[Path] = []
+    for directory in directories:
+        if directory in roots or any(parent in unique for parent in directory.parents):
+            continue
+        roots.append(directory)
+    return roots
 
 
 class Analyzer:
     """Hash Analyzer Application
     """
+    # pylint: disable=too-many-instance-attributes
+    # Application state
+    CHECKPOINT_INTERVAL = 60
 
-    def __init__(self, ignore_pattern: re.Pattern, job_path: Path):
-        self.__ignore_pattern: re.Pattern = ignore_pattern
+    def __init__(self, ignore_pattern: Union[re.Pattern, IgnoreFilter, None], job_path: Path, *,
+                 hash_backend: str = 'threads',
+                 walk_workers: int = 1,
+                 algorithm: Optional[str] = None,
+                 hash_workers: Optional[int] = None,
+                 in_flight: Optional[int] = None,
+                 coordinator: Optional[Coordinator] = None):
+        # pylint: disable=too-many-arguments
+        # Application configuration
+        self.__ignore_pattern = ignore_pattern
+        self.__coordinator = coordinator
+        self.__hash_backend = hash_backend
+        self.__hash_workers = hash_workers
+        self.__in_flight = in_flight
+        self.__requested_algorithm = algorithm
+        self.__algorithm = DEFAULT_ALGORITHM
+        self.__walk_workers = walk_workers
         self.__job_path = job_path
         self.__cache: JobCache = JobCache(self.__job_path)
         self.__paths_to_remove: Dict[Path, str] = {}
+        self.__pending_stats: Dict[Path, FileStat] = {}
+        self.__pending_partials: Dict[Path, str] = {}
+        self.__stale_paths: Set[Path] = set()
+        self.__replaced_paths: Set[Path] = set()
+        self.__digest_index: Optional[DigestIndex] = None
+        self.__n_stale_digests = 0
+        self.__checkpoints: Dict[Path, Checkpoint] = {}
+        self.__last_checkpoint = 0.
         self.logger = logging.getLogger('Analyzer')
         self.__current_hostname = socket.gethostname()
 
-    def analyze(self, working_dir: Path):
+    def analyze(self, working_dir: Path, *,
+                incremental: bool = False,
+                size_filter: bool = False,
+                partial_hash: bool = False,
+                resume: bool = False):
         """Analyzes the working directory for duplicated files.  Also updates the job cache with
-        every file encountered.
+        every file encountered.  Progress is checkpointed every CHECKPOINT_INTERVAL seconds until
+        the analysis completes.
+
+        Args:
+            working_dir (Path): Directory to process
+            incremental (bool, optional): Only hash files that are new or whose stat fingerprint
+            changed since the last analysis, and drop records of files that have disappeared.
+            Defaults to False.
+            size_filter (bool, optional): Only hash files whose size matches another file in this
+            job.  Files with a unique size are recorded without a digest, and are hashed once
+            another file of the same size is encountered.  Defaults to False.
+            partial_hash (bool, optional): After size filtering, only hash files whose partial
+            digest also matches another file in this job.  Implies size_filter.  Defaults to
+            False.
+            resume (bool, optional): Skip files already recorded for this host under the working
+            directory, such as by an interrupted analysis.  Defaults to False.
+        """
+        self.analyze_many([working_dir],
+                          incremental=incremental,
+                          size_filter=size_filter,
+                          partial_hash=partial_hash,
+                          resume=resume)
+
+    def analyze_many(self, working_dirs: Sequence[Path], *,
+                     incremental: bool = False,
+                     size_filter: bool = False,
+                     partial_hash: bool = False,
+                     resume: bool = False):
+        """Analyzes several working directories in one pass.  The directories are walked together
+        and hashed by a single hasher, and each directory is checkpointed separately.
+
+        Args:
+            working_dirs (Sequence[Path]): Directories to process.  Directories inside another
+            directory in the sequence are only walked once.
+            incremental (bool, optional): As in analyze. Defaults to False.
+            size_filter (bool, optional): As in analyze. Defaults to False.
+            partial_hash (bool, optional): As in analyze. Defaults to False.
+            resume (bool, optional): As in analyze. Defaults to False.
+        """
+        size_filter = size_filter or partial_hash
+        self.__use_algorithm()
+        roots = _outermost(working_dirs)
+        completed: Set[Path] = set()
+        for root in roots:
+            completed |= self.__start_checkpoint(root, resume=resume)
+        try:
+            self.__analyze(roots,
+                           incremental=incremental,
+                           size_filter=size_filter,
+                           partial_hash=partial_hash,
+                           completed=completed)
+        except BaseException:
+            # Record the progress of the interrupted analysis to resume from
+            self.__save_checkpoints(force=True)
+            raise
+        finally:
+            self.__pending_stats = {}
+            self.__pending_partials = {}
+            self.__stale_paths = set()
+            self.__replaced_paths = set()
+            checkpoints = self.__checkpoints
+            self.__checkpoints = {}
+        for root, checkpoint in checkpoints.items():
+            self.logger.info(f'Analyzed {root}: hashed {checkpoint.n_files} files '
+                             f'({checkpoint.n_bytes} bytes)')
+            self.__cache.clear_checkpoint(root)
+
+    def __start_checkpoint(self, working_dir: Path, *, resume: bool) -> Set[Path]:
+        """Starts checkpointing the analysis of the working directory
 
         Args:
             working_dir (Path): Directory to process
+            resume (bool): Whether to resume from the files already recorded
+
+        Returns:
+            Set[Path]: Files already recorded, to skip
+        """
+        completed: Set[Path] = set()
+        checkpoint = self.__cache.get_checkpoint(working_dir)
+        if resume:
+            completed = self.__cache.get_tree(working_dir)
+            if checkpoint is None:
+                self.logger.info(f'No interrupted analysis of {working_dir}, skipping '
+                                 f'{len(completed)} recorded files')
+            else:
+                self.logger.info(f'Resuming analysis of {working_dir} from '
+                                 f'{checkpoint.last_path}, skipping {len(completed)} recorded '
+                                 'files')
+        elif checkpoint is not None:
+            self.logger.warning(f'Restarting interrupted analysis of {working_dir}, use resume '
+                                'to skip recorded files')
+        now = time.time()
+        if resume and checkpoint is not None:
+            checkpoint = checkpoint._replace(updated=now)
+        else:
+            checkpoint = Checkpoint(started=now, updated=now, n_files=0, last_path=None)
+        self.__checkpoints[working_dir] = checkpoint
+        self.__last_checkpoint = time.monotonic()
+        self.__cache.save_checkpoint(working_dir, checkpoint)
+        return completed
+
+    def __update_checkpoints(self, entries: List[Tuple[Path, FileStat]]):
+        for path, file_stat in entries:
+            root = next((parent for parent in path.parents if parent in self.__checkpoints), None)
+            if root is None:
+                continue
+            checkpoint = self.__checkpoints[root]
+            self.__checkpoints[root] = checkpoint._replace(
+                n_files=checkpoint.n_files + 1,
+                n_bytes=checkpoint.n_bytes + (file_stat.size or 0),
+                last_path=path.as_posix())
+        self.__save_checkpoints()
+
+    def __save_checkpoints(self, *, force: bool = False):
+        if not self.__checkpoints:
+            return
+        if not force and time.monotonic() - self.__last_checkpoint < self.CHECKPOINT_INTERVAL:
+            return
+        now = time.time()
+        for root, checkpoint in self.__checkpoints.items():
+            self.__checkpoints[root] = checkpoint._replace(updated=now)
+            self.__cache.save_checkpoint(root, self.__checkpoints[root])
+        self.__last_checkpoint = time.monotonic()
+
+    def __analyze(self, roots: List[Path], *,
+                  incremental: bool,
+                  size_filter: bool,
+                  partial_hash: bool,
+                  completed: Set[Path]):
+        if incremental:
+            # Recorded paths that are not walked again have disappeared
+            for root in roots:
+                self.__stale_paths |= self.__cache.get_tree(root)
+            self.__stale_paths -= completed
+            # Fingerprints are looked up through a separate connection
+            self.__cache.flush()
+        files = self.__discover(roots, completed=completed)
+        if not size_filter:
+            hasher = self.__make_hasher(hash_fn=self.__digest_fn(),
+                                        batch_fn=self.__add_results_to_cache)
+            hasher.run_files(self.__track_stats(files))
+            self.__drop_stale_records()
+            self.__digest_undigested_matches()
+            return
+
+        self.__pending_stats = dict(tqdm(files, desc='Discovering files', dynamic_ncols=True))
+        self.__drop_stale_records()
+        paths_to_hash = self.__filter_by_size(self.__pending_stats,
+                                              match_within=True,
+                                              partial_hash=partial_hash)
+        for path in self.__pending_stats.keys() - paths_to_hash:
+            self.__cache.add(path, None,
+                             file_stat=self.__pending_stats[path],
+                             partial=self.__pending_partials.get(path, None))
+        self.__hash_paths(paths_to_hash, batch_fn=self.__add_results_to_cache)
+
+    def __discover(self, roots: List[Path], *,
+                   completed: Optional[Set[Path]] = None) -> Iterator[Tuple[Path, FileStat]]:
+        """Discovers the files in the working directories that need to be recorded, as they are
+        walked.  Files are walked in batches of LOOKUP_BATCH_SIZE, and the recorded fingerprints
+        of the files with a stale path are looked up together.  Files whose fingerprint is
+        unchanged are skipped, changed files are added to the replaced paths, and walked files
+        are removed from the stale paths.
+
+        Args:
+            roots (List[Path]): Directories to process
+            completed (Optional[Set[Path]], optional): Files already recorded by an interrupted
+            analysis, to skip. Defaults to None.
+
+        Yields:
+            Iterator[Tuple[Path, FileStat]]: Files to record and their fingerprints
         """
         n_files = 0
-        n_bytes = 0
-
-        for path in tqdm(working_dir.rglob('*'),
-                         desc='Discovering files',
-                         dynamic_ncols=True):
-            n_files += 1
-            if path.is_file():
-                n_bytes += path.stat().st_size
-        self.logger.info(f'Processing {n_files} files ({n_bytes} bytes)')
-
-        hasher = ParallelHasher(
-            self.__cache.add,
-            self.__ignore_pattern,
-            hash_fn=compute_sha256,
-            n_bytes=n_bytes)
-        hasher.run(working_dir.rglob('*'), n_files)
+        n_changed = 0
+
+        def walked() -> Iterator[Tuple[Path, FileStat]]:
+            nonlocal n_files
+            for path, stat_result in self.__walk(roots):
+                n_files += 1
+                if completed and path in completed:
+                    continue
+                yield path, FileStat.from_stat(stat_result)
+
+        files = walked()
+        while batch := list(islice(files, JobCache.LOOKUP_BATCH_SIZE)):
+            # Only paths with a record can be unchanged
+            recorded = {path for path, _ in batch if path in self.__stale_paths}
+            self.__stale_paths -= recorded
+            file_stats = self.__cache.get_stats(recorded)
+            for path, file_stat in batch:
+                if file_stats.get(path, None) == file_stat:
+                    continue
+                if path in recorded:
+                    self.__replaced_paths.add(path)
+                n_changed += 1
+                yield path, file_stat
+        self.logger.info(f'{n_changed} of {n_files} files to process, '
+                         f'{len(self.__stale_paths)} records stale')
+
+    def __drop_stale_records(self):
+        """Drops the records of files that disappeared, and of changed files whose records were
+        not replaced, such as when they failed to hash
+        """
+        paths = self.__stale_paths | self.__replaced_paths
+        self.__stale_paths = set()
+        self.__replaced_paths = set()
+        if paths:
+            self.__cache.drop_paths(self.__current_hostname, paths)
+
+    def __filter_by_size(self, files: Dict[Path, FileStat], *,
+                         match_within: bool,
+                         partial_hash: bool = False) -> Set[Path]:
+        """Selects the files whose size matches another file, and digests any cached records that
+        were recorded without a digest but now match a selected file.
+
+        Args:
+            files (Dict[Path, FileStat]): Candidate files
+            match_within (bool): Whether files of the same size within the candidates count as a
+            match, or only records in the job cache
+            partial_hash (bool, optional): Whether to also require a matching partial digest.
+            Defaults to False.
+
+        Returns:
+            Set[Path]: Files that need a digest
+        """
+        if self.__cache.has_unsized_digests:
+            self.logger.warning('Job cache has records without file sizes, hashing all files')
+            return set(files)
+        size_groups: Dict[int, List[Path]] = {}
+        for path, file_stat in files.items():
+            if file_stat.size in size_groups:
+                size_groups[file_stat.size].append(path)
+            else:
+                size_groups[file_stat.size] = [path]
+
+        paths_to_hash: Set[Path] = set()
+        cached_sizes: Set[int] = set()
+        for size, paths in size_groups.items():
+            # Earlier records of the same files are not a match
+            if self.__cache.has_size(size, exclude=set(paths)):
+                cached_sizes.add(size)
+                paths_to_hash.update(paths)
+            elif match_within and len(paths) > 1:
+                paths_to_hash.update(paths)
+        self.logger.info(f'{len(paths_to_hash)} of {len(files)} files have a size match')
+        records = [record
+                   for record in self.__cache.get_size_matches(cached_sizes)
+                   if record.host != self.__current_hostname or record.path not in files]
+        if partial_hash and paths_to_hash:
+            paths_to_hash, records = self.__filter_by_partial(paths_to_hash,
+                                                              records,
+                                                              match_within=match_within)
+        self.__digest_cached_records({(record.path, record.host)
+                                      for record in records
+                                      if record.digest is None})
+        return paths_to_hash
+
+    def __filter_by_partial(self,
+                            paths: Set[Path],
+                            records: List[CacheRecord],
+                            *,
+                            match_within: bool) -> Tuple[Set[Path], List[CacheRecord]]:
+        """Selects the files whose partial digest matches another file
+
+        Args:
+            paths (Set[Path]): Candidate files with a size match
+            records (List[CacheRecord]): Cached records with a size match
+            match_within (bool): Whether matches within the candidates count, or only records in
+            the job cache
+
+        Returns:
+            Tuple[Set[Path], List[CacheRecord]]: Files that need a digest, and the cached records
+            that match them
+        """
+        self.__hash_paths(paths, self.__pending_partials.__setitem__,
+                          hash_fn=self.__partial_digest_fn())
+        partial_groups: Dict[Tuple[int, str], List[Path]] = {}
+        # Files whose partial digest failed can't be ruled out
+        paths_to_hash = {path for path in paths if path not in self.__pending_partials}
+        for path in paths - paths_to_hash:
+            key = (self.__pending_stats[path].size, self.__pending_partials[path])
+            if key in partial_groups:
+                partial_groups[key].append(path)
+            else:
+                partial_groups[key] = [path]
+
+        cached_keys = {(record.size, record.partial) for record in records}
+        unknown_sizes = {record.size for record in records if record.partial is None}
+        for key, group in partial_groups.items():
+            if key in cached_keys or key[0] in unknown_sizes:
+                paths_to_hash.update(group)
+            elif match_within and len(group) > 1:
+                paths_to_hash.update(group)
+        self.logger.info(f'{len(paths_to_hash)} of {len(paths)} files have a partial digest match')
+
+        selected_keys = {(self.__pending_stats[path].size, self.__pending_partials.get(path, None))
+                         for path in paths_to_hash}
+        selected_sizes = {size for size, _ in selected_keys}
+        unknown_partial_sizes = {size for size, partial in selected_keys if partial is None}
+        records = [record
+                   for record in records
+                   if (record.size, record.partial) in selected_keys
+                   or (record.partial is None and record.size in selected_sizes)
+                   or record.size in unknown_partial_sizes]
+        return paths_to_hash, records
+
+    def __digest_cached_records(self, records: Set[Tuple[Path, str]]):
+        """Hashes the specified records that were recorded without a digest
+
+        Args:
+            records (Set[Tuple[Path, str]]): Path and hostname of each record to digest
+        """
+        paths = {path for path, host in records if host == self.__current_hostname}
+        if len(paths) != len(records):
+            self.logger.warning(f'{len(records) - len(paths)} undigested records of matching size '
+                                'are on other hosts and cannot be verified')
+        if not paths:
+            return
+        digests: Dict[Path, str] = {}
+        self.__pending_stats.update({path: FileStat.from_stat(path.stat())
+                                     for path in paths
+                                     if path.is_file()})
+        self.__hash_paths(paths, digests.__setitem__)
+        self.__cache.drop_paths(self.__current_hostname, digests.keys())
+        self.__add_results_to_cache(list(digests.items()))
+
+    def __digest_undigested_matches(self):
+        """Digests the records that a size filtered analysis recorded without a digest, if another
+        file now has the same size.  Analyses without size filtering never look for these
+        records, so they would otherwise never match.
+        """
+        records = self.__cache.get_undigested_matches()
+        if not records:
+            return
+        self.logger.info(f'{len(records)} records without a digest have a size match')
+        self.__digest_cached_records({(record.path, record.host) for record in records})
+
+    def __hash_paths(self,
+                     paths: Set[Path],
+                     process_fn: Optional[Callable[[Path, str], None]] = None,
+                     *,
+                     batch_fn: Optional[Callable[[List[Tuple[Path, str]]], None]] = None,
+                     hash_fn: Callable[[Path], str] = None):
+        if hash_fn is None:
+            hash_fn = self.__digest_fn()
+        files = [(path, self.__pending_stats[path].size)
+                 for path in paths
+                 if path in self.__pending_stats]
+        n_bytes = sum(size for _, size in files)
+        self.logger.info(f'Processing {len(files)} files ({n_bytes} bytes)')
+        hasher = self.__make_hasher(process_fn,
+                                    hash_fn=hash_fn,
+                                    n_bytes=n_bytes,
+                                    batch_fn=batch_fn)
+        hasher.run_files(files, len(files))
+
+    def __make_hasher(self,
+                      process_fn: Optional[Callable[[Path, str], None]] = None,
+                      *,
+                      hash_fn: Callable[[Path], str],
+                      n_bytes: Optional[int] = None,
+                      batch_fn: Optional[Callable[[List[Tuple[Path, str]]], None]] = None
+                      ) -> ParallelHasher:
+        if self.__coordinator is not None:
+            return RemoteHasher(process_fn,
+                                None,
+                                coordinator=self.__coordinator,
+                                hash_fn=hash_fn,
+                                n_bytes=n_bytes,
+                                batch_fn=batch_fn)
+        return ParallelHasher(process_fn,
+                              None,
+                              hash_fn=hash_fn,
+                              n_bytes=n_bytes,
+                              batch_fn=batch_fn,
+                              backend=self.__hash_backend,
+                              n_hash_workers=self.__hash_workers,
+                              n_in_flight=self.__in_flight)
+
+    def __use_algorithm(self):
+        """Selects the hash algorithm of the job
+
+        Raises:
+            ValueError: The algorithm differs from the job's, or is not installed on this host
+        """
+        algorithm = self.__requested_algorithm or self.__cache.algorithm or DEFAULT_ALGORITHM
+        if algorithm not in HASH_ALGORITHMS:
+            # Otherwise every file would fail to hash, and be logged and skipped
+            raise ValueError(f'{algorithm} is not installed on this host, available algorithms '
+                             f'are {sorted(HASH_ALGORITHMS)}')
+        self.__algorithm = self.__cache.use_algorithm(algorithm)
+
+    def __digest_fn(self) -> Callable[[Path], str]:
+        # Partials of module level functions can be pickled for the processes backend
+        if self.__algorithm == 'sha256':
+            return compute_sha256
+        return partial(compute_digest, algorithm=self.__algorithm)
+
+    def __partial_digest_fn(self) -> Callable[[Path], str]:
+        if self.__algorithm == 'sha256':
+            return compute_partial_sha256
+        return partial(compute_partial_digest, algorithm=self.__algorithm)
+
+    def __walk(self, roots: List[Path]) -> Iterator[Tuple[Path, os.stat_result]]:
+        return walk_files(roots, self.__ignore_pattern, n_workers=self.__walk_workers)
+
+    def __track_stats(self,
+                      files: Iterable[Tuple[Path, FileStat]]) -> Iterator[Tuple[Path, int]]:
+        for path, file_stat in files:
+            self.__pending_stats[path] = file_stat
+            yield path, file_stat.size
+
+    def __add_results_to_cache(self, results: List[Tuple[Path, str]]) -> None:
+        # Records of changed files are replaced as their new digests arrive
+        replaced = [path for path, _ in results if path in self.__replaced_paths]
+        if replaced:
+            self.__cache.drop_paths(self.__current_hostname, replaced)
+            self.__replaced_paths.difference_update(replaced)
+        entries = []
+        for path, digest in results:
+            file_stat = self.__pending_stats.pop(path, None)
+            if file_stat is None:
+                file_stat = FileStat.from_stat(path.stat())
+            entries.append((path, digest, file_stat, self.__pending_partials.get(path, None)))
+        self.__cache.add_many(entries)
+        self.__update_checkpoints([(path, file_stat) for path, _, file_stat, _ in entries])
 
     def get_duplicates(self, *,
                        ignore_hashes: List[str] = None) -> Dict[str, Set[Tuple[Path, str]]]:
@@ -59,53 +522,124 @@ class Analyzer:
         Returns:
             Dict[str, Set[Tuple[Path, str]]]: Dict of digests and corresponding duplicated paths
         """
-        report = self.__cache.get_duplicates()
-        if ignore_hashes:
-            for digest in ignore_hashes:
-                if digest in report:
-                    report.pop(digest)
-        return report
+        return dict(self.iter_duplicates(ignore_hashes=ignore_hashes))
+
+    def iter_duplicates(self, *,
+                        ignore_hashes: List[str] = None
+                        ) -> Iterator[Tuple[str, Set[Tuple[Path, str]]]]:
+        """Lazily generates the report of duplicated files, most duplicated first.  Records that
+        a size filtered analysis recorded without a digest are digested first if another file now
+        has the same size.
 
-    def delete(self, working_dir: Path) -> Dict[Path, str]:
+        Args:
+            ignore_hashes (List[str], optional): Digests to exclude from the report. Defaults to
+            None.
+
+        Yields:
+            Iterator[Tuple[str, Set[Tuple[Path, str]]]]: Digest and corresponding duplicated paths
+        """
+        ignore_hashes = set(ignore_hashes or [])
+        if self.__cache.get_undigested_matches():
+            self.__use_algorithm()
+            self.__digest_undigested_matches()
+        for digest, files in self.__cache.iter_duplicates():
+            if digest not in ignore_hashes:
+                yield digest, files
+
+    def delete(self, working_dir: Path, *,
+               size_filter: bool = False,
+               partial_hash: bool = False) -> Dict[Path, str]:
         """Deletes any files in the working directory that are duplicated elsewhere in this job.
         Does not add any new files to the cache.
 
         Args:
             working_dir (Path): Directory to search for and delete duplicates in
+            size_filter (bool, optional): Only hash files whose size matches a record in this
+            job.  Defaults to False.
+            partial_hash (bool, optional): After size filtering, only hash files whose partial
+            digest also matches a record in this job.  Implies size_filter.  Defaults to False.
 
         Returns:
             Dict[Path, str]: Dictionary of paths and digests that were deleted
         """
-        n_files = 0
-        n_bytes = 0
-        for path in tqdm(working_dir.rglob('*'),
-                         desc='Discovering files',
-                         dynamic_ncols=True):
-            n_files += 1
-            if path.is_file():
-                n_bytes += path.stat().st_size
-        self.logger.info(f'Processing {n_files} files ({n_bytes} bytes)')
         self.__paths_to_remove: Dict[Path, str] = {}
-        hasher = ParallelHasher(
-            self.__add_result_to_delete_queue,
-            self.__ignore_pattern,
-            hash_fn=compute_sha256,
-            n_bytes=n_bytes)
-        hasher.run(working_dir.rglob('*'), n_files)
+        self.__n_stale_digests = 0
+        self.__use_algorithm()
+        try:
+            if size_filter or partial_hash:
+                self.__pending_stats = dict(tqdm(self.__discover([working_dir]),
+                                                 desc='Discovering files',
+                                                 dynamic_ncols=True))
+                paths_to_hash = self.__filter_by_size(self.__pending_stats,
+                                                      match_within=False,
+                                                      partial_hash=partial_hash)
+                self.__digest_index = self.__cache.get_digest_index()
+                self.__hash_paths(paths_to_hash, batch_fn=self.__add_results_to_delete_queue)
+            else:
+                self.__delete_streamed(working_dir)
+        finally:
+            self.__pending_stats = {}
+            self.__pending_partials = {}
+            if self.__digest_index is not None:
+                self.__digest_index.close()
+                self.__digest_index = None
+            if self.__n_stale_digests:
+                self.logger.warning(f'Digest index listed {self.__n_stale_digests} digests that '
+                                    'are not in the job cache, rebuilding the index')
+                self.__cache.discard_digest_index()
 
         return self.__paths_to_remove
 
-    def __add_result_to_delete_queue(self, path: Path, digest: str) -> None:
-        if digest not in self.__cache:
+    def __delete_streamed(self, working_dir: Path):
+        """Hashes the files in the working directory as they are discovered.  Files with the size
+        of a record without a digest are held back until those records are digested.
+
+        Args:
+            working_dir (Path): Directory to search for duplicates in
+        """
+        undigested_sizes = self.__cache.get_undigested_sizes()
+        deferred: Dict[Path, FileStat] = {}
+
+        def files() -> Iterator[Tuple[Path, int]]:
+            for path, stat_result in self.__walk([working_dir]):
+                if stat_result.st_size in undigested_sizes:
+                    deferred[path] = FileStat.from_stat(stat_result)
+                    continue
+                yield path, stat_result.st_size
+
+        self.__digest_index = self.__cache.get_digest_index()
+        hasher = self.__make_hasher(hash_fn=self.__digest_fn(),
+                                    batch_fn=self.__add_results_to_delete_queue)
+        hasher.run_files(files())
+        if not deferred:
             return
-        matching_paths = self.__cache[digest]
-        if (path, self.__current_hostname) not in matching_paths:
-            # Hash matches, and this file is not in the reference set
-            self.__paths_to_remove[path] = digest
-        else:
-            if len(matching_paths) > 1:
-                # Hash matches, reference set has more than just this file
+        sizes = {file_stat.size for file_stat in deferred.values()}
+        self.__digest_cached_records({(record.path, record.host)
+                                      for record in self.__cache.get_size_matches(sizes)
+                                      if record.digest is None})
+        # Digesting the records replaces them, which discards the index
+        self.__digest_index.close()
+        self.__digest_index = self.__cache.get_digest_index()
+        self.__pending_stats.update(deferred)
+        self.__hash_paths(set(deferred), batch_fn=self.__add_results_to_delete_queue)
+
+    def __add_results_to_delete_queue(self, results: List[Tuple[Path, str]]) -> None:
+        # Most files are unique, so check the in-memory index before querying the cache
+        results = [(path, digest) for path, digest in results if digest in self.__digest_index]
+        matches = self.__cache.get_many(digest for _, digest in results)
+        for path, digest in results:
+            if digest not in matches:
+                # A stale index, whose reference copies are no longer in the cache
+                self.__n_stale_digests += 1
+                continue
+            matching_paths = matches[digest]
+            if (path, self.__current_hostname) not in matching_paths:
+                # Hash matches, and this file is not in the reference set
                 self.__paths_to_remove[path] = digest
+            else:
+                if len(matching_paths) > 1:
+                    # Hash matches, reference set has more than just this file
+                    self.__paths_to_remove[path] = digest
 
     def __enter__(self) -> Analyzer:
         self.load()
@@ -6,8 +6,6 @@ import datetime as dt
 import logging
 import logging.handlers
 import os
-import re
-import shutil
 import socket
 import sys
 import time
@@ -20,8 +18,13 @@ import semantic_version
 from appdirs import AppDirs
 
 from e4e_deduplication.analyzer import Analyzer
-from e4e_deduplication.file_filter import load_ignore_pattern
+from e4e_deduplication.file_filter import IgnoreFilter, load_ignore_filter
+from e4e_deduplication.hasher import DEFAULT_ALGORITHM, HASH_ALGORITHMS
 from e4e_deduplication.job_cache import JobCache
+from e4e_deduplication.parallel_hasher import BACKENDS, ParallelHasher
+from e4e_deduplication.record_file import COMPRESSORS
+from e4e_deduplication.remote_hasher import (AUTHKEY_ENV, Coordinator, load_authkey,
+                                             parse_address, run_worker)
 
 
 class Deduplicator:
@@ -44,6 +47,8 @@ class Deduplicator:
             'export_cache': self.__configure_export_cache_parser,
             # 'info': self.__configure_info_parser,
             'import_cache': self.__configure_import_cache_parser,
+            'merge_cache': self.__configure_merge_cache_parser,
+            'worker': self.__configure_worker_parser,
             'list_jobs': self.__configure_list_jobs_parser,
             'drop_tree': self.__configure_drop_tree_parser,
             'report': self.__configure_report_parser
@@ -117,7 +122,7 @@ class Deduplicator:
                             required=True,
                             dest='directories')
         parser.add_argument('-e', '--exclude',
-                            help='Path to ignore file of absolute path regex patterns to exclude.',
+                            help='Path to ignore file of regex patterns to exclude.',
                             type=Path,
                             default=None)
         parser.add_argument('-j', '--job_name',
@@ -127,6 +132,58 @@ class Deduplicator:
         parser.add_argument('--clear_cache',
                             action='store_true',
                             help='Clears the job cache.')
+        parser.add_argument('--incremental',
+                            action='store_true',
+                            help='Only hashes new or modified files, and drops records of files '
+                            'that no longer exist.')
+        parser.add_argument('--resume',
+                            action='store_true',
+                            help='Skips files already recorded for this host under each '
+                            'directory, such as by an interrupted analysis.')
+        parser.add_argument('--size_filter',
+                            action='store_true',
+                            help='Only hashes files whose size matches another file in the job.')
+        parser.add_argument('--partial_hash',
+                            action='store_true',
+                            help='Only hashes files whose size and partial digest match another '
+                            'file in the job.  Implies --size_filter.')
+        parser.add_argument('--backend',
+                            type=str,
+                            choices=BACKENDS,
+                            default='threads',
+                            help='Hashing backend.  auto uses processes for many small files, '
+                            'and pipeline prefetches files ahead of hashing for network '
+                            'filesystems.')
+        parser.add_argument('--hash_workers',
+                            type=int,
+                            default=None,
+                            help='Number of hashing threads or processes.  Defaults to the '
+                            'number of CPUs.')
+        parser.add_argument('--in_flight',
+                            type=int,
+                            default=None,
+                            help='Number of files prefetched at once by the pipeline backend.  '
+                            f'Defaults to {ParallelHasher.PIPELINE_IN_FLIGHT}.')
+        parser.add_argument('--walk_workers',
+                            type=int,
+                            default=1,
+                            help='Number of directories to list concurrently.  Increase for '
+                            'network filesystems.')
+        parser.add_argument('--listen',
+                            type=str,
+                            default=None,
+                            help='Hashes on workers connecting to this address, host:port or a '
+                            f'socket path, instead of on this host.  Requires {AUTHKEY_ENV}.')
+        parser.add_argument('--local_workers',
+                            type=int,
+                            default=0,
+                            help='Number of workers to start on this host with --listen.')
+        parser.add_argument('--algorithm',
+                            type=str,
+                            choices=sorted(HASH_ALGORITHMS),
+                            default=None,
+                            help='Hash algorithm.  Defaults to the algorithm of the job, or '
+                            f'{DEFAULT_ALGORITHM} for a new job.')
         parser.add_argument('-a', '--analysis_dest',
                             type=str,
                             default='',
@@ -144,7 +201,18 @@ class Deduplicator:
                  job_name: str,
                  clear_cache: bool,
                  analysis_dest: str,
-                 ignore_hash: List[str] = None):
+                 ignore_hash: List[str] = None,
+                 incremental: bool = False,
+                 size_filter: bool = False,
+                 partial_hash: bool = False,
+                 backend: str = 'threads',
+                 walk_workers: int = 1,
+                 algorithm: Optional[str] = None,
+                 hash_workers: Optional[int] = None,
+                 in_flight: Optional[int] = None,
+                 resume: bool = False,
+                 listen: Optional[str] = None,
+                 local_workers: int = 0):
         # pylint: disable=too-many-arguments,too-many-locals
         # Required for CLI args, process orchestration
         job_path = Path(self.__app_dirs.user_data_dir, job_name).resolve()
@@ -157,26 +225,43 @@ class Deduplicator:
         if len(bad_dirs) > 0:
             raise FileNotFoundError(f'Unknown directories {bad_dirs}')
 
-        for directory in directories:
-            directory_path = directory.resolve()
-            self.__log.info(f'Walking path {directory_path}')
+        if clear_cache:
+            user_input = input(
+                'Clearing the cache is a destructive operation, proceed? [y/N]: ')
+            if user_input.lower().strip() != 'y':
+                return
 
-            if clear_cache:
-                user_input = input(
-                    'Clearing the cache is a destructive operation, proceed? [y/N]: ')
-                if user_input.lower().strip() != 'y':
-                    return
+        if exclude:
+            ignore_pattern = load_ignore_filter(exclude.resolve())
+        else:
+            ignore_pattern = None
+        self.__log.info(f'Using ignore pattern {ignore_pattern}')
 
-            if exclude:
-                ignore_pattern = load_ignore_pattern(exclude.resolve())
-            else:
-                ignore_pattern = None
-            self.__log.info(f'Using ignore pattern {ignore_pattern}')
+        directory_paths = [directory.resolve() for directory in directories]
+        for directory_path in directory_paths:
+            self.__log.info(f'Walking path {directory_path}')
 
-            with Analyzer(ignore_pattern=ignore_pattern, job_path=job_path) as app:
-                if clear_cache:
-                    app.clear_cache()
-                app.analyze(working_dir=directory_path)
+        with contextlib.ExitStack() as stack:
+            coordinator = None
+            if listen:
+                coordinator = stack.enter_context(Coordinator(parse_address(listen),
+                                                              load_authkey(),
+                                                              n_local_workers=local_workers))
+            app = stack.enter_context(Analyzer(ignore_pattern=ignore_pattern,
+                                               job_path=job_path,
+                                               hash_backend=backend,
+                                               walk_workers=walk_workers,
+                                               algorithm=algorithm,
+                                               hash_workers=hash_workers,
+                                               in_flight=in_flight,
+                                               coordinator=coordinator))
+            if clear_cache:
+                app.clear_cache()
+            app.analyze_many(directory_paths,
+                             incremental=incremental,
+                             size_filter=size_filter,
+                             partial_hash=partial_hash,
+                             resume=resume)
 
         self.__generate_report(analysis_dest, job_path,
                                ignore_pattern, ignore_hashes=ignore_hash)
@@ -184,14 +269,11 @@ class Deduplicator:
     def __generate_report(self,
                           analysis_dest: str,
                           job_path: Path,
-                          ignore_pattern: Optional[re.Pattern],
+                          ignore_pattern: Optional[IgnoreFilter],
                           ignore_hashes: List[str] = None):
         with self.output_writer(analysis_dest) as handle, \
                 Analyzer(ignore_pattern=ignore_pattern, job_path=job_path) as app:
-            analysis_report = app.get_duplicates(ignore_hashes=ignore_hashes)
-            for digest, files in sorted(analysis_report.items(),
-                                        key=lambda x: len(x[1]),
-                                        reverse=True):
+            for digest, files in app.iter_duplicates(ignore_hashes=ignore_hashes):
                 handle.write(
                     f'File signature {digest} discovered {len(files)} times:\n'
                 )
@@ -204,7 +286,7 @@ class Deduplicator:
                             type=Path,
                             required=True)
         parser.add_argument('-e', '--exclude',
-                            help='Path to ignore file of absolute path regex patterns to exclude.',
+                            help='Path to ignore file of regex patterns to exclude.',
                             type=Path,
                             default=None)
         parser.add_argument('-j', '--job_name',
@@ -220,6 +302,41 @@ class Deduplicator:
                             choices=['cmd', 'ps', 'sh'],
                             default=None,
                             help='Shell to generate script for')
+        parser.add_argument('--size_filter',
+                            action='store_true',
+                            help='Only hashes files whose size matches another file in the job.')
+        parser.add_argument('--partial_hash',
+                            action='store_true',
+                            help='Only hashes files whose size and partial digest match another '
+                            'file in the job.  Implies --size_filter.')
+        parser.add_argument('--backend',
+                            type=str,
+                            choices=BACKENDS,
+                            default='threads',
+                            help='Hashing backend.  auto uses processes for many small files, '
+                            'and pipeline prefetches files ahead of hashing for network '
+                            'filesystems.')
+        parser.add_argument('--hash_workers',
+                            type=int,
+                            default=None,
+                            help='Number of hashing threads or processes.  Defaults to the '
+                            'number of CPUs.')
+        parser.add_argument('--in_flight',
+                            type=int,
+                            default=None,
+                            help='Number of files prefetched at once by the pipeline backend.  '
+                            f'Defaults to {ParallelHasher.PIPELINE_IN_FLIGHT}.')
+        parser.add_argument('--walk_workers',
+                            type=int,
+                            default=1,
+                            help='Number of directories to list concurrently.  Increase for '
+                            'network filesystems.')
+        parser.add_argument('--algorithm',
+                            type=str,
+                            choices=sorted(HASH_ALGORITHMS),
+                            default=None,
+                            help='Hash algorithm.  Defaults to the algorithm of the job, or '
+                            f'{DEFAULT_ALGORITHM} for a new job.')
         parser.set_defaults(func=self._delete)
 
     def _delete(self,
@@ -227,7 +344,14 @@ class Deduplicator:
                 exclude: Path,
                 job_name: str,
                 script_dest: Path,
-                shell: str = None):
+                shell: str = None,
+                size_filter: bool = False,
+                partial_hash: bool = False,
+                backend: str = 'threads',
+                walk_workers: int = 1,
+                algorithm: Optional[str] = None,
+                hash_workers: Optional[int] = None,
+                in_flight: Optional[int] = None):
         # pylint: disable=too-many-arguments,too-many-locals
         # Required for CLI args, process orchestration
         job_path = Path(self.__app_dirs.user_data_dir, job_name).resolve()
@@ -240,14 +364,22 @@ class Deduplicator:
 
         if exclude:
             ignore_path = exclude.resolve()
-            ignore_pattern = load_ignore_pattern(ignore_path)
+            ignore_pattern = load_ignore_filter(ignore_path)
         else:
             ignore_pattern = None
         self.__log.info(f'Using ignore pattern {ignore_pattern}')
 
-        with Analyzer(ignore_pattern=ignore_pattern, job_path=job_path) as app:
+        with Analyzer(ignore_pattern=ignore_pattern,
+                      job_path=job_path,
+                      hash_backend=backend,
+                      walk_workers=walk_workers,
+                      algorithm=algorithm,
+                      hash_workers=hash_workers,
+                      in_flight=in_flight) as app:
             delete_report = app.delete(
-                working_dir=directory_path
+                working_dir=directory_path,
+                size_filter=size_filter,
+                partial_hash=partial_hash
             )
 
         os_shell_map = {
@@ -280,12 +412,47 @@ class Deduplicator:
                             type=Path,
                             help='filename to export cache CSV as',
                             required=True)
+        parser.add_argument('--shard',
+                            action='store_true',
+                            help='Exports only the records of one host, sorted for merge_cache')
+        parser.add_argument('--host',
+                            type=str,
+                            default=None,
+                            help='Host to export with --shard.  Defaults to this host.')
+        parser.add_argument('--compact',
+                            action='store_true',
+                            help='Exports a compact block compressed record file instead of JSON '
+                            'lines.  import_cache and merge_cache detect the format.')
+        parser.add_argument('--compression',
+                            choices=sorted(COMPRESSORS),
+                            default='zlib',
+                            help='Block compression with --compact.  Defaults to zlib.')
         parser.set_defaults(func=self._export_cache)
 
-    def _export_cache(self, job_name: str, output: Path) -> None:
+    def _export_cache(self,
+                      job_name: str,
+                      output: Path,
+                      shard: bool = False,
+                      host: Optional[str] = None,
+                      compact: bool = False,
+                      compression: str = 'zlib') -> None:
+        # pylint: disable=too-many-arguments
+        # Required for CLI args
         job_path = Path(self.__app_dirs.user_data_dir, job_name).resolve()
         self.__log.info(f'Using job path {job_path}')
-        shutil.copy(job_path.joinpath('hashes.csv'), output.resolve())
+        if not job_path.is_dir():
+            raise FileNotFoundError(f'Unknown job {job_name}')
+        with JobCache(job_path) as job:
+            if compact:
+                if shard and host is None:
+                    host = socket.gethostname()
+                job.export_compact(output.resolve(),
+                                   host=host if shard else None,
+                                   compression=compression)
+            elif shard:
+                job.export_shard(output.resolve(), host=host)
+            else:
+                job.export_json(output.resolve())
 
     def __configure_import_cache_parser(self, parser: ArgumentParser):
         parser.add_argument('-i', '--input_file',
@@ -307,8 +474,53 @@ class Deduplicator:
             if job_path.is_dir():
                 print(f'A job named {name} already exists!')
                 return
-        job_path.mkdir(parents=True, exist_ok=True)
-        shutil.copy(input_file, job_path.joinpath('hashes.csv'))
+        with JobCache(job_path) as job:
+            job.clear()
+            job.import_json(input_file)
+
+    def __configure_merge_cache_parser(self, parser: ArgumentParser):
+        parser.add_argument('-i', '--input_file',
+                            type=Path,
+                            required=True,
+                            action='append',
+                            help='Shard or exported cache to merge.  May be repeated.')
+        parser.add_argument('-n', '--name',
+                            type=str,
+                            required=True,
+                            help='job name to merge into, created if it does not exist')
+        parser.set_defaults(func=self._merge_cache)
+
+    def _merge_cache(self, input_file: List[Path], name: str) -> None:
+        job_path = Path(self.__app_dirs.user_data_dir, name)
+        with JobCache(job_path) as job:
+            n_added = job.merge_json([path.resolve() for path in input_file])
+        print(f'Merged {n_added} records into {name}')
+
+    def __configure_worker_parser(self, parser: ArgumentParser):
+        parser.add_argument('-c', '--connect',
+                            type=str,
+                            required=True,
+                            help='Address of the analyze --listen coordinator, host:port or a '
+                            f'socket path.  Requires {AUTHKEY_ENV}.')
+        parser.add_argument('--threads',
+                            type=int,
+                            default=None,
+                            help='Number of hashing threads.  Defaults to the number of CPUs.')
+        parser.add_argument('--path_map',
+                            type=str,
+                            nargs=2,
+                            metavar=('COORDINATOR_PREFIX', 'WORKER_PREFIX'),
+                            default=None,
+                            help='Replaces the prefix of the coordinator\'s paths, for shares '
+                            'mounted at different paths on this host.')
+        parser.set_defaults(func=self._worker)
+
+    def _worker(self, connect: str, threads: Optional[int] = None,
+                path_map: Optional[List[str]] = None) -> None:
+        run_worker(parse_address(connect),
+                   load_authkey(),
+                   n_threads=threads,
+                   path_map=tuple(path_map) if path_map else None)
 
     def __configure_list_jobs_parser(self, parser: ArgumentParser):
         parser.set_defaults(func=self._list_jobs)
@@ -0,0 +1,41 @@
+'''Cache v1.5.0 to v1.6.0 upgrade logic
+'''
+import argparse
+from pathlib import Path
+
+from e4e_deduplication.job_cache import JobCache
+
+
+def upgrade_cache(
+        hash_file: Path,
+        dest_path: Path):
+    """Upgrades a v1.5.0 JSON lines hash file to a v1.6.0 SQLite job cache
+
+    Args:
+        hash_file (Path): Hash file to upgrade
+        dest_path (Path): Job directory to write the upgraded cache to
+    """
+    with JobCache(dest_path) as cache:
+        cache.import_json(hash_file)
+
+
+def main():
+    """CLI Interface
+    """
+    parser = argparse.ArgumentParser(
+        description='e4e_deduplication upgrade cache tool from v1.5.0 to v1.6.0'
+    )
+    parser.add_argument('--hash_file',
+                        type=Path,
+                        help='v1.5.0 hash file to upgrade',
+                        required=True)
+    parser.add_argument('--dest_path',
+                        type=Path,
+                        help='Job directory to write upgraded v1.6.0 cache to',
+                        required=True)
+    args = parser.parse_args()
+    upgrade_cache(**vars(args))
+
+
+if __name__ == '__main__':
+    main()
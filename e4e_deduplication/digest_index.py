@@ -0,0 +1,235 @@
+'''Compact Digest Index
+'''
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from hashlib import sha256
+from heapq import merge as heap_merge
+from operator import itemgetter
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+KEY_SIZE = 32
+_MAGIC = b'E4EDIDX2'
+# Magic, cache generation, max record id, number of keys, in native byte order like the id array
+_HEADER = struct.Struct('=8sqqQ')
+
+
+def pack_digest(digest: str) -> bytes:
+    """Packs a digest into a fixed size binary key.  64 character hex digests are stored as their
+    32 raw bytes, and any other digest is stored as the SHA-256 of its text.
+
+    Args:
+        digest (str): Digest
+
+    Returns:
+        bytes: KEY_SIZE byte key
+    """
+    if len(digest) == 2 * KEY_SIZE:
+        try:
+            return bytes.fromhex(digest)
+        except ValueError:
+            pass
+    return sha256(digest.encode()).digest()
+
+
+class _Keys:
+    """Sequence view of the fixed size keys in a buffer, for bisect
+    """
+    # pylint: disable=too-few-public-methods
+    # Sequence protocol only
+
+    def __init__(self, buffer: bytes, n_keys: int):
+        self.__buffer = buffer
+        self.__n_keys = n_keys
+
+    def __len__(self) -> int:
+        return self.__n_keys
+
+    def __getitem__(self, idx: int) -> bytes:
+        return bytes(self.__buffer[idx * KEY_SIZE:(idx + 1) * KEY_SIZE])
+
+
+class DigestIndex:
+    """Sorted index of binary digest keys and the record ids that have each digest.  Each record
+    costs KEY_SIZE + 8 bytes, and records sharing a digest are adjacent, so a digest's ids are a
+    contiguous slice of the id array.  Indices can be saved to a sidecar file, and loaded by
+    memory mapping the file instead of reading it.
+    """
+
+    def __init__(self, keys: bytes, row_ids: Sequence[int], *,
+                 mapping: Optional[mmap.mmap] = None):
+        """Initializes the index over sorted data
+
+        Args:
+            keys (bytes): Concatenated KEY_SIZE byte keys in ascending order
+            row_ids (Sequence[int]): Signed 64-bit record id of each key, as an array or
+            memoryview
+            mapping (Optional[mmap.mmap], optional): Memory map backing keys and row_ids, closed
+            by close. Defaults to None.
+        """
+        if len(keys) != KEY_SIZE * len(row_ids):
+            raise ValueError('Keys and ids do not match')
+        self.__keys = _Keys(keys, len(row_ids))
+        self.__key_buffer = keys
+        self.__row_ids = row_ids
+        self.__mapping = mapping
+        self.__appended: Optional[DigestIndex] = None
+
+    @classmethod
+    def build(cls, records: Iterable[Tuple[str, int]]) -> DigestIndex:
+        """Builds the index
+
+        Args:
+            records (Iterable[Tuple[str, int]]): Digest and record id of each record.  Records
+            already ordered by digest are not sorted again.
+
+        Returns:
+            DigestIndex: Digest index
+        """
+        return cls.__from_keys((pack_digest(digest), row_id) for digest, row_id in records)
+
+    @classmethod
+    def __from_keys(cls, records: Iterable[Tuple[bytes, int]]) -> DigestIndex:
+        keys = bytearray()
+        row_ids = array('q')
+        is_sorted = True
+        prev_key = b''
+        for key, row_id in records:
+            is_sorted = is_sorted and key >= prev_key
+            prev_key = key
+            keys += key
+            row_ids.append(row_id)
+        if not is_sorted:
+            view = _Keys(bytes(keys), len(row_ids))
+            order = sorted(range(len(row_ids)), key=view.__getitem__)
+            keys = bytearray().join(view[idx] for idx in order)
+            row_ids = array('q', (row_ids[idx] for idx in order))
+        return cls(bytes(keys), row_ids)
+
+    def append(self, records: Iterable[Tuple[str, int]]) -> int:
+        """Adds records to an in-memory layer over the sorted data, such as records added to the
+        cache since a sidecar file was saved
+
+        Args:
+            records (Iterable[Tuple[str, int]]): Digest and record id of each record
+
+        Returns:
+            int: Number of records in the in-memory layer
+        """
+        layer = [(pack_digest(digest), row_id) for digest, row_id in records]
+        if self.__appended is not None:
+            layer.extend(self.__appended)
+        self.__appended = DigestIndex.__from_keys(layer)
+        return len(self.__appended)
+
+    def __iter__(self) -> Iterator[Tuple[bytes, int]]:
+        """Iterates over the binary key and record id of each record in key order
+        """
+        records = ((self.__keys[idx], self.__row_ids[idx]) for idx in range(len(self.__keys)))
+        if self.__appended is None:
+            return records
+        return heap_merge(records, self.__appended, key=itemgetter(0))
+
+    def save(self, path: Path, max_row_id: int, generation: int = 0) -> None:
+        """Atomically writes the index, including any appended records, to a sidecar file
+
+        Args:
+            path (Path): Sidecar path
+            max_row_id (int): Largest record id in the cache when the index was built
+            generation (int, optional): Generation of the cache when the index was built, which
+            changes whenever records are removed. Defaults to 0.
+        """
+        temp_path = path.with_name(path.name + '.tmp')
+        with open(temp_path, 'wb') as handle:
+            handle.write(_HEADER.pack(_MAGIC, generation, max_row_id, len(self)))
+            if self.__appended is None:
+                handle.write(self.__key_buffer)
+                handle.write(self.__row_ids.tobytes())
+            else:
+                row_ids = array('q')
+                for key, row_id in self:
+                    handle.write(key)
+                    row_ids.append(row_id)
+                handle.write(row_ids.tobytes())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> Tuple[DigestIndex, int, int]:
+        """Memory maps an index sidecar file
+
+        Args:
+            path (Path): Sidecar path
+
+        Raises:
+            ValueError: Sidecar file is not a valid index
+
+        Returns:
+            Tuple[DigestIndex, int, int]: Digest index, and the largest record id and generation
+            of the cache when the index was built
+        """
+        with open(path, 'rb') as handle:
+            header = handle.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                raise ValueError(f'Truncated digest index {path}')
+            magic, generation, max_row_id, n_keys = _HEADER.unpack(header)
+            if magic != _MAGIC:
+                raise ValueError(f'Unknown digest index format {path}')
+            if os.fstat(handle.fileno()).st_size != _HEADER.size + n_keys * (KEY_SIZE + 8):
+                raise ValueError(f'Truncated digest index {path}')
+            if n_keys == 0:
+                return cls(b'', array('q')), max_row_id, generation
+            mapping = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        keys_end = _HEADER.size + n_keys * KEY_SIZE
+        view = memoryview(mapping)
+        index = cls(view[_HEADER.size:keys_end], view[keys_end:].cast('q'), mapping=mapping)
+        return index, max_row_id, generation
+
+    def close(self) -> None:
+        """Releases the memory map backing a loaded index
+        """
+        if self.__mapping is None:
+            return
+        self.__key_buffer.release()
+        self.__row_ids.release()
+        self.__mapping.close()
+        self.__mapping = None
+
+    def __len__(self) -> int:
+        n_appended = len(self.__appended) if self.__appended is not None else 0
+        return len(self.__row_ids) + n_appended
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the index data in bytes
+        """
+        n_appended = self.__appended.nbytes if self.__appended is not None else 0
+        return len(self.__key_buffer) + self.__row_ids.itemsize * len(self.__row_ids) + n_appended
+
+    def __contains__(self, digest: str) -> bool:
+        key = pack_digest(digest)
+        idx = bisect_left(self.__keys, key)
+        if idx < len(self.__keys) and self.__keys[idx] == key:
+            return True
+        return self.__appended is not None and digest in self.__appended
+
+    def lookup(self, digest: str) -> List[int]:
+        """Retrieves the ids of the records with the specified digest
+
+        Args:
+            digest (str): Digest to look up
+
+        Returns:
+            List[int]: Record ids, empty if the digest is not indexed
+        """
+        key = pack_digest(digest)
+        start = bisect_left(self.__keys, key)
+        end = bisect_right(self.__keys, key, lo=start)
+        row_ids = self.__row_ids[start:end].tolist()
+        if self.__appended is not None:
+            row_ids.extend(self.__appended.lookup(digest))
+        return row_ids
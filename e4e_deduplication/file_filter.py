@@ -1,8 +1,27 @@
 '''File Path Filter
 '''
+import os
 import re
 from pathlib import Path
-from typing import List
+from typing import List, Optional
+
+
+def _read_rules(ignore_path: Path) -> List[str]:
+    rules: List[str] = []
+    with open(ignore_path, 'r', encoding='utf-8') as handle:
+        for line in handle:
+            if line.startswith('#'):
+                continue
+            if len(line.strip()) == 0:
+                continue
+            rules.append(line.strip())
+    return rules
+
+
+def _compile(patterns: List[str]) -> Optional[re.Pattern]:
+    if not patterns:
+        return None
+    return re.compile('|'.join(patterns))
 
 
 def load_ignore_pattern(ignore_path: Path) -> re.Pattern:
@@ -14,13 +33,108 @@ def load_ignore_pattern(ignore_path: Path) -> re.Pattern:
     Returns:
         re.Pattern: Regex pattern
     """
-    regex_patterns: List[str] = []
-    with open(ignore_path, 'r', encoding='utf-8') as handle:
-        for line in handle:
-            if line.startswith('#'):
-                continue
-            if len(line.strip()) == 0:
-                continue
-            regex_patterns.append(line.strip())
+    regex_patterns = [rule.rstrip('/') for rule in _read_rules(ignore_path)]
     ignore_pattern = re.compile('|'.join(regex_patterns))
     return ignore_pattern
+
+
+def load_ignore_filter(ignore_path: Path) -> 'IgnoreFilter':
+    """Loads the ignore rules from file
+
+    Args:
+        ignore_path (Path): Path to ignore file
+
+    Returns:
+        IgnoreFilter: Ignore filter
+    """
+    return IgnoreFilter(_read_rules(ignore_path))
+
+
+class IgnoreFilter:
+    """Ignore rules split by what they apply to.  Rules ending in / only apply to directories, and
+    ignored directories are not descended into.  Rules containing a / are searched for in the
+    absolute posix path.  All other rules are searched for in the file or directory name only,
+    which is much cheaper than searching the full path.
+    """
+
+    def __init__(self, rules: List[str], *, path_rules: Optional[List[str]] = None):
+        """Initializes the ignore filter
+
+        Args:
+            rules (List[str]): Regex ignore rules
+            path_rules (Optional[List[str]], optional): Regex rules to search for in the absolute
+            path of every directory and file. Defaults to None.
+        """
+        path_rules = path_rules or []
+        dir_name_rules: List[str] = []
+        dir_path_rules: List[str] = list(path_rules)
+        file_name_rules: List[str] = []
+        file_path_rules: List[str] = list(path_rules)
+        for rule in rules:
+            if rule.endswith('/'):
+                rule = rule.rstrip('/')
+                if '/' in rule:
+                    dir_path_rules.append(rule)
+                else:
+                    dir_name_rules.append(rule)
+            elif '/' in rule:
+                dir_path_rules.append(rule)
+                file_path_rules.append(rule)
+            else:
+                dir_name_rules.append(rule)
+                file_name_rules.append(rule)
+        self.__dir_names = _compile(dir_name_rules)
+        self.__dir_paths = _compile(dir_path_rules)
+        self.__file_names = _compile(file_name_rules)
+        self.__file_paths = _compile(file_path_rules)
+        self.__rules = list(rules) + path_rules
+
+    @classmethod
+    def from_pattern(cls, pattern: re.Pattern) -> 'IgnoreFilter':
+        """Creates a filter that searches the absolute path of every directory and file, as a
+        single ignore pattern does
+
+        Args:
+            pattern (re.Pattern): Regex pattern of absolute paths to exclude
+
+        Returns:
+            IgnoreFilter: Ignore filter
+        """
+        return cls([], path_rules=[pattern.pattern])
+
+    def __repr__(self) -> str:
+        return f'IgnoreFilter({self.__rules})'
+
+    def ignore_directory(self, path: str, name: str) -> bool:
+        """Checks whether a directory and everything below it is ignored
+
+        Args:
+            path (str): Directory path
+            name (str): Directory name
+
+        Returns:
+            bool: True if ignored, otherwise False
+        """
+        if self.__dir_names and self.__dir_names.search(name):
+            return True
+        return bool(self.__dir_paths and self.__dir_paths.search(_to_posix(path)))
+
+    def ignore_file(self, path: str, name: str) -> bool:
+        """Checks whether a file is ignored
+
+        Args:
+            path (str): File path
+            name (str): File name
+
+        Returns:
+            bool: True if ignored, otherwise False
+        """
+        if self.__file_names and self.__file_names.search(name):
+            return True
+        return bool(self.__file_paths and self.__file_paths.search(_to_posix(path)))
+
+
+def _to_posix(path: str) -> str:
+    if os.sep == '/':
+        return path
+    return path.replace(os.sep, '/')
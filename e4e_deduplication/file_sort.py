@@ -1,113 +1,146 @@
 '''Utility to sort a file line by line
 '''
-import math
+import json
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
 from heapq import merge as heap_merge
-from multiprocessing import Condition, Event, Process, Queue, cpu_count
+from multiprocessing import cpu_count, get_context
 from pathlib import Path
-from queue import Empty
-from shutil import copy
 from tempfile import TemporaryDirectory
-from typing import Iterable
+from typing import Any, Callable, List, Optional, Tuple
 
+DEFAULT_MEMORY_BUDGET = 256*1024*1024
+MAX_FAN_IN = 64
 
-class PoolMerger:
-    """Parallel Process Merger
+SortKey = Optional[Callable[[str], Any]]
 
+
+def json_field(line: str, field: str) -> Any:
+    """Extracts a field from a JSON lines record, for use as a sort key with functools.partial
+
+    Args:
+        line (str): JSON document
+        field (str): Field to extract
+
+    Returns:
+        Any: Field value
     """
-    # pylint: disable=too-few-public-methods
-    # Runner
-
-    def __init__(self):
-        self.final_size = 0
-        self.final_path = None
-
-    def run(self, partitions: Iterable[Path], final_size: int) -> Path:
-        """Runs the pool merger over the specified partitions
-
-        Args:
-            partitions (Iterable[Path]): Specified partitions
-            final_size (int): Final size of merged file
-
-        Returns:
-            Path: Path of final file
-        """
-        self.final_size = final_size
-        merger_terminate = Event()
-        merger_condition = Condition()
-        merge_queue = Queue()
-        result_queue = Queue()
-
-        merger_terminate.clear()
-        workers = [Process(target=self._merger, kwargs={
-            'condition': merger_condition,
-            'queue': merge_queue,
-            'terminate': merger_terminate,
-            'result_queue': result_queue
-        }, name=f'merge_worker_{thread_idx:03d}') for thread_idx in range(cpu_count())]
-        for worker in workers:
-            worker.start()
-        with merger_condition:
-            for partition in partitions:
-                merge_queue.put(partition)
-            merger_condition.notify_all()
-        for worker in workers:
-            worker.join()
-        return result_queue.get()
-
-    def _merger(self, condition: Condition, queue: Queue, terminate: Event, result_queue: Queue):
-        while True:
-            with condition:
-                if queue.empty() and not terminate.is_set():
-                    condition.wait(timeout=1)
-                if terminate.is_set() and queue.empty():
-                    return
-                try:
-                    part1: Path = queue.get(block=False)
-                except Empty:
-                    continue
-                if part1.stat().st_size == self.final_size:
-                    terminate.set()
-                    condition.notify_all()
-                    result_queue.put(part1)
-                    return
-                if queue.empty():
-                    queue.put(part1)
-                    condition.wait(timeout=5)
-                    continue
-                part2: Path = queue.get(block=False)
-            output_path = part1.parent.joinpath(f'{part1.stem}_{part2.stem}')
-            with open(part1, 'r', encoding='utf-8', newline='\n') as handle1, \
-                open(part2, 'r', encoding='utf-8', newline='\n') as handle2, \
-                    open(output_path, 'w', encoding='utf-8', newline='\n') as output_handle:
-                output_handle.writelines(heap_merge(handle1, handle2))
-            part1.unlink()
-            part2.unlink()
-            with condition:
-                queue.put(output_path)
-                condition.notify()
-
-
-def sort_file(src_path: Path, sorted_path: Path) -> None:
-    """Sorts the file line by line
+    return json.loads(line)[field]
+
+
+def _split_runs(src_path: Path, run_size: int) -> List[Tuple[int, int]]:
+    """Splits the file into byte ranges of about run_size bytes that end on line boundaries
 
     Args:
-        src_path (Path): Source Path
-        sorted_path (Path): Final Path
+        src_path (Path): File to split
+        run_size (int): Target size of each range in bytes
 
+    Returns:
+        List[Tuple[int, int]]: Start and end offset of each range
     """
     file_size = src_path.stat().st_size
-    partition_size = min(math.ceil(file_size / cpu_count()), 1024*1024*1024)
-    with TemporaryDirectory() as tmpdir:
+    bounds: List[Tuple[int, int]] = []
+    start = 0
+    with open(src_path, 'rb') as handle:
+        while start < file_size:
+            handle.seek(min(start + run_size, file_size))
+            handle.readline()
+            end = handle.tell()
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+
+def _line_key(line: str, key: SortKey) -> Any:
+    """Computes the sort key of a line without its newline, so runs and merges order alike
+
+    Args:
+        line (str): Line, with or without the trailing newline
+        key (SortKey): Function to extract the sort key from each line
+
+    Returns:
+        Any: Sort key
+    """
+    line = line[:-1] if line.endswith('\n') else line
+    return key(line) if key else line
+
+
+def _sort_run(src_path: Path, start: int, end: int, run_path: Path, key: SortKey) -> Path:
+    with open(src_path, 'rb') as handle:
+        handle.seek(start)
+        text = handle.read(end - start).decode('utf-8')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    lines.sort(key=partial(_line_key, key=key))
+    with open(run_path, 'w', encoding='utf-8', newline='\n') as run_handle:
+        run_handle.writelines(line + '\n' for line in lines)
+    return run_path
+
+
+def _merge_runs(runs: List[Path], output_path: Path, key: SortKey) -> Path:
+    with ExitStack() as stack:
+        handles = [stack.enter_context(open(run, 'r', encoding='utf-8', newline='\n'))
+                   for run in runs]
+        with open(output_path, 'w', encoding='utf-8', newline='\n') as output_handle:
+            output_handle.writelines(heap_merge(*handles, key=partial(_line_key, key=key)))
+    for run in runs:
+        run.unlink()
+    return output_path
+
+
+def sort_file(src_path: Path,
+              sorted_path: Path,
+              *,
+              key: SortKey = None,
+              memory_budget: int = DEFAULT_MEMORY_BUDGET,
+              n_workers: Optional[int] = None,
+              max_fan_in: int = MAX_FAN_IN) -> None:
+    """Sorts the file line by line with an external merge sort.  The file is split into sorted
+    runs in parallel, which are then merged in a single k-way pass unless there are more than
+    max_fan_in runs.  Each line is terminated with a newline in the sorted file.
+
+    Args:
+        src_path (Path): Source Path
+        sorted_path (Path): Final Path
+        key (SortKey, optional): Function to extract the sort key from each line.  Must be
+        picklable, such as functools.partial(json_field, field='digest').  Defaults to None.
+        memory_budget (int, optional): Approximate number of source bytes held in memory across
+        all workers at once.  Defaults to DEFAULT_MEMORY_BUDGET.
+        n_workers (Optional[int], optional): Number of processes to generate and merge runs
+        with.  Defaults to the number of CPUs.
+        max_fan_in (int, optional): Maximum number of runs merged at once.  Defaults to
+        MAX_FAN_IN.
+    """
+    # pylint: disable=too-many-arguments
+    # Sort configuration
+    n_workers = n_workers or cpu_count()
+    run_bounds = _split_runs(src_path, max(memory_budget // n_workers, 1))
+    if not run_bounds:
+        # Empty source
+        sorted_path.write_text('', encoding='utf-8')
+        return
+    # The calling process may already run threads, and forking it can copy held locks into the
+    # children, so the workers are started fresh
+    with TemporaryDirectory() as tmpdir, \
+            ProcessPoolExecutor(max_workers=n_workers,
+                                mp_context=get_context('spawn')) as executor:
         temp_dir = Path(tmpdir).resolve()
-        partitions = []
-        with open(src_path, 'r', encoding='utf-8') as src_handle:
-            partition_idx = 0
-            while lines := src_handle.readlines(partition_size):
-                partition_path = temp_dir.joinpath(f'{partition_idx}')
-                with open(partition_path, 'w', encoding='utf-8', newline='\n') as partition_handle:
-                    partition_handle.writelines(sorted(lines))
-                partition_idx += 1
-                partitions.append(partition_path)
-        pool = PoolMerger()
-        sorted_file = pool.run(partitions, file_size)
-        copy(sorted_file, sorted_path)
+        runs: List[Path] = list(executor.map(
+            _sort_run,
+            [src_path] * len(run_bounds),
+            [start for start, _ in run_bounds],
+            [end for _, end in run_bounds],
+            [temp_dir.joinpath(f'run_{idx}') for idx in range(len(run_bounds))],
+            [key] * len(run_bounds)))
+        merge_pass = 0
+        while len(runs) > max_fan_in:
+            groups = [runs[idx:idx + max_fan_in] for idx in range(0, len(runs), max_fan_in)]
+            runs = list(executor.map(
+                _merge_runs,
+                groups,
+                [temp_dir.joinpath(f'pass_{merge_pass}_{idx}') for idx in range(len(groups))],
+                [key] * len(groups)))
+            merge_pass += 1
+        _merge_runs(runs, sorted_path, key)
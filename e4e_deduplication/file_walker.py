@@ -0,0 +1,168 @@
+'''Directory Walker
+'''
+import logging
+import os
+import re
+from collections import deque
+from pathlib import Path
+from queue import Queue
+from threading import Condition, Thread
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple, Union
+
+from e4e_deduplication.file_filter import IgnoreFilter
+
+QUEUE_SIZE = 1024
+_SENTINEL = None
+
+
+def _scan_directory(directory: str,
+                    ignore_filter: Optional[IgnoreFilter]
+                    ) -> Tuple[List[str], List[Tuple[Path, os.stat_result]]]:
+    """Lists a single directory
+
+    Args:
+        directory (str): Directory to list
+        ignore_filter (Optional[IgnoreFilter]): Ignore rules.  Ignored directories are not
+        descended into.
+
+    Returns:
+        Tuple[List[str], List[Tuple[Path, os.stat_result]]]: Subdirectories to descend into, and
+        the path and stat result of each file
+    """
+    logger = logging.getLogger('walk_files')
+    subdirectories: List[str] = []
+    files: List[Tuple[Path, os.stat_result]] = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if ignore_filter and ignore_filter.ignore_directory(entry.path,
+                                                                            entry.name):
+                            continue
+                        subdirectories.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if ignore_filter and ignore_filter.ignore_file(entry.path, entry.name):
+                        continue
+                    files.append((Path(entry.path), entry.stat()))
+                except OSError:
+                    logger.exception(f'Unable to stat {entry.path}')
+    except OSError:
+        logger.exception(f'Unable to list {directory}')
+    return subdirectories, files
+
+
+def walk_files(root: Union[Path, Iterable[Path]],
+               ignore_pattern: Union[re.Pattern, IgnoreFilter, None] = None,
+               *,
+               n_workers: int = 1
+               ) -> Iterator[Tuple[Path, os.stat_result]]:
+    """Walks the directory tree in a single pass with os.scandir, yielding each file with its stat
+    result.  Symbolic links to directories are not followed, and directories matching the ignore
+    pattern are pruned without being listed.
+
+    Args:
+        root (Union[Path, Iterable[Path]]): Directory to walk, or directories to walk together.
+        Directories inside another walked directory are walked again, so pass disjoint
+        directories.
+        ignore_pattern (Union[re.Pattern, IgnoreFilter, None], optional): Ignore rules, or a regex
+        pattern of absolute paths to exclude. Defaults to None.
+        n_workers (int, optional): Number of directories to list concurrently.  Listing is
+        latency bound on network filesystems, so this is independent of the number of hashing
+        workers.  The order of the files is not deterministic for more than one worker.
+        Defaults to 1.
+
+    Yields:
+        Iterator[Tuple[Path, os.stat_result]]: Path and stat result of each file
+    """
+    if isinstance(ignore_pattern, re.Pattern):
+        ignore_pattern = IgnoreFilter.from_pattern(ignore_pattern)
+    roots = [root] if isinstance(root, Path) else list(root)
+    if n_workers > 1:
+        yield from _ParallelWalker(roots, ignore_pattern, n_workers).walk()
+        return
+    # Popped from the end, so the roots are walked in order
+    directories: List[str] = [str(root) for root in reversed(roots)]
+    while directories:
+        subdirectories, files = _scan_directory(directories.pop(), ignore_pattern)
+        directories.extend(subdirectories)
+        yield from files
+
+
+class _ParallelWalker:
+    """Work stealing directory walker.  Each worker descends depth first through its own deque of
+    directories, and steals the shallowest directory from another worker when its own is empty.
+    """
+    # pylint: disable=too-few-public-methods
+    # Single use walker
+
+    def __init__(self, roots: List[Path], ignore_filter: Optional[IgnoreFilter], n_workers: int):
+        self.__ignore_filter = ignore_filter
+        self.__n_workers = n_workers
+        self.__directories: List[Deque[str]] = [deque() for _ in range(n_workers)]
+        for idx, root in enumerate(roots):
+            self.__directories[idx % n_workers].append(str(root))
+        self.__n_pending = len(roots)
+        self.__stopped = False
+        self.__condition = Condition()
+        self.__results = Queue(maxsize=QUEUE_SIZE)
+
+    def walk(self) -> Iterator[Tuple[Path, os.stat_result]]:
+        """Walks the tree
+
+        Yields:
+            Iterator[Tuple[Path, os.stat_result]]: Path and stat result of each file
+        """
+        workers = [Thread(target=self.__worker, args=(idx,), daemon=True)
+                   for idx in range(self.__n_workers)]
+        for worker in workers:
+            worker.start()
+        n_running = len(workers)
+        try:
+            while n_running:
+                if (files := self.__results.get()) is _SENTINEL:
+                    n_running -= 1
+                    continue
+                yield from files
+        finally:
+            with self.__condition:
+                self.__stopped = True
+                self.__condition.notify_all()
+            # Keep draining so the workers are not blocked on a full queue
+            while n_running:
+                if self.__results.get() is _SENTINEL:
+                    n_running -= 1
+            for worker in workers:
+                worker.join()
+
+    def __next_directory(self, idx: int) -> Optional[str]:
+        with self.__condition:
+            while not self.__stopped:
+                if self.__directories[idx]:
+                    return self.__directories[idx].pop()
+                for offset in range(1, self.__n_workers):
+                    victim = self.__directories[(idx + offset) % self.__n_workers]
+                    if victim:
+                        return victim.popleft()
+                if self.__n_pending == 0:
+                    return None
+                self.__condition.wait()
+            return None
+
+    def __worker(self, idx: int) -> None:
+        try:
+            while (directory := self.__next_directory(idx)) is not None:
+                subdirectories: List[str] = []
+                try:
+                    subdirectories, files = _scan_directory(directory, self.__ignore_filter)
+                    if files:
+                        self.__results.put(files)
+                finally:
+                    with self.__condition:
+                        self.__directories[idx].extend(subdirectories)
+                        self.__n_pending += len(subdirectories) - 1
+                        self.__condition.notify_all()
+        finally:
+            self.__results.put(_SENTINEL)
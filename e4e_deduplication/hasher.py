@@ -1,25 +1,333 @@
 '''File based hashers
 '''
 import logging
-from hashlib import sha256
+import mmap
+import os
+import stat
+import threading
+import time
+from functools import lru_cache, partial
+from hashlib import blake2b, sha256
 from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, NamedTuple, Optional
 
+BLOCK_SIZE = 2*1024*1024
+PREFETCH_SIZE = 4*1024*1024
+MMAP_MIN_SIZE = 64*1024*1024
+MMAP_WINDOW_SIZE = 256*1024*1024
+# Files modified more recently than this many seconds may still be written, and are read
+MMAP_MIN_AGE = 60
+# Linux filesystems whose files are mapped, network filesystems and any others are read
+MMAP_FILESYSTEMS = frozenset(['bcachefs', 'btrfs', 'exfat', 'ext2', 'ext3', 'ext4', 'f2fs',
+                              'hfsplus', 'jfs', 'ntfs', 'ntfs3', 'tmpfs', 'vfat', 'xfs', 'zfs'])
+PARTIAL_BLOCK_SIZE = 256*1024
+PARTIAL_N_SAMPLES = 4
+DEFAULT_ALGORITHM = 'sha256'
 
-def compute_sha256(path: Path) -> str:
+# Read buffers are reused by each hashing thread instead of allocating a new block per read
+_buffers = threading.local()
+
+# Constructors of hashlib style hash objects, keyed by algorithm name
+HASH_ALGORITHMS: Dict[str, Callable[[], Any]] = {
+    'sha256': sha256,
+    'blake2b': partial(blake2b, digest_size=32),
+}
+try:
+    import blake3
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+except ImportError:
+    pass
+try:
+    import xxhash
+    HASH_ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+
+def get_hasher(algorithm: str) -> Any:
+    """Creates a hash object for the specified algorithm
+
+    Args:
+        algorithm (str): Algorithm name, one of HASH_ALGORITHMS
+
+    Raises:
+        ValueError: Unknown or unavailable algorithm
+
+    Returns:
+        Any: hashlib style hash object
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f'Unknown hash algorithm {algorithm}, available algorithms are '
+                         f'{sorted(HASH_ALGORITHMS)}')
+    return HASH_ALGORITHMS[algorithm]()
+
+
+class PrefetchedFile(NamedTuple):
+    """File opened and read ahead of hashing by prefetch
+    """
+    # Open file to hash, or None if the whole file was read into data
+    handle: Optional[BinaryIO]
+    data: Optional[bytes]
+
+
+def _get_buffer(block_size: int) -> memoryview:
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < block_size:
+        buffer = memoryview(bytearray(block_size))
+        _buffers.buffer = buffer
+    return buffer[:block_size]
+
+
+def _open_for_hashing(path: Path, *, sequential: bool = True) -> BinaryIO:
+    """Opens the file for unbuffered reading without updating its access time, and advises the
+    kernel of sequential access, where supported
+
+    Args:
+        path (Path): Path to open
+        sequential (bool, optional): Whether the file will be read sequentially. Defaults to
+        True.
+
+    Returns:
+        BinaryIO: Unbuffered binary file
+    """
+    flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+    no_atime = getattr(os, 'O_NOATIME', 0)
+    try:
+        file_descriptor = os.open(path, flags | no_atime)
+    except PermissionError:
+        # O_NOATIME is only permitted for the owner of the file
+        if not no_atime:
+            raise
+        file_descriptor = os.open(path, flags)
+    if sequential and hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+    return open(file_descriptor, 'rb', buffering=0)
+
+
+def _read_block(handle: BinaryIO, buffer: memoryview) -> int:
+    # Unbuffered reads can return less than requested before the end of the file
+    n_read = 0
+    while n_read < len(buffer) and (n_chunk := handle.readinto(buffer[n_read:])):
+        n_read += n_chunk
+    return n_read
+
+
+@lru_cache(maxsize=None)
+def _filesystem_type(device: int) -> Optional[str]:
+    """Looks up the type of the filesystem with the specified device number
+
+    Args:
+        device (int): Device number, as in os.stat_result.st_dev
+
+    Returns:
+        Optional[str]: Filesystem type, or None if unknown
+    """
+    try:
+        with open('/proc/self/mountinfo', 'r', encoding='utf-8') as handle:
+            for line in handle:
+                fields = line.split()
+                major, minor = fields[2].split(':')
+                if os.makedev(int(major), int(minor)) == device:
+                    return fields[fields.index('-') + 1]
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _should_mmap(stat_result: os.stat_result, mmap_min_size: Optional[int]) -> bool:
+    if mmap_min_size is None or stat_result.st_size < max(mmap_min_size, 1):
+        return False
+    if not stat.S_ISREG(stat_result.st_mode):
+        return False
+    if time.time() - stat_result.st_mtime < MMAP_MIN_AGE:
+        return False
+    return _filesystem_type(stat_result.st_dev) in MMAP_FILESYSTEMS
+
+
+def _update_mmap(hasher: Any, file_descriptor: int, size: int) -> None:
+    # Windows bound the address space used by very large files
+    for offset in range(0, size, MMAP_WINDOW_SIZE):
+        with mmap.mmap(file_descriptor,
+                       min(MMAP_WINDOW_SIZE, size - offset),
+                       access=mmap.ACCESS_READ,
+                       offset=offset) as window:
+            if hasattr(window, 'madvise'):
+                window.madvise(mmap.MADV_SEQUENTIAL)
+            hasher.update(window)
+
+
+def compute_digest(path: Path,
+                   algorithm: str = DEFAULT_ALGORITHM,
+                   *,
+                   block_size: int = BLOCK_SIZE,
+                   mmap_min_size: Optional[int] = MMAP_MIN_SIZE,
+                   prefetched: Optional[PrefetchedFile] = None) -> str:
+    """Computes the digest of the file with the specified algorithm.  Regular files of at least
+    mmap_min_size bytes on local Linux filesystems that have not been modified for MMAP_MIN_AGE
+    seconds are memory mapped and hashed without copying.  Other files are read in blocks into a
+    buffer that is reused by each thread.  A mapped file that is truncated while it is hashed
+    kills the process with SIGBUS, so pass mmap_min_size=None for files that may be written.
+
+    Args:
+        path (Path): Path to hash
+        algorithm (str, optional): Algorithm name, one of HASH_ALGORITHMS. Defaults to
+        DEFAULT_ALGORITHM.
+        block_size (int, optional): Size of each read in bytes. Defaults to BLOCK_SIZE.
+        mmap_min_size (Optional[int], optional): Size in bytes from which local files are memory
+        mapped, or None to always read. Defaults to MMAP_MIN_SIZE.
+        prefetched (Optional[PrefetchedFile], optional): The file as returned by prefetch with
+        keep_open, which is hashed instead of opening the path again, and closed. Defaults to
+        None.
+
+    Returns:
+        str: Digest
+    """
+    logger = logging.getLogger('compute_digest')
+    if prefetched is not None and prefetched.handle is None:
+        hasher = get_hasher(algorithm)
+        hasher.update(prefetched.data)
+        return hasher.hexdigest()
+    if prefetched is not None:
+        handle = prefetched.handle
+    else:
+        handle = _open_for_hashing(path)
+    with handle:
+        hasher = get_hasher(algorithm)
+        stat_result = os.fstat(handle.fileno())
+        if _should_mmap(stat_result, mmap_min_size):
+            try:
+                _update_mmap(hasher, handle.fileno(), stat_result.st_size)
+                return hasher.hexdigest()
+            except (OSError, ValueError):
+                logger.warning(f'Unable to map {path}, reading instead')
+                hasher = get_hasher(algorithm)
+                handle.seek(0)
+        buffer = _get_buffer(block_size)
+        try:
+            while n_read := handle.readinto(buffer):
+                hasher.update(buffer[:n_read])
+        except OSError:
+            logger.exception(f'Exception when reading from {path}')
+    return hasher.hexdigest()
+
+
+def prefetch(path: Path,
+             n_bytes: int = PREFETCH_SIZE,
+             *,
+             keep_open: bool = False,
+             max_data: Optional[int] = None) -> Optional[PrefetchedFile]:
+    """Opens the file and reads its first n_bytes bytes, so that a following hash of the file is
+    served from the page cache.  Errors are left for the hash to report.
+
+    Args:
+        path (Path): Path to prefetch
+        n_bytes (int, optional): Number of bytes to read. Defaults to PREFETCH_SIZE.
+        keep_open (bool, optional): Whether to return the file for compute_digest instead of
+        closing it, so the file is only opened once.  Files of at most max_data bytes are
+        returned as their contents. Defaults to False.
+        max_data (Optional[int], optional): Size of the largest file returned as its contents.
+        Defaults to n_bytes.
+
+    Returns:
+        Optional[PrefetchedFile]: The file if keep_open, and it could be opened and read
+    """
+    if max_data is None:
+        max_data = n_bytes
+    try:
+        handle = _open_for_hashing(path)
+    except OSError:
+        return None
+    try:
+        if keep_open and os.fstat(handle.fileno()).st_size <= max_data:
+            with handle:
+                return PrefetchedFile(handle=None, data=handle.readall())
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(handle.fileno(), 0, n_bytes, os.POSIX_FADV_WILLNEED)
+        # Small reads keep the buffers of many prefetching threads small
+        buffer = _get_buffer(PARTIAL_BLOCK_SIZE)
+        n_read = 0
+        while n_read < n_bytes and (n_chunk := handle.readinto(buffer)):
+            n_read += n_chunk
+        if keep_open:
+            handle.seek(0)
+            return PrefetchedFile(handle=handle, data=None)
+    except OSError:
+        pass
+    handle.close()
+    return None
+
+
+def compute_sha256(path: Path, *, prefetched: Optional[PrefetchedFile] = None) -> str:
     """Computes the SHA256 sum
 
     Args:
         path (Path): Path to hash
+        prefetched (Optional[PrefetchedFile], optional): As in compute_digest. Defaults to None.
 
     Returns:
         str: Digest
     """
-    logger = logging.getLogger('compute_sha256')
-    hasher = sha256()
-    with open(path, 'rb') as handle:
+    return compute_digest(path, 'sha256', prefetched=prefetched)
+
+
+def compute_partial_digest(path: Path,
+                           algorithm: str = DEFAULT_ALGORITHM,
+                           *,
+                           block_size: int = PARTIAL_BLOCK_SIZE,
+                           n_samples: int = PARTIAL_N_SAMPLES) -> str:
+    """Computes the digest of the first and last blocks of the file, plus evenly spaced interior
+    blocks.  Files smaller than the sampled blocks are hashed in full.  Files with different
+    partial digests are not duplicates, but matching partial digests must still be confirmed with
+    a full digest.
+
+    Args:
+        path (Path): Path to hash
+        algorithm (str, optional): Algorithm name, one of HASH_ALGORITHMS. Defaults to
+        DEFAULT_ALGORITHM.
+        block_size (int, optional): Size of each sampled block in bytes. Defaults to
+        PARTIAL_BLOCK_SIZE.
+        n_samples (int, optional): Number of interior blocks to sample. Defaults to
+        PARTIAL_N_SAMPLES.
+
+    Returns:
+        str: Partial digest
+    """
+    logger = logging.getLogger('compute_partial_digest')
+    hasher = get_hasher(algorithm)
+    buffer = _get_buffer(block_size)
+    with _open_for_hashing(path, sequential=False) as handle:
+        size = handle.seek(0, os.SEEK_END)
+        if size <= block_size * (n_samples + 2):
+            offsets = range(0, size, block_size)
+        else:
+            last_offset = size - block_size
+            offsets = [last_offset * idx // (n_samples + 1) for idx in range(n_samples + 2)]
         try:
-            while blob := handle.read(2*1024*1024):
-                hasher.update(blob)
+            for offset in offsets:
+                handle.seek(offset)
+                hasher.update(buffer[:_read_block(handle, buffer)])
         except OSError:
             logger.exception(f'Exception when reading from {path}')
     return hasher.hexdigest()
+
+
+def compute_partial_sha256(path: Path, *,
+                           block_size: int = PARTIAL_BLOCK_SIZE,
+                           n_samples: int = PARTIAL_N_SAMPLES) -> str:
+    """Computes the SHA256 sum of the first and last blocks of the file, plus evenly spaced
+    interior blocks, as in compute_partial_digest
+
+    Args:
+        path (Path): Path to hash
+        block_size (int, optional): Size of each sampled block in bytes. Defaults to
+        PARTIAL_BLOCK_SIZE.
+        n_samples (int, optional): Number of interior blocks to sample. Defaults to
+        PARTIAL_N_SAMPLES.
+
+    Returns:
+        str: Partial digest
+    """
+    return compute_partial_digest(path, 'sha256', block_size=block_size, n_samples=n_samples)
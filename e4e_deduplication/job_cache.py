@@ -1,25 +1,237 @@
 '''Job Cache
 '''
+# pylint: disable=too-many-lines
+# Storage layout, upgrades, queries, and import and export formats of the job cache
 from __future__ import annotations
 
 import json
 import logging
 import os
-import shutil
 import socket
-from io import FileIO
+import sqlite3
+from contextlib import contextmanager
+from heapq import merge as heap_merge
+from operator import itemgetter
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Dict, List, Set, Tuple
+from typing import (Collection, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence,
+                    Set, Tuple, Union)
 
 from tqdm import tqdm
 
+from e4e_deduplication.digest_index import DigestIndex
 from e4e_deduplication.file_sort import sort_file
+from e4e_deduplication.hasher import DEFAULT_ALGORITHM
+from e4e_deduplication.record_file import RecordFile, is_record_file, write_records
+
+_INT64_MASK = (1 << 64) - 1
+_INT64_SIGN = 1 << 63
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hosts (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    digest BLOB,
+    path BLOB NOT NULL,
+    host_id INTEGER NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    device INTEGER,
+    partial BLOB,
+    algorithm TEXT
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS records_digest ON records(digest);
+CREATE INDEX IF NOT EXISTS records_host_path ON records(host_id, path);
+CREATE INDEX IF NOT EXISTS records_size ON records(size);
+'''
+_RECORD_COLUMNS = 'digest, path, size, mtime_ns, inode, device, partial, algorithm'
+# Orders digests by their text, with records that were not hashed first
+_DIGEST_ORDER = "CASE WHEN typeof(digest) = 'blob' THEN lower(hex(digest)) ELSE digest END"
+
+
+def _path_value(path: Path) -> bytes:
+    """Converts a path to the bytes stored in the cache.  Names that are not valid UTF-8 are
+    surrogate escaped by Python, and cannot be stored as SQLite text.
+
+    Args:
+        path (Path): Path of file
+
+    Returns:
+        bytes: Posix path as bytes
+    """
+    return os.fsencode(path.as_posix())
+
+
+def _value_path(value: bytes) -> Path:
+    return Path(os.fsdecode(value))
+
+
+def _digest_value(digest: Optional[str]) -> Union[bytes, str, None]:
+    """Converts a digest to the value stored in the cache.  Lowercase hex digests are stored as
+    their raw bytes, half the size of the text, and any other digest is stored as text.
+
+    Args:
+        digest (Optional[str]): Digest or partial digest
+
+    Returns:
+        Union[bytes, str, None]: Raw digest, or the digest text
+    """
+    if digest is None:
+        return None
+    try:
+        value = bytes.fromhex(digest)
+    except ValueError:
+        return digest
+    return value if value.hex() == digest else digest
+
+
+def _value_digest(value: Union[bytes, str, None]) -> Optional[str]:
+    return value.hex() if isinstance(value, bytes) else value
+
+
+def _iter_sorted(connection: sqlite3.Connection, host: Optional[str] = None) -> Iterator[Tuple]:
+    """Reads the records in the order of shards, by host, path and digest, with records that were
+    not hashed first.  Each host is read in path order from the host and path index, so the
+    records are not sorted in a temporary table.
+
+    Args:
+        connection (sqlite3.Connection): Job cache connection
+        host (Optional[str], optional): Host to read. Defaults to all hosts.
+
+    Yields:
+        Iterator[Tuple]: Digest, path, host, size, mtime_ns, inode, device, partial digest and
+        algorithm of each record, with digests as stored
+    """
+    if host is None:
+        hosts = connection.execute('SELECT id, name FROM hosts ORDER BY name').fetchall()
+    else:
+        hosts = connection.execute('SELECT id, name FROM hosts WHERE name = ?',
+                                   (host,)).fetchall()
+    for host_id, name in hosts:
+        cursor = connection.execute(
+            f'SELECT {_RECORD_COLUMNS} FROM records WHERE host_id = ? '
+            f'ORDER BY path, {_DIGEST_ORDER}', (host_id,))
+        for digest, path, *fields in cursor:
+            yield (digest, path, name, *fields)
+
+
+def _shard_sort_key(line: str) -> Tuple[str, bytes, str]:
+    """Extracts the host, path and digest of a JSON lines record, in the order of _iter_sorted
+
+    Args:
+        line (str): JSON document
+
+    Returns:
+        Tuple[str, bytes, str]: Host, path and digest, with an empty digest for records that
+        were not hashed
+    """
+    document = json.loads(line)
+    return document['host'], os.fsencode(document['path']), document['digest'] or ''
+
+
+def _read_documents(json_path: Path) -> Iterator[Dict]:
+    """Reads the records of a JSON lines hash file or a compact record file
+
+    Args:
+        json_path (Path): Hash file
+
+    Yields:
+        Dict: JSON document of each record
+    """
+    if is_record_file(json_path):
+        with RecordFile(json_path) as records:
+            yield from records
+        return
+    with open(json_path, 'r', encoding='utf-8') as handle:
+        for line in handle:
+            if line.strip() == '':
+                continue
+            yield json.loads(line)
+
+
+def _read_shard(json_path: Path) -> Iterator[Tuple[Tuple[str, bytes, str], Dict]]:
+    for document in _read_documents(json_path):
+        key = (document['host'], os.fsencode(document['path']), document['digest'] or '')
+        yield key, document
+
+
+def _to_int64(value: Optional[int]) -> Optional[int]:
+    # SQLite integers are signed 64-bit, inode and device numbers are unsigned
+    if value is None:
+        return None
+    return ((value & _INT64_MASK) ^ _INT64_SIGN) - _INT64_SIGN
+
+
+def _from_int64(value: Optional[int]) -> Optional[int]:
+    if value is None:
+        return None
+    return value & _INT64_MASK
+
+
+class FileStat(NamedTuple):
+    """File stat fingerprint used to detect unchanged files
+    """
+    size: int
+    mtime_ns: int
+    inode: int
+    device: int
+
+    @classmethod
+    def from_stat(cls, stat_result: os.stat_result) -> FileStat:
+        """Creates the fingerprint from a stat result
+
+        Args:
+            stat_result (os.stat_result): Result of os.stat or DirEntry.stat
+
+        Returns:
+            FileStat: File fingerprint
+        """
+        return cls(size=stat_result.st_size,
+                   mtime_ns=stat_result.st_mtime_ns,
+                   inode=stat_result.st_ino,
+                   device=stat_result.st_dev)
+
+
+class CacheRecord(NamedTuple):
+    """Job cache record
+    """
+    path: Path
+    host: str
+    digest: Optional[str]
+    size: Optional[int]
+    partial: Optional[str]
+
+
+class Checkpoint(NamedTuple):
+    """Progress of an analysis of a directory that has not completed
+    """
+    started: float
+    updated: float
+    n_files: int
+    last_path: Optional[str]
+    n_bytes: int = 0
 
 
 class JobCache:
     """Sqlite3 backed job cache
     """
+    # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    # Cache state and query interface
+    DB_NAME = 'hashes.db'
+    LEGACY_NAME = 'hashes.csv'
+    INDEX_NAME = 'digests.idx'
+    INDEX_COMPACT_RATIO = 8
+    BUFFER_SIZE = 10000
+    LOOKUP_BATCH_SIZE = 500
+    MMAP_SIZE = 1024*1024*1024
 
     def __init__(self, path: Path) -> None:
         self.__log = logging.getLogger(f'Job Cache {path.name}')
@@ -28,12 +240,14 @@ class JobCache:
         if path.exists():
             if not path.is_dir():
                 raise RuntimeError('Not a directory!')
-        self.__hash_path = path.joinpath('hashes.csv')
-        self.__hash_handle: FileIO = None
-        self.__hash_cache: Dict[str, List[int]] = {}
+        self.__db_path = path.joinpath(self.DB_NAME)
+        self.__legacy_path = path.joinpath(self.LEGACY_NAME)
+        self.__index_path = path.joinpath(self.INDEX_NAME)
+        self.__connection: sqlite3.Connection = None
         self.__current_hostname = socket.gethostname()
-        self.__n_lines: int = None
-        self.__sorted: bool = False
+        self.__pending_rows: List[Tuple] = []
+        self.__algorithm: Optional[str] = None
+        self.__host_ids: Dict[str, int] = {}
 
     def __enter__(self) -> JobCache:
         self.open()
@@ -42,40 +256,93 @@ class JobCache:
     def open(self):
         """Opens the cache
         """
-        # pylint: disable=consider-using-with
-        self.__hash_handle = open(
-            self.__hash_path, 'a+', encoding='utf-8', newline='\n')
-        # Resource needs to exist beyond the scope of this function
-        self.__rebuild_cache()
-        self.__hash_handle.seek(0)
-
-    def __rebuild_cache(self):
-        self.__hash_handle.seek(0)
-        self.__hash_cache.clear()
-        prev_line_idx = 0
-        self.__n_lines = 0
-        prev_line = ''
-        pb_ = tqdm(desc='Loading hash cache',
-                   total=self.__hash_path.stat().st_size,
-                   dynamic_ncols=True,
-                   unit='B',
-                   unit_scale=True)
-        self.__sorted = True
-        while line := self.__hash_handle.readline():
-            document: Dict = json.loads(line)
-            digest = document['digest']
-            if digest in self.__hash_cache:
-                self.__hash_cache[digest].append(
-                    prev_line_idx)
-            else:
-                self.__hash_cache[digest] = [prev_line_idx]
-            prev_line_idx = self.__hash_handle.tell()
-            pb_.update(len(line) + 1)
-            self.__n_lines += 1
-            if line < prev_line:
-                self.__sorted = False
-            prev_line = line
-        pb_.close()
+        if not self.__db_path.exists() and self.__legacy_path.is_file():
+            self.__migrate()
+        self.__connect(self.__db_path)
+
+    def __connect(self, db_path: Path):
+        # Records are added from the hasher's result thread
+        self.__connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('PRAGMA synchronous=NORMAL')
+        # Read pages through a memory map instead of a read call per page
+        self.__connection.execute(f'PRAGMA mmap_size={self.MMAP_SIZE}')
+        columns = {row[1] for row in self.__connection.execute('PRAGMA table_info(records)')}
+        if 'host' in columns:
+            self.__upgrade_records(columns)
+        self.__connection.executescript(_SCHEMA)
+
+    def __upgrade_records(self, columns: Set[str]):
+        """Converts the records of a job created by v1.6.x, which stored each digest as text and
+        each hostname in every record, to raw digests and a table of hosts.  Record ids are kept,
+        so the digest index stays valid.  The conversion is one transaction, so an interrupted
+        conversion is started over by the next open.
+
+        Args:
+            columns (Set[str]): Columns of the records table
+        """
+        self.__log.info(f'Upgrading the records of {self.__db_path}')
+        connection = self.__connection
+        connection.execute('BEGIN')
+        try:
+            for index in ['records_digest', 'records_host_path', 'records_size']:
+                connection.execute(f'DROP INDEX IF EXISTS {index}')
+            connection.execute('ALTER TABLE records RENAME TO records_v1')
+            for statement in _SCHEMA.split(';'):
+                if statement.strip():
+                    connection.execute(statement)
+            # Records from before algorithms were recorded are SHA-256
+            algorithm = 'algorithm' if 'algorithm' in columns else 'NULL'
+            cursor = connection.execute(
+                'SELECT id, digest, path, host, size, mtime_ns, inode, device, partial, '
+                f'{algorithm} FROM records_v1 ORDER BY id')
+            while batch := cursor.fetchmany(self.BUFFER_SIZE):
+                rows = []
+                for row_id, digest, path, host, *fields, partial, algorithm in batch:
+                    if host not in self.__host_ids:
+                        connection.execute('INSERT INTO hosts (name) VALUES (?)', (host,))
+                        self.__host_ids[host] = connection.execute(
+                            'SELECT id FROM hosts WHERE name = ?', (host,)).fetchone()[0]
+                    # Paths were stored as text before v1.6.x stored them as bytes
+                    rows.append((row_id,
+                                 _digest_value(digest),
+                                 os.fsencode(path) if isinstance(path, str) else path,
+                                 self.__host_ids[host],
+                                 *fields,
+                                 _digest_value(partial),
+                                 algorithm))
+                connection.executemany(
+                    'INSERT INTO records '
+                    '(id, digest, path, host_id, size, mtime_ns, inode, device, partial, '
+                    'algorithm) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            connection.execute('DROP TABLE records_v1')
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            self.__host_ids = {}
+            raise
+        # Returns the space of the converted records to the file system
+        connection.execute('VACUUM')
+
+    def __migrate(self):
+        # Imported into a temporary database that is only moved into place once complete, so an
+        # interrupted migration is started over by the next open
+        temp_path = self.__db_path.with_name(self.DB_NAME + '.migrating')
+        for path in [temp_path,
+                     temp_path.with_name(temp_path.name + '-wal'),
+                     temp_path.with_name(temp_path.name + '-shm')]:
+            if path.exists():
+                path.unlink()
+        self.__log.info(f'Migrating {self.__legacy_path} to {self.__db_path}')
+        self.__connect(temp_path)
+        try:
+            self.import_json(self.__legacy_path)
+            # Folds the write ahead log into the database file before it is moved
+            self.__connection.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            self.__connection.close()
+            self.__connection = None
+        os.replace(temp_path, self.__db_path)
 
     def __exit__(self, exc, exv, exp) -> None:
         self.close()
@@ -83,40 +350,183 @@ class JobCache:
     def close(self):
         """Closes the cache
         """
-        self.__hash_handle.close()
+        self.flush()
+        self.__connection.close()
+
+    def flush(self):
+        """Writes and commits any buffered records to disk
+        """
+        self.__write_pending()
+        self.__connection.commit()
+
+    def __write_pending(self):
+        # Buffered records must be visible to queries on this connection
+        if not self.__pending_rows:
+            return
+        rows = self.__pending_rows
+        self.__pending_rows = []
+        # A batch that fails to write is discarded whole, so later writes are not blocked by it
+        if not self.__connection.in_transaction:
+            # Releasing a savepoint outside a transaction would commit the batch
+            self.__connection.execute('BEGIN')
+        self.__connection.execute('SAVEPOINT pending_rows')
+        try:
+            self.__connection.executemany(
+                'INSERT INTO records '
+                '(digest, path, host_id, size, mtime_ns, inode, device, partial, algorithm) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        except Exception:
+            self.__connection.execute('ROLLBACK TO pending_rows')
+            self.__log.exception(f'Discarded {len(rows)} records that could not be written')
+            raise
+        finally:
+            self.__connection.execute('RELEASE pending_rows')
+
+    def __execute(self, sql: str, parameters: Iterable = ()) -> sqlite3.Cursor:
+        self.__write_pending()
+        return self.__connection.execute(sql, parameters)
+
+    def __host_id(self, host: str, *, create: bool = False) -> Optional[int]:
+        """Looks up the id that records of the host store instead of its name
+
+        Args:
+            host (str): Hostname
+            create (bool, optional): Add the host if it has no id. Defaults to False.
+
+        Returns:
+            Optional[int]: Host id, or None if the host has no id
+        """
+        if host in self.__host_ids:
+            return self.__host_ids[host]
+        if create:
+            self.__execute('INSERT OR IGNORE INTO hosts (name) VALUES (?)', (host,))
+        row = self.__execute('SELECT id FROM hosts WHERE name = ?', (host,)).fetchone()
+        if row is None:
+            return None
+        self.__host_ids[host] = row[0]
+        return row[0]
+
+    @property
+    def algorithm(self) -> Optional[str]:
+        """Hash algorithm of the records in the job, or None if the job has no records
+        """
+        row = self.__execute("SELECT value FROM metadata WHERE key = 'algorithm'").fetchone()
+        if row is not None:
+            return row[0]
+        if self.__execute('SELECT 1 FROM records LIMIT 1').fetchone() is not None:
+            # Jobs from before algorithms were recorded are SHA-256
+            return DEFAULT_ALGORITHM
+        return None
+
+    def use_algorithm(self, algorithm: Optional[str]) -> str:
+        """Sets the hash algorithm recorded with records added to the job.  Digests from
+        different algorithms never match, so a job cannot mix algorithms.
+
+        Args:
+            algorithm (Optional[str]): Hash algorithm, or None to use the job's algorithm, or
+            DEFAULT_ALGORITHM for a new job
+
+        Raises:
+            ValueError: The job already has records from a different algorithm
+
+        Returns:
+            str: Hash algorithm
+        """
+        job_algorithm = self.algorithm
+        if algorithm is None:
+            algorithm = job_algorithm or DEFAULT_ALGORITHM
+        if job_algorithm is not None and job_algorithm != algorithm:
+            raise ValueError(f'Job uses {job_algorithm}, not {algorithm}.  Clear the cache to '
+                             'change algorithms.')
+        self.__execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('algorithm', ?)",
+                       (algorithm,))
+        self.__algorithm = algorithm
+        return algorithm
+
+    @property
+    def n_records(self) -> int:
+        """Number of records in the cache
+        """
+        return self.__execute('SELECT COUNT(*) FROM records').fetchone()[0]
 
     def __contains__(self, digest: str) -> bool:
-        return digest in self.__hash_cache
+        cursor = self.__execute(
+            'SELECT 1 FROM records WHERE digest = ? LIMIT 1', (_digest_value(digest),))
+        return cursor.fetchone() is not None
 
     def __getitem__(self, digest: str) -> Set[Tuple[Path, str]]:
-        paths: Set[Path] = set()
-        for offset in self.__hash_cache[digest]:
-            paths.add(self.__extract_path_hostname(offset))
-        self.__hash_handle.seek(0)
+        cursor = self.__execute(
+            'SELECT records.path, hosts.name FROM records '
+            'JOIN hosts ON hosts.id = records.host_id WHERE records.digest = ?',
+            (_digest_value(digest),))
+        paths = {(_value_path(path), host) for path, host in cursor}
+        if not paths:
+            raise KeyError(digest)
         return paths
 
-    def add(self, path: Path, digest: str):
+    def add(self,
+            path: Path,
+            digest: Optional[str],
+            file_stat: Optional[FileStat] = None,
+            partial: Optional[str] = None):
         """Adds the path and digest to the job cache
 
         Args:
             path (Path): Path of file
-            digest (str): File digest
-        """
-        self.__hash_handle.seek(0, os.SEEK_END)
-        line_start = self.__hash_handle.tell()
-        document = json.dumps({
-            'digest': digest,
-            'path': path.as_posix(),
-            'host': self.__current_hostname
-        })
-        self.__hash_handle.write(document + '\n')
-        self.__hash_handle.seek(0)
-        if digest in self.__hash_cache:
-            self.__hash_cache[digest].append(line_start)
-        else:
-            self.__hash_cache[digest] = [line_start]
-        self.__n_lines += 1
-        self.__sorted = False
+            digest (Optional[str]): File digest, or None if the file was not hashed
+            file_stat (Optional[FileStat], optional): Stat fingerprint of the file at the time it
+            was hashed. Defaults to None.
+            partial (Optional[str], optional): Partial digest of the file. Defaults to None.
+        """
+        self.add_many([(path, digest, file_stat, partial)])
+
+    def add_many(self,
+                 entries: Iterable[Tuple[Path, Optional[str], Optional[FileStat], Optional[str]]]):
+        """Adds the paths and digests to the job cache.  Records are buffered in memory and
+        written in blocks of BUFFER_SIZE records, or when the cache is flushed or closed.
+
+        Args:
+            entries (Iterable[Tuple[Path, Optional[str], Optional[FileStat], Optional[str]]]):
+            Path, digest, stat fingerprint and partial digest of each file, as in add
+        """
+        no_stat = FileStat(None, None, None, None)
+        host_id = self.__host_id(self.__current_hostname, create=True)
+        self.__queue_rows((_digest_value(digest),
+                           _path_value(path),
+                           host_id,
+                           (file_stat or no_stat).size,
+                           (file_stat or no_stat).mtime_ns,
+                           _to_int64((file_stat or no_stat).inode),
+                           _to_int64((file_stat or no_stat).device),
+                           _digest_value(partial),
+                           self.__algorithm)
+                          for path, digest, file_stat, partial in entries)
+
+    def __queue_rows(self, rows: Iterable[Tuple], *, commit: bool = True):
+        self.__pending_rows.extend(rows)
+        if len(self.__pending_rows) >= self.BUFFER_SIZE:
+            if commit:
+                self.flush()
+            else:
+                self.__write_pending()
+
+    @contextmanager
+    def __atomic(self) -> Iterator[None]:
+        """Commits the records queued with commit=False in the block together, or none of them if
+        the block raises
+        """
+        self.flush()
+        algorithm = self.__algorithm
+        try:
+            yield
+            self.flush()
+        except BaseException:
+            self.__pending_rows = []
+            self.__connection.rollback()
+            self.__algorithm = algorithm
+            # Hosts added in the block were rolled back too
+            self.__host_ids = {}
+            raise
 
     def get_duplicates(self) -> Dict[str, Set[Tuple[Path, str]]]:
         """Generates the mapping of duplicates
@@ -124,58 +534,347 @@ class JobCache:
         Returns:
             Dict[str, Set[Path]]: duplicates mapping
         """
-        result: Dict[str, Set[Path]] = {}
-        if not self.__sorted:
-            self.__hash_handle.close()
-            sort_file(self.__hash_path, self.__hash_path)
-            # pylint: disable=consider-using-with
-            self.__hash_handle = open(
-                self.__hash_path, 'a+', encoding='utf-8', newline='\n')
-            # resource needs to exist beyond the scope of this function
-            self.__hash_handle.seek(0)
-            self.__rebuild_cache()
-            self.__sorted = True
-        if not self.__n_lines:
-            self.__hash_handle.seek(0)
-            self.__n_lines = sum(1 for _ in self.__hash_handle)
-            self.__hash_handle.seek(0)
-        self.__log.info(
-            f'Cache has {self.__n_lines} lines, {len(self.__hash_cache)} cache entries')
-        n_offsets = 0
-        for digest, offsets in tqdm(self.__hash_cache.items(),
-                                    dynamic_ncols=True,
-                                    desc='Discovering Duplicates'):
-            if len(offsets) == 1:
-                n_offsets += 1
-                continue
-            file_set = set()
-            for offset in offsets:
-                path_hostname_pair = self.__extract_path_hostname(offset)
-                file_set.add(path_hostname_pair)
-                n_offsets += 1
-            result[digest] = file_set
-        self.__log.debug(f'{n_offsets} offsets discovered')
+        return dict(self.iter_duplicates())
+
+    def iter_duplicates(self) -> Iterator[Tuple[str, Set[Tuple[Path, str]]]]:
+        """Lazily generates the duplicated digests and their files, most duplicated first.  Only
+        the digests are grouped up front, and the groups' files are then read from the digest
+        index in batches, so the first group is available without loading every duplicated
+        record.
+
+        Yields:
+            Iterator[Tuple[str, Set[Tuple[Path, str]]]]: Digest and the path and hostname of each
+            file with that digest
+        """
+        self.__log.info(f'Cache has {self.n_records} records')
+        # Files recorded more than once, such as by analyzing a directory again, count once
+        groups = self.__execute(
+            'SELECT digest, COUNT(*) AS n_files FROM ('
+            'SELECT DISTINCT digest, host_id, path FROM records WHERE digest IS NOT NULL) '
+            'GROUP BY digest HAVING n_files > 1 ORDER BY n_files DESC, digest')
+        with tqdm(dynamic_ncols=True, desc='Discovering Duplicates') as progress:
+            while batch := [_value_digest(digest)
+                            for digest, _ in groups.fetchmany(self.LOOKUP_BATCH_SIZE)]:
+                files = self.get_many(batch)
+                for digest in batch:
+                    yield digest, files[digest]
+                progress.update(len(batch))
+
+    def get_many(self, digests: Iterable[str]) -> Dict[str, Set[Tuple[Path, str]]]:
+        """Retrieves the files with each of the specified digests, in batches of
+        LOOKUP_BATCH_SIZE digests per query
+
+        Args:
+            digests (Iterable[str]): Digests to look up
 
+        Returns:
+            Dict[str, Set[Tuple[Path, str]]]: Path and hostname of the files with each digest.
+            Digests without any records are omitted.
+        """
+        result: Dict[str, Set[Tuple[Path, str]]] = {}
+        digests = list(dict.fromkeys(digests))
+        for start in range(0, len(digests), self.LOOKUP_BATCH_SIZE):
+            batch = digests[start:start + self.LOOKUP_BATCH_SIZE]
+            cursor = self.__execute(
+                'SELECT records.digest, records.path, hosts.name FROM records '
+                'JOIN hosts ON hosts.id = records.host_id '
+                f'WHERE records.digest IN ({", ".join("?" * len(batch))})',
+                [_digest_value(digest) for digest in batch])
+            for digest, path, host in cursor:
+                result.setdefault(_value_digest(digest), set()).add((_value_path(path), host))
         return result
 
-    def __extract_path_hostname(self, offset: int) -> Tuple[Path, str]:
-        self.__hash_handle.seek(offset)
-        line = self.__hash_handle.readline().strip()
-        document: Dict = json.loads(line)
-        return Path(document['path']), document['host']
+    def get_digest_index(self) -> DigestIndex:
+        """Loads the compact index of every digest in the job.  The index is memory mapped from
+        its sidecar file, and records added since the sidecar was saved are replayed into memory.
+        The sidecar is rebuilt if it is missing or invalid, and resaved once the replayed records
+        exceed 1 / INDEX_COMPACT_RATIO of the index.  A sidecar saved before records were removed
+        from the job is from an older generation of the job, and is rebuilt.
+
+        Returns:
+            DigestIndex: Digest index
+        """
+        # The sidecar must only cover committed records
+        self.flush()
+        max_row_id = self.__execute('SELECT COALESCE(MAX(id), 0) FROM records').fetchone()[0]
+        generation = self.__generation
+        try:
+            index, indexed_row_id, indexed_generation = DigestIndex.load(self.__index_path)
+        except FileNotFoundError:
+            index, indexed_row_id, indexed_generation = None, None, None
+        except ValueError:
+            self.__log.exception('Discarding digest index')
+            index, indexed_row_id, indexed_generation = None, None, None
+        if index is not None and (indexed_generation != generation
+                                  or indexed_row_id > max_row_id):
+            index.close()
+            index = None
+        if index is None:
+            cursor = self.__execute(
+                'SELECT digest, id FROM records WHERE digest IS NOT NULL ORDER BY digest')
+            index = DigestIndex.build(tqdm(((_value_digest(digest), row_id)
+                                            for digest, row_id in cursor),
+                                           dynamic_ncols=True,
+                                           desc='Indexing Digests'))
+            self.__save_index(index, max_row_id, generation)
+            return index
+        if indexed_row_id == max_row_id:
+            return index
+        n_appended = index.append((_value_digest(digest), row_id)
+                                  for digest, row_id in self.__execute(
+                                      'SELECT digest, id FROM records '
+                                      'WHERE id > ? AND digest IS NOT NULL',
+                                      (indexed_row_id,)))
+        self.__log.info(f'Replayed {n_appended} records into digest index')
+        if n_appended * self.INDEX_COMPACT_RATIO > len(index):
+            self.__save_index(index, max_row_id, generation)
+        return index
+
+    def discard_digest_index(self):
+        """Discards the digest index, such as after it was found to list digests that are not in
+        the job, so it is rebuilt by the next get_digest_index
+        """
+        self.__invalidate_index()
+        self.flush()
+
+    def __save_index(self, index: DigestIndex, max_row_id: int, generation: int):
+        try:
+            index.save(self.__index_path, max_row_id, generation)
+        except OSError:
+            self.__log.exception('Unable to save digest index')
+
+    @property
+    def __generation(self) -> int:
+        row = self.__execute("SELECT value FROM metadata WHERE key = 'generation'").fetchone()
+        return int(row[0]) if row is not None else 0
+
+    def __invalidate_index(self):
+        """Starts a new generation of the job, in the transaction that removes records.  Deleted
+        record ids can be reused, so only additions can be replayed into an index, and an index
+        from an older generation is rebuilt even if its sidecar could not be removed.
+        """
+        self.__execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('generation', ?)",
+                       (str(self.__generation + 1),))
+        try:
+            self.__index_path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError:
+            self.__log.exception('Unable to remove digest index')
+
+    def save_checkpoint(self, root: Path, checkpoint: Checkpoint):
+        """Commits any buffered records, and records the progress of an analysis of root on this
+        host.  Committed records survive a crash of the process.
+
+        Args:
+            root (Path): Directory being analyzed
+            checkpoint (Checkpoint): Analysis progress
+        """
+        self.__execute('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)',
+                       (self.__checkpoint_key(root), json.dumps(checkpoint._asdict())))
+        self.flush()
+
+    def get_checkpoint(self, root: Path) -> Optional[Checkpoint]:
+        """Retrieves the progress of an incomplete analysis of root on this host
+
+        Args:
+            root (Path): Directory being analyzed
+
+        Returns:
+            Optional[Checkpoint]: Analysis progress, or None if no analysis is incomplete
+        """
+        row = self.__execute('SELECT value FROM metadata WHERE key = ?',
+                             (self.__checkpoint_key(root),)).fetchone()
+        if row is None:
+            return None
+        return Checkpoint(**json.loads(row[0]))
+
+    def clear_checkpoint(self, root: Path):
+        """Marks the analysis of root on this host as complete
+
+        Args:
+            root (Path): Directory analyzed
+        """
+        self.__execute('DELETE FROM metadata WHERE key = ?', (self.__checkpoint_key(root),))
+        self.flush()
+
+    def __checkpoint_key(self, root: Path) -> str:
+        root_name = _path_value(root).decode('utf-8', 'backslashreplace')
+        return f'checkpoint:{self.__current_hostname}:{root_name}'
+
+    def get_stat(self, path: Path) -> Optional[FileStat]:
+        """Retrieves the stat fingerprint recorded for a path on this host
+
+        Args:
+            path (Path): Path of file
+
+        Returns:
+            Optional[FileStat]: Recorded fingerprint, or None if the path has no record or the
+            record predates fingerprinting
+        """
+        row = self.__execute(
+            'SELECT size, mtime_ns, inode, device FROM records '
+            'WHERE host_id = ? AND path = ? ORDER BY id DESC LIMIT 1',
+            (self.__host_id(self.__current_hostname), _path_value(path))).fetchone()
+        if row is None or any(field is None for field in row):
+            return None
+        size, mtime_ns, inode, device = row
+        return FileStat(size=size,
+                        mtime_ns=mtime_ns,
+                        inode=_from_int64(inode),
+                        device=_from_int64(device))
+
+    def get_stats(self, paths: Iterable[Path]) -> Dict[Path, FileStat]:
+        """Retrieves the stat fingerprints recorded for paths on this host, in batches of
+        LOOKUP_BATCH_SIZE paths per query.  The records are read through a separate connection,
+        so the fingerprints can be looked up while another thread adds records.  Only committed
+        records are read.
+
+        Args:
+            paths (Iterable[Path]): Paths of files
+
+        Returns:
+            Dict[Path, FileStat]: Latest recorded fingerprint of each path.  Paths without a
+            record, or whose record predates fingerprinting, are omitted.
+        """
+        result: Dict[Path, Optional[FileStat]] = {}
+        paths = list(dict.fromkeys(paths))
+        if not paths:
+            return {}
+        reader = sqlite3.connect(f'{self.__db_path.resolve().as_uri()}?mode=ro', uri=True)
+        try:
+            for start in range(0, len(paths), self.LOOKUP_BATCH_SIZE):
+                batch = paths[start:start + self.LOOKUP_BATCH_SIZE]
+                cursor = reader.execute(
+                    'SELECT records.path, records.size, records.mtime_ns, records.inode, '
+                    'records.device FROM records JOIN hosts ON hosts.id = records.host_id '
+                    f'WHERE hosts.name = ? AND records.path IN ({", ".join("?" * len(batch))}) '
+                    'ORDER BY records.id',
+                    [self.__current_hostname, *(_path_value(path) for path in batch)])
+                # Later records of a path replace earlier ones
+                for path, *fields in cursor:
+                    if None in fields:
+                        result[_value_path(path)] = None
+                        continue
+                    size, mtime_ns, inode, device = fields
+                    result[_value_path(path)] = FileStat(size=size,
+                                                         mtime_ns=mtime_ns,
+                                                         inode=_from_int64(inode),
+                                                         device=_from_int64(device))
+        finally:
+            reader.close()
+        return {path: file_stat for path, file_stat in result.items() if file_stat is not None}
+
+    def has_size(self, size: int, exclude: Collection[Path] = ()) -> bool:
+        """Checks if any record has the specified file size
+
+        Args:
+            size (int): File size in bytes
+            exclude (Collection[Path], optional): Paths on this host whose records do not count,
+            such as earlier records of the files being matched. Defaults to ().
+
+        Returns:
+            bool: True if a record of that size exists
+        """
+        host_id = self.__host_id(self.__current_hostname)
+        cursor = self.__execute('SELECT host_id, path FROM records WHERE size = ?', (size,))
+        return any(record_host != host_id or _value_path(path) not in exclude
+                   for record_host, path in cursor)
+
+    @property
+    def has_unsized_digests(self) -> bool:
+        """Checks if any digested record predates size fingerprinting.  Such records could match a
+        file of any size.
+        """
+        cursor = self.__execute(
+            'SELECT 1 FROM records WHERE size IS NULL AND digest IS NOT NULL LIMIT 1')
+        return cursor.fetchone() is not None
+
+    def get_size_matches(self, sizes: Iterable[int]) -> List[CacheRecord]:
+        """Retrieves the records of the specified sizes
+
+        Args:
+            sizes (Iterable[int]): File sizes in bytes
+
+        Returns:
+            List[CacheRecord]: Matching records
+        """
+        records: List[CacheRecord] = []
+        for size in sizes:
+            cursor = self.__execute(
+                'SELECT records.path, hosts.name, records.digest, records.partial FROM records '
+                'JOIN hosts ON hosts.id = records.host_id WHERE records.size = ?', (size,))
+            for path, host, digest, partial in cursor:
+                records.append(CacheRecord(path=_value_path(path),
+                                           host=host,
+                                           digest=_value_digest(digest),
+                                           size=size,
+                                           partial=_value_digest(partial)))
+        return records
+
+    def get_undigested_sizes(self) -> Set[int]:
+        """Retrieves the sizes of the records that were recorded without a digest, such as by a
+        size filtered analysis
+
+        Returns:
+            Set[int]: File sizes in bytes
+        """
+        cursor = self.__execute(
+            'SELECT DISTINCT size FROM records WHERE digest IS NULL AND size IS NOT NULL')
+        return {size for size, in cursor}
+
+    def get_undigested_matches(self) -> List[CacheRecord]:
+        """Retrieves the records that were recorded without a digest, but whose size matches a
+        record of another file.  Records whose partial digests both differ do not match.
+
+        Returns:
+            List[CacheRecord]: Matching records without a digest
+        """
+        cursor = self.__execute(
+            'SELECT DISTINCT undigested.path, hosts.name, undigested.size, '
+            'undigested.partial FROM records AS undigested '
+            'JOIN hosts ON hosts.id = undigested.host_id '
+            'JOIN records AS other ON other.size = undigested.size '
+            'AND (other.host_id != undigested.host_id OR other.path != undigested.path) '
+            'AND (other.partial IS NULL OR undigested.partial IS NULL '
+            'OR other.partial = undigested.partial) '
+            'WHERE undigested.digest IS NULL')
+        return [CacheRecord(path=_value_path(path),
+                            host=host,
+                            digest=None,
+                            size=size,
+                            partial=_value_digest(partial))
+                for path, host, size, partial in cursor]
+
+    def get_tree(self, directory: Path) -> Set[Path]:
+        """Retrieves the paths recorded for this host under the specified directory
+
+        Args:
+            directory (Path): Directory to search
+
+        Returns:
+            Set[Path]: Recorded paths
+        """
+        lower, upper = self.__tree_bounds(directory)
+        cursor = self.__execute(
+            'SELECT path FROM records WHERE host_id = ? AND path >= ? AND path < ?',
+            (self.__host_id(self.__current_hostname), lower, upper))
+        return {_value_path(path) for path, in cursor}
+
+    @staticmethod
+    def __tree_bounds(directory: Path) -> Tuple[bytes, bytes]:
+        # Every path under the directory sorts between "directory/" and "directory0"
+        prefix = os.fsencode(directory.as_posix().rstrip('/') + '/')
+        return prefix, prefix[:-1] + b'0'
 
     def clear(self) -> None:
         """Clears the job cache
         """
-        self.__hash_handle.close()
-        self.__hash_path.unlink()
-        # pylint: disable=consider-using-with
-        self.__hash_handle = open(
-            self.__hash_path, 'a+', encoding='utf-8', newline='\n')
-        # resource needs to exist beyond the scope of this function
-        self.__hash_handle.seek(0)
-        self.__hash_cache.clear()
-        self.__n_lines = 0
+        self.__execute('DELETE FROM records')
+        self.__execute("DELETE FROM metadata WHERE key = 'algorithm' OR key LIKE 'checkpoint:%'")
+        self.__algorithm = None
+        self.__invalidate_index()
+        self.flush()
 
     def drop_tree(self, host: str, directory: Path):
         """Drops any paths that match the specified host/directory
@@ -184,41 +883,202 @@ class JobCache:
             host (str): Host to drop from
             directory (Path): Path to drop from
         """
-        # pylint: disable=consider-using-with
-        # resource needs to exist beyond the scope of this function
-        # Need to modify the CSV
-        with TemporaryDirectory() as tmpdir:
-            temp_dir = Path(tmpdir).resolve()
-            self.__hash_handle.seek(0)
-            with open(file=temp_dir.joinpath('hashes.csv'),
-                      mode='w',
-                      encoding='utf-8',
-                      newline='\n') as handle:
-                shutil.copyfileobj(self.__hash_handle, handle)
-            with open(file=temp_dir.joinpath('hashes.csv'),
-                      mode='r',
-                      encoding='utf-8',
-                      newline='\n') as handle:
-                self.__hash_handle.close()
-                self.__hash_handle = open(
-                    self.__hash_path, 'w', encoding='utf-8', newline='\n')
-                for line in tqdm(handle,
-                                 total=self.__n_lines,
-                                 desc='Dropping Tree',
+        lower, upper = self.__tree_bounds(directory)
+        cursor = self.__execute(
+            'DELETE FROM records WHERE host_id = ? AND path >= ? AND path < ?',
+            (self.__host_id(host), lower, upper))
+        self.__log.info(f'Dropped {cursor.rowcount} records')
+        if cursor.rowcount:
+            self.__invalidate_index()
+        self.flush()
+
+    def drop_paths(self, host: str, paths: Iterable[Path]):
+        """Drops any records of the specified paths on the specified host
+
+        Args:
+            host (str): Host to drop from
+            paths (Iterable[Path]): Paths to drop
+        """
+        host_id = self.__host_id(host)
+        self.__write_pending()
+        cursor = self.__connection.executemany(
+            'DELETE FROM records WHERE host_id = ? AND path = ?',
+            ((host_id, _path_value(path)) for path in paths))
+        if cursor.rowcount:
+            self.__invalidate_index()
+        self.flush()
+
+    def import_json(self, json_path: Path):
+        """Imports the records of a JSON lines hash file, as written by v1.3.0 through v1.5.x and
+        by export_json, or of a compact record file written by export_compact.  The records are
+        committed together, so a file that fails to import leaves the job unchanged.
+
+        Args:
+            json_path (Path): JSON lines hash file or compact record file
+
+        Raises:
+            ValueError: Records from a different algorithm than the job
+        """
+        with self.__atomic():
+            rows: List[Tuple] = []
+            for document in tqdm(_read_documents(json_path),
+                                 desc='Importing records',
                                  dynamic_ncols=True):
-                    if line.strip() == '':
-                        continue
-                    document = json.loads(line)
-                    line_host = document['host']
-                    line_path = Path(document['path'])
-                    if line_host != host:
-                        self.__hash_handle.write(line)
-                        continue
-                    if directory not in line_path.parents:
-                        self.__hash_handle.write(line)
-                        continue
-        self.__hash_handle.close()
-        self.__hash_handle = open(
-            self.__hash_path, 'a+', encoding='utf-8', newline='\n')
-        self.__hash_handle.seek(0)
-        self.__rebuild_cache()
+                rows.append(self.__document_row(document))
+                if len(rows) >= self.BUFFER_SIZE:
+                    self.__queue_rows(rows, commit=False)
+                    rows = []
+            self.__queue_rows(rows, commit=False)
+
+    def merge_json(self, json_paths: Sequence[Path]) -> int:
+        """Merges JSON lines hash files into the job with a streaming k-way merge.  Records
+        identical in host, path and digest to a record in the job or in another file are only
+        added once.  Shards written by export_shard and compact record files are merged
+        directly, and any other file is sorted first.  The records are committed together, so a
+        merge that fails leaves the job unchanged.
+
+        Args:
+            json_paths (Sequence[Path]): JSON lines hash files or compact record files
+
+        Raises:
+            ValueError: Records from a different algorithm than the job
+
+        Returns:
+            int: Number of records added
+        """
+        self.flush()
+        # A separate connection streams the job's records while the merged records are added
+        reader = sqlite3.connect(f'{self.__db_path.resolve().as_uri()}?mode=ro', uri=True)
+        try:
+            with TemporaryDirectory() as tmpdir:
+                records = (((host, path, _value_digest(digest) or ''), None)
+                           for digest, path, host, *_ in _iter_sorted(reader))
+                shards = [_read_shard(self.__sorted_shard(json_path,
+                                                          Path(tmpdir, f'shard_{idx}')))
+                          for idx, json_path in enumerate(json_paths)]
+                return self.__merge_shards(heap_merge(records, *shards, key=itemgetter(0)))
+        finally:
+            reader.close()
+
+    def __sorted_shard(self, json_path: Path, sorted_path: Path) -> Path:
+        if is_record_file(json_path):
+            # Record files are always sorted
+            return json_path
+        with open(json_path, 'r', encoding='utf-8') as handle:
+            prev_key = None
+            for line in handle:
+                if line.strip() == '':
+                    continue
+                key = _shard_sort_key(line)
+                if prev_key is not None and key < prev_key:
+                    break
+                prev_key = key
+            else:
+                return json_path
+        self.__log.info(f'Sorting {json_path}')
+        sort_file(json_path, sorted_path, key=_shard_sort_key)
+        return sorted_path
+
+    def __merge_shards(self, records: Iterable[Tuple[Tuple[str, bytes, str], Optional[Dict]]]
+                       ) -> int:
+        # Equal keys are adjacent, and the job's own records come first
+        n_added = 0
+        prev_key = None
+        with self.__atomic():
+            rows: List[Tuple] = []
+            for key, document in tqdm(records, desc='Merging records', dynamic_ncols=True):
+                if key == prev_key:
+                    continue
+                prev_key = key
+                if document is None:
+                    continue
+                rows.append(self.__document_row(document))
+                n_added += 1
+                if len(rows) >= self.BUFFER_SIZE:
+                    self.__queue_rows(rows, commit=False)
+                    rows = []
+            self.__queue_rows(rows, commit=False)
+        self.__log.info(f'Merged {n_added} records')
+        return n_added
+
+    def __document_row(self, document: Dict) -> Tuple:
+        algorithm = document.get('algorithm', DEFAULT_ALGORITHM)
+        if algorithm != self.__algorithm:
+            self.use_algorithm(algorithm)
+        return (_digest_value(document['digest']),
+                os.fsencode(document['path']),
+                self.__host_id(document['host'], create=True),
+                document.get('size', None),
+                document.get('mtime_ns', None),
+                _to_int64(document.get('inode', None)),
+                _to_int64(document.get('device', None)),
+                _digest_value(document.get('partial', None)),
+                algorithm)
+
+    def export_json(self, json_path: Path):
+        """Exports the records as a JSON lines hash file
+
+        Args:
+            json_path (Path): Destination file
+        """
+        cursor = self.__execute(
+            'SELECT records.digest, records.path, hosts.name, records.size, records.mtime_ns, '
+            'records.inode, records.device, records.partial, records.algorithm FROM records '
+            'JOIN hosts ON hosts.id = records.host_id ORDER BY records.id')
+        self.__write_documents(cursor, json_path)
+
+    def export_shard(self, json_path: Path, host: Optional[str] = None):
+        """Exports the records of a single host as a JSON lines hash file sorted for merge_json
+
+        Args:
+            json_path (Path): Destination file
+            host (Optional[str], optional): Host to export. Defaults to this host.
+        """
+        self.__write_pending()
+        self.__write_documents(_iter_sorted(self.__connection, host or self.__current_hostname),
+                               json_path)
+
+    def export_compact(self,
+                       path: Path,
+                       host: Optional[str] = None,
+                       compression: str = 'zlib') -> int:
+        """Exports the records as a compact record file, sorted for merge_json
+
+        Args:
+            path (Path): Destination file
+            host (Optional[str], optional): Host to export. Defaults to all hosts.
+            compression (str, optional): Block compression, one of record_file.COMPRESSORS.
+            Defaults to 'zlib'.
+
+        Returns:
+            int: Number of records exported
+        """
+        self.__write_pending()
+        return write_records(path,
+                             self.__documents(_iter_sorted(self.__connection, host)),
+                             compression=compression)
+
+    def __write_documents(self, rows: Iterable[Tuple], json_path: Path):
+        with open(json_path, 'w', encoding='utf-8', newline='\n') as handle:
+            for document in self.__documents(rows):
+                handle.write(json.dumps(document) + '\n')
+
+    def __documents(self, rows: Iterable[Tuple]) -> Iterator[Dict]:
+        job_algorithm = self.algorithm
+        for digest, path, host, size, mtime_ns, inode, device, partial, algorithm in rows:
+            document = {
+                'digest': _value_digest(digest),
+                'path': os.fsdecode(path),
+                'host': host
+            }
+            if size is not None:
+                document.update({
+                    'size': size,
+                    'mtime_ns': mtime_ns,
+                    'inode': _from_int64(inode),
+                    'device': _from_int64(device)
+                })
+            if partial is not None:
+                document['partial'] = _value_digest(partial)
+            document['algorithm'] = algorithm or job_algorithm
+            yield document
@@ -1,69 +1,171 @@
 '''Parallel Hasher
 '''
+import inspect
 import re
-from multiprocessing import Condition, Event, Lock, cpu_count
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from itertools import chain, islice
+from multiprocessing import cpu_count, get_context
 from pathlib import Path
 from queue import Empty, Queue
-from threading import Thread
-from typing import Callable, Iterable
+from threading import Condition, Lock, Thread
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
 import logging
 from tqdm import tqdm
 
-from e4e_deduplication.hasher import compute_sha256
+from e4e_deduplication.hasher import PREFETCH_SIZE, compute_sha256, prefetch
 
+BACKENDS = ('threads', 'processes', 'auto', 'pipeline')
+_SENTINEL = None
 
-def _hasher(condition: Condition,
-            job_queue: Queue,
-            terminate: Event,
+
+class _ByteBudget:
+    """Limits the number of bytes held at once by several threads
+    """
+
+    def __init__(self, n_bytes: int):
+        self.__n_bytes = n_bytes
+        self.__n_used = 0
+        self.__condition = Condition()
+
+    def acquire(self, n_bytes: int) -> None:
+        """Waits until n_bytes more bytes fit in the budget, and reserves them
+
+        Args:
+            n_bytes (int): Number of bytes, at most the budget
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__n_used + n_bytes <= self.__n_bytes)
+            self.__n_used += n_bytes
+
+    def release(self, n_bytes: int) -> None:
+        """Returns reserved bytes to the budget
+
+        Args:
+            n_bytes (int): Number of bytes
+        """
+        with self.__condition:
+            self.__n_used -= n_bytes
+            self.__condition.notify_all()
+
+
+def _prefetcher(job_queue: Queue, ready_queue: Queue, keep_open: bool, budget: _ByteBudget
+                ) -> None:
+    while (job := job_queue.get()) is not _SENTINEL:
+        # Files small enough are read whole, and their contents held until they are hashed
+        n_reserved = 0
+        if keep_open and job[1] is not None and job[1] <= PREFETCH_SIZE:
+            n_reserved = job[1]
+            budget.acquire(n_reserved)
+        prefetched = prefetch(job[0], keep_open=keep_open, max_data=n_reserved)
+        n_held = len(prefetched.data) if prefetched and prefetched.data is not None else 0
+        budget.release(n_reserved - n_held)
+        ready_queue.put(job if prefetched is None else (*job, prefetched))
+
+
+def _accepts_prefetched(hash_fn: Callable[[Path], str]) -> bool:
+    try:
+        return 'prefetched' in inspect.signature(hash_fn).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _hasher(job_queue: Queue,
             result_queue: Queue,
-            result_condition: Condition,
             hash_fn: Callable[[Path], str],
-            error_queue: Queue) -> None:
-    # pylint: disable=too-many-arguments
-    # This is a general hasher
+            budget: Optional[_ByteBudget] = None) -> None:
     logger = logging.getLogger('Hasher')
-    while True:
-        with condition:
-            if job_queue.empty() and not terminate.is_set():
-                condition.wait(timeout=1)
-            if terminate.is_set() and job_queue.empty():
-                return
+    while (job := job_queue.get()) is not _SENTINEL:
+        path, size = job[:2]
         try:
-            job: Path = job_queue.get(block=False)
-        except Empty:
+            if len(job) > 2:
+                # Opened and read by a prefetcher, and closed by the hash function
+                digest = hash_fn(path, prefetched=job[2])
+            else:
+                digest = hash_fn(path)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Hash Function emitted exception')
             continue
+        finally:
+            if len(job) > 2 and job[2].data is not None:
+                budget.release(len(job[2].data))
+        result_queue.put((path, digest, size))
+
+
+def _hash_batch(jobs: List[Tuple[Path, Optional[int]]],
+                hash_fn: Callable[[Path], str]) -> List[Tuple[Path, str, Optional[int]]]:
+    # Runs in a worker process, so hash_fn must be picklable
+    logger = logging.getLogger('Hasher')
+    results: List[Tuple[Path, str, Optional[int]]] = []
+    for path, size in jobs:
         try:
-            digest = hash_fn(job)
+            results.append((path, hash_fn(path), size))
         except Exception:  # pylint: disable=broad-except
             logger.exception('Hash Function emitted exception')
-            error_queue.put(job)
-            continue
-        result_queue.put((job, digest))
-        with result_condition:
-            result_condition.notify()
+    return results
 
 
 class ParallelHasher:
     """Parallel Hashing Class
     """
-    # pylint: disable=too-few-public-methods
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
     # This is meant to be a single method class
+    PROCESS_CHUNK_SIZE = 64
+    QUEUE_SIZE = 1024
+    AUTO_MIN_FILES = 4096
+    AUTO_MAX_MEAN_SIZE = 256*1024
+    PIPELINE_IN_FLIGHT = 64
+    PIPELINE_BUFFER_SIZE = 64*1024*1024
 
     def __init__(self,
-                 process_fn: Callable[[Path, str], None],
+                 process_fn: Optional[Callable[[Path, str], None]],
                  ignore_pattern: re.Pattern,
                  *,
                  hash_fn: Callable[[Path], str] = compute_sha256,
-                 n_bytes: int = None):
+                 n_bytes: int = None,
+                 batch_fn: Optional[Callable[[List[Tuple[Path, str]]], None]] = None,
+                 batch_size: int = 1024,
+                 backend: str = 'threads',
+                 n_hash_workers: Optional[int] = None,
+                 n_in_flight: Optional[int] = None):
         """Initializes the Parallel Hashing Class
 
         Args:
-            process_fn (Callable[[Path, str], None]): Processing Function to retrieve the results
+            process_fn (Optional[Callable[[Path, str], None]]): Processing Function to retrieve
+            the results
             ignore_pattern (re.Pattern): Regex pattern to use for ignore
+            batch_fn (Optional[Callable[[List[Tuple[Path, str]]], None]], optional): Processing
+            Function to retrieve the results in batches of up to batch_size results.  Called with
+            any remaining results once hashing completes.  Defaults to None.
+            batch_size (int, optional): Maximum number of results per batch. Defaults to 1024.
+            backend (str, optional): Hashing backend, one of BACKENDS.  'threads' hashes in
+            n_hash_workers threads, 'processes' hashes chunks of PROCESS_CHUNK_SIZE paths in a
+            process pool, and 'auto' uses processes for at least AUTO_MIN_FILES files averaging at
+            most AUTO_MAX_MEAN_SIZE bytes.  When the files are streamed, 'auto' decides from the
+            first AUTO_MIN_FILES files discovered.  hash_fn must be picklable to use processes.
+            'pipeline' opens and prefetches n_in_flight files at once in I/O threads ahead of the
+            hashing threads, to hide the latency of network filesystems.  Hash functions with a
+            prefetched argument, such as compute_digest, hash the prefetched file without opening
+            it again.  Prefetched files of at most PREFETCH_SIZE bytes are read whole, holding at
+            most PIPELINE_BUFFER_SIZE bytes of file contents at once.  Defaults to 'threads'.
+            n_hash_workers (Optional[int], optional): Number of hashing threads or processes,
+            independent of n_in_flight.  Defaults to the number of CPUs.
+            n_in_flight (Optional[int], optional): Number of files opened and prefetched at once
+            by the pipeline backend.  Defaults to PIPELINE_IN_FLIGHT.
         """
+        # pylint: disable=too-many-arguments
+        # Hasher configuration
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {backend}')
         self._process_fn = process_fn
+        self._batch_fn = batch_fn
+        self._batch_size = batch_size
+        self._batch: List[Tuple[Path, str]] = []
+        self._backend = backend
+        self._n_hash_workers = n_hash_workers or cpu_count()
+        self._n_in_flight = n_in_flight or self.PIPELINE_IN_FLIGHT
         self._ignore_pattern = ignore_pattern
         self._pb = None
+        self._pb_bytes = False
         self._pb_lock = Lock()
         self._hash_fn = hash_fn
         self._n_bytes = n_bytes
@@ -76,40 +178,87 @@ class ParallelHasher:
             paths (Iterable[Path]): Iterable of paths to hash
             n_iter (int): Number of iterations expected
         """
-        n_files_discovered = 0
-        processor_terminate = Event()
-        result_condition = Condition()
-        job_terminate = Event()
-        job_condition = Condition()
-        job_queue = Queue()
-        result_queue = Queue()
-        error_queue = Queue()
         self._pb = tqdm(total=n_iter, dynamic_ncols=True,
                         desc='Computing Hashes')
-        if self._n_bytes:
+        self._pb_bytes = bool(self._n_bytes)
+        if self._pb_bytes:
             self._pb.total = self._n_bytes
             self._pb.unit = 'B'
             self._pb.unit_scale = 1
-        job_terminate.clear()
-        processor_terminate.clear()
-        accumulator = Thread(target=self._result_accumulator, kwargs={
-            'result_condition': result_condition,
-            'result_queue': result_queue,
-            'processor_terminate': processor_terminate
-        })
-        accumulator.start()
-        processes = [Thread(target=_hasher, kwargs={
-            'condition': job_condition,
-            'job_queue': job_queue,
-            'terminate': job_terminate,
-            'result_queue': result_queue,
-            'result_condition': result_condition,
-            'hash_fn': self._hash_fn,
-            'error_queue': error_queue
-        })
-            for _ in range(cpu_count())]
-        for process in processes:
-            process.start()
+        self._run(self._discover(paths), n_iter)
+
+    def run_files(self, files: Iterable[Tuple[Path, int]], n_files: Optional[int] = None):
+        """Runs the parallel hasher over files that have already been discovered and filtered, such
+        as from walk_files.  The files are hashed as they are discovered.  If n_bytes was not
+        specified, the progress total grows as files are discovered.
+
+        Args:
+            files (Iterable[Tuple[Path, int]]): Path and size in bytes of each file to hash
+            n_files (Optional[int], optional): Number of files expected, if known. Defaults to
+            None.
+        """
+        self._pb = tqdm(total=self._n_bytes or 0, dynamic_ncols=True,
+                        desc='Computing Hashes', unit='B', unit_scale=1)
+        self._pb_bytes = True
+        if not self._n_bytes:
+            files = self._count(files)
+        self._run(files, n_files)
+
+    def _run(self, jobs: Iterable[Tuple[Path, Optional[int]]], n_iter: Optional[int]):
+        self._batch = []
+        try:
+            backend, jobs = self._select_backend(jobs, n_iter)
+            if backend == 'processes':
+                n_files_discovered = self._run_processes(jobs)
+            elif backend == 'pipeline':
+                n_files_discovered = self._run_threads(jobs, n_prefetchers=self._n_in_flight)
+            else:
+                n_files_discovered = self._run_threads(jobs)
+            if self._batch_fn and self._batch:
+                self._batch_fn(self._batch)
+        except KeyboardInterrupt:
+            # Deliver the files hashed before the interrupt so they are not hashed again
+            if self._batch_fn and self._batch:
+                self._batch_fn(self._batch)
+            raise
+        finally:
+            self._batch = []
+            self._pb.close()
+        self.__log.info(f'Processed {n_files_discovered} real files')
+
+    def _select_backend(self,
+                        jobs: Iterable[Tuple[Path, Optional[int]]],
+                        n_iter: Optional[int]
+                        ) -> Tuple[str, Iterable[Tuple[Path, Optional[int]]]]:
+        if self._backend != 'auto':
+            return self._backend, jobs
+        if self._n_bytes and n_iter:
+            n_files = n_iter
+            n_bytes = self._n_bytes
+        else:
+            # Streamed files are held back until enough are discovered to decide
+            jobs = iter(jobs)
+            sample = list(islice(jobs, self.AUTO_MIN_FILES))
+            jobs = chain(sample, jobs)
+            n_files = len(sample)
+            if any(size is None for _, size in sample):
+                return 'threads', jobs
+            n_bytes = sum(size for _, size in sample)
+        if n_files < self.AUTO_MIN_FILES or n_bytes / n_files > self.AUTO_MAX_MEAN_SIZE:
+            backend = 'threads'
+        else:
+            backend = 'processes'
+        self.__log.info(f'Selected {backend} backend for {n_files} files averaging '
+                        f'{n_bytes / max(n_files, 1):.0f} bytes')
+        return backend, jobs
+
+    def _count(self, files: Iterable[Tuple[Path, int]]) -> Iterator[Tuple[Path, int]]:
+        for path, size in files:
+            with self._pb_lock:
+                self._pb.total += size
+            yield path, size
+
+    def _discover(self, paths: Iterable[Path]) -> Iterator[Tuple[Path, Optional[int]]]:
         for path in paths:
             if self._ignore_pattern and self._ignore_pattern.search(path.as_posix()):
                 with self._pb_lock:
@@ -126,41 +275,169 @@ class ParallelHasher:
             if self._n_bytes is None:
                 with self._pb_lock:
                     self._pb.update(n=0.5)
-            with job_condition:
-                job_queue.put(path)
-                job_condition.notify()
-            n_files_discovered += 1
-        job_terminate.set()
-        with job_condition:
-            job_condition.notify_all()
-        for process in processes:
-            process.join()
-        processor_terminate.set()
-
-        with result_condition:
-            result_condition.notify_all()
-        accumulator.join()
-        self._pb.close()
-        self.__log.info(f'Processed {n_files_discovered} real files')
+                yield path, None
+            else:
+                yield path, path.stat().st_size
 
-    def _result_accumulator(self,
-                            result_condition: Condition,
-                            result_queue: Queue,
-                            processor_terminate: Event) -> None:
+    def _run_threads(self,
+                     jobs: Iterable[Tuple[Path, Optional[int]]],
+                     n_prefetchers: int = 0) -> int:
+        n_files_discovered = 0
+        # Bounded queues block the walk while the hashers catch up
+        job_queue = Queue(maxsize=self.QUEUE_SIZE)
+        result_queue = Queue(maxsize=self.QUEUE_SIZE)
+        accumulator_errors: List[Exception] = []
+        accumulator = Thread(target=self._result_accumulator, kwargs={
+            'result_queue': result_queue,
+            'errors': accumulator_errors
+        })
+        accumulator.start()
+        budget = None
+        if n_prefetchers:
+            budget = _ByteBudget(max(self.PIPELINE_BUFFER_SIZE, PREFETCH_SIZE))
+            # Prefetched files wait for a hasher while their data is still cached
+            ready_queue = Queue(maxsize=n_prefetchers)
+            # Hash functions that accept the prefetched file hash it without opening it again
+            keep_open = _accepts_prefetched(self._hash_fn)
+            prefetchers = [Thread(target=_prefetcher, kwargs={
+                'job_queue': job_queue,
+                'ready_queue': ready_queue,
+                'keep_open': keep_open,
+                'budget': budget
+            })
+                for _ in range(n_prefetchers)]
+        else:
+            ready_queue = job_queue
+            prefetchers = []
+        for prefetcher in prefetchers:
+            prefetcher.start()
+        workers = self._start_hashers(ready_queue, result_queue, budget)
+        try:
+            for job in jobs:
+                if accumulator_errors:
+                    # Results can no longer be delivered, so stop discovering files
+                    break
+                job_queue.put(job)
+                n_files_discovered += 1
+        finally:
+            if accumulator_errors:
+                # Files already queued would only be hashed to be discarded
+                self._discard_jobs(job_queue)
+            for _ in prefetchers:
+                job_queue.put(_SENTINEL)
+            for prefetcher in prefetchers:
+                prefetcher.join()
+            self._stop_hashers(ready_queue, workers)
+            result_queue.put(_SENTINEL)
+            accumulator.join()
+        if accumulator_errors:
+            raise accumulator_errors[0]
+        return n_files_discovered
+
+    @staticmethod
+    def _discard_jobs(job_queue: Queue) -> None:
+        """Removes the jobs that no hasher or prefetcher has started
+
+        Args:
+            job_queue (Queue): Path and size of each file to hash
+        """
         while True:
-            with result_condition:
-                if result_queue.empty() and not processor_terminate.is_set():
-                    result_condition.wait(timeout=1)
-                if processor_terminate.is_set() and result_queue.empty():
-                    return
             try:
-                pair = result_queue.get()
+                job_queue.get_nowait()
             except Empty:
-                continue
-            path, digest = pair
-            with self._pb_lock:
-                if self._n_bytes is None:
-                    self._pb.update(n=0.5)
-                else:
-                    self._pb.update(n=path.stat().st_size)
+                return
+
+    def _start_hashers(self,
+                       job_queue: Queue,
+                       result_queue: Queue,
+                       budget: Optional[_ByteBudget] = None) -> List[Thread]:
+        """Starts hashing the jobs in job_queue until a sentinel is received for each hasher,
+        putting the path, digest and size of each file into result_queue
+
+        Args:
+            job_queue (Queue): Path and size of each file to hash
+            result_queue (Queue): Hash results
+            budget (Optional[_ByteBudget], optional): Budget of the prefetched file contents in
+            job_queue, released once each file is hashed. Defaults to None.
+
+        Returns:
+            List[Thread]: Hashing threads
+        """
+        workers = [Thread(target=_hasher, kwargs={
+            'job_queue': job_queue,
+            'result_queue': result_queue,
+            'hash_fn': self._hash_fn,
+            'budget': budget
+        })
+            for _ in range(self._n_hash_workers)]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def _stop_hashers(self, job_queue: Queue, workers: List[Thread]) -> None:
+        """Waits for the hashers to finish every job put into job_queue
+
+        Args:
+            job_queue (Queue): Path and size of each file to hash
+            workers (List[Thread]): Hashing threads from _start_hashers
+        """
+        for _ in workers:
+            job_queue.put(_SENTINEL)
+        for worker in workers:
+            worker.join()
+
+    def _run_processes(self, jobs: Iterable[Tuple[Path, Optional[int]]]) -> int:
+        n_files_discovered = 0
+        max_in_flight = 4 * self._n_hash_workers
+        chunk: List[Tuple[Path, Optional[int]]] = []
+        pending: Set[Future] = set()
+        # Forking a process that already runs the discovery and database threads can copy held
+        # locks into the children, so the workers are started fresh
+        with ProcessPoolExecutor(max_workers=self._n_hash_workers,
+                                 mp_context=get_context('spawn')) as executor:
+            for job in jobs:
+                chunk.append(job)
+                n_files_discovered += 1
+                if len(chunk) < self.PROCESS_CHUNK_SIZE:
+                    continue
+                pending.add(executor.submit(_hash_batch, chunk, self._hash_fn))
+                chunk = []
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self._deliver_futures(done)
+            if chunk:
+                pending.add(executor.submit(_hash_batch, chunk, self._hash_fn))
+            done, _ = wait(pending)
+            self._deliver_futures(done)
+        return n_files_discovered
+
+    def _deliver_futures(self, futures: Iterable[Future]) -> None:
+        for future in futures:
+            for path, digest, size in future.result():
+                self._deliver(path, digest, size)
+
+    def _deliver(self, path: Path, digest: str, size: Optional[int]) -> None:
+        with self._pb_lock:
+            if self._pb_bytes:
+                self._pb.update(n=size)
+            else:
+                self._pb.update(n=0.5)
+        if self._process_fn:
             self._process_fn(path, digest)
+        if self._batch_fn:
+            self._batch.append((path, digest))
+            if len(self._batch) >= self._batch_size:
+                self._batch_fn(self._batch)
+                self._batch = []
+
+    def _result_accumulator(self,
+                            result_queue: Queue,
+                            errors: List[Exception]) -> None:
+        while (result := result_queue.get()) is not _SENTINEL:
+            if errors:
+                # Keep draining so the hashers are not blocked on a full queue
+                continue
+            try:
+                self._deliver(*result)
+            except Exception as exc:  # pylint: disable=broad-except
+                errors.append(exc)
@@ -0,0 +1,324 @@
+'''Compact Record File
+
+Binary alternative to JSON lines hash files.  Records are sorted by host, path and digest and
+stored in independently compressed blocks of BLOCK_RECORDS records.  Hosts and algorithms are
+stored once in a string table, hex digests are stored as raw bytes, and each path only stores
+the suffix that differs from the previous path in its block.  A block index at the end of the
+file holds the first host and path of each block, so a path is found by decompressing a single
+block.
+
+Layout: header, blocks, zlib compressed JSON footer with the string table and block index, and a
+trailer with the offset and length of the footer.
+'''
+from __future__ import annotations
+
+import json
+import os
+import struct
+import zlib
+from bisect import bisect_left
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+BLOCK_RECORDS = 4096
+_MAGIC = b'E4ERECS1'
+_HEADER = struct.Struct('<8s16s')
+_TRAILER = struct.Struct('<QQ8s')
+_INT_FIELDS = ('size', 'mtime_ns', 'inode', 'device')
+_NONE, _HEX, _TEXT = range(3)
+
+# Block compressors and decompressors, keyed by name
+COMPRESSORS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+try:
+    import zstandard
+    COMPRESSORS['zstd'] = (zstandard.ZstdCompressor().compress,
+                           zstandard.ZstdDecompressor().decompress)
+except ImportError:
+    pass
+
+
+def _record_key(document: Dict) -> Tuple[str, bytes, str]:
+    # Paths are compared as bytes, like the job cache
+    return document['host'], os.fsencode(document['path']), document['digest'] or ''
+
+
+def _write_varint(buffer: bytearray, value: int):
+    # Zigzag encoded, so negative values stay short
+    value = -2 * value - 1 if value < 0 else 2 * value
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (value >> 1) ^ -(value & 1), offset
+
+
+def _write_text(buffer: bytearray, value: Optional[str]):
+    if value is None:
+        _write_varint(buffer, _NONE)
+        return
+    try:
+        raw = bytes.fromhex(value)
+        is_hex = raw.hex() == value
+    except ValueError:
+        is_hex = False
+    if not is_hex:
+        raw = value.encode('utf-8')
+    _write_varint(buffer, _HEX if is_hex else _TEXT)
+    _write_varint(buffer, len(raw))
+    buffer += raw
+
+
+def _read_text(data: bytes, offset: int) -> Tuple[Optional[str], int]:
+    kind, offset = _read_varint(data, offset)
+    if kind == _NONE:
+        return None, offset
+    length, offset = _read_varint(data, offset)
+    raw = data[offset:offset + length]
+    offset += length
+    return (raw.hex() if kind == _HEX else raw.decode('utf-8')), offset
+
+
+def _common_prefix(previous: bytes, current: bytes) -> int:
+    length = min(len(previous), len(current))
+    idx = 0
+    while idx < length and previous[idx] == current[idx]:
+        idx += 1
+    return idx
+
+
+def is_record_file(path: Path) -> bool:
+    """Checks whether the file is a compact record file
+
+    Args:
+        path (Path): File to check
+
+    Returns:
+        bool: True if the file starts with the record file header
+    """
+    with open(path, 'rb') as handle:
+        return handle.read(len(_MAGIC)) == _MAGIC
+
+
+def write_records(path: Path,
+                  documents: Iterable[Dict],
+                  *,
+                  compression: str = 'zlib',
+                  block_records: int = BLOCK_RECORDS) -> int:
+    """Writes records to a compact record file
+
+    Args:
+        path (Path): Destination file
+        documents (Iterable[Dict]): Records as written to JSON lines hash files, sorted by host,
+        path and digest, with records without a digest first
+        compression (str, optional): Block compression, one of COMPRESSORS. Defaults to 'zlib'.
+        block_records (int, optional): Records per block. Defaults to BLOCK_RECORDS.
+
+    Raises:
+        ValueError: Unknown compression, or records are not sorted
+
+    Returns:
+        int: Number of records written
+    """
+    # pylint: disable=too-many-locals,too-many-statements
+    # Single pass encoder
+    if compression not in COMPRESSORS:
+        raise ValueError(f'Unknown compression {compression}, available compressions are '
+                         f'{sorted(COMPRESSORS)}')
+    compress = COMPRESSORS[compression][0]
+    strings: Dict[str, int] = {}
+    blocks: List[Tuple[int, int, int, int, str]] = []
+    block = bytearray()
+    n_block = 0
+    n_records = 0
+    first: Tuple[int, str] = (0, '')
+    prev_key: Optional[Tuple[str, bytes, str]] = None
+    prev_path = b''
+    with open(path, 'wb') as handle:
+        handle.write(_HEADER.pack(_MAGIC, compression.encode()))
+
+        def write_block(records: bytearray, n_block: int, first: Tuple[int, str]):
+            data = compress(bytes(records))
+            blocks.append((handle.tell(), len(data), n_block, *first))
+            handle.write(data)
+
+        for document in documents:
+            key = _record_key(document)
+            if prev_key is not None and key < prev_key:
+                raise ValueError(f'Records are not sorted at {key}')
+            prev_key = key
+            host_id = strings.setdefault(document['host'], len(strings))
+            if n_block == 0:
+                first = (host_id, document['path'])
+                prev_path = b''
+            _write_varint(block, host_id)
+            path_bytes = key[1]
+            n_shared = _common_prefix(prev_path, path_bytes)
+            _write_varint(block, n_shared)
+            _write_varint(block, len(path_bytes) - n_shared)
+            block += path_bytes[n_shared:]
+            prev_path = path_bytes
+            _write_text(block, document['digest'])
+            _write_text(block, document.get('partial', None))
+            algorithm = document.get('algorithm', None)
+            _write_varint(block, 0 if algorithm is None
+                          else strings.setdefault(algorithm, len(strings)) + 1)
+            values = [document.get(field, None) for field in _INT_FIELDS]
+            _write_varint(block, sum(1 << idx
+                                     for idx, value in enumerate(values)
+                                     if value is not None))
+            for value in values:
+                if value is not None:
+                    _write_varint(block, value)
+            n_block += 1
+            n_records += 1
+            if n_block >= block_records:
+                write_block(block, n_block, first)
+                block = bytearray()
+                n_block = 0
+        if n_block:
+            write_block(block, n_block, first)
+        footer = zlib.compress(json.dumps({
+            'strings': sorted(strings, key=strings.__getitem__),
+            'blocks': blocks
+        }).encode('utf-8'))
+        footer_offset = handle.tell()
+        handle.write(footer)
+        handle.write(_TRAILER.pack(footer_offset, len(footer), _MAGIC))
+    return n_records
+
+
+class RecordFile:
+    """Reader of a compact record file, for sequential scans and lookups by host and path
+    """
+
+    def __init__(self, path: Path):
+        """Initializes the reader
+
+        Args:
+            path (Path): Record file
+        """
+        self.__path = path
+        self.__handle: Optional[BinaryIO] = None
+        self.__decompress: Callable[[bytes], bytes] = zlib.decompress
+        self.__strings: List[str] = []
+        self.__blocks: List[Tuple[int, int, int, int, str]] = []
+        self.__first_keys: List[Tuple[str, bytes]] = []
+
+    def __enter__(self) -> RecordFile:
+        self.open()
+        return self
+
+    def __exit__(self, exc, exv, exp) -> None:
+        self.close()
+
+    def open(self):
+        """Opens the file and reads the block index
+
+        Raises:
+            ValueError: Not a record file, or an unavailable compression
+        """
+        self.__handle = open(self.__path, 'rb')  # pylint: disable=consider-using-with
+        magic, compression = _HEADER.unpack(self.__handle.read(_HEADER.size))
+        compression = compression.rstrip(b'\0').decode()
+        if magic != _MAGIC:
+            raise ValueError(f'Unknown record file format {self.__path}')
+        if compression not in COMPRESSORS:
+            raise ValueError(f'{self.__path} uses {compression}, which is not installed')
+        self.__decompress = COMPRESSORS[compression][1]
+        self.__handle.seek(-_TRAILER.size, 2)
+        footer_offset, footer_length, magic = _TRAILER.unpack(
+            self.__handle.read(_TRAILER.size))
+        if magic != _MAGIC:
+            raise ValueError(f'Truncated record file {self.__path}')
+        self.__handle.seek(footer_offset)
+        footer = json.loads(zlib.decompress(self.__handle.read(footer_length)))
+        self.__strings = footer['strings']
+        self.__blocks = [tuple(block) for block in footer['blocks']]
+        self.__first_keys = [(self.__strings[host_id], os.fsencode(path))
+                             for _, _, _, host_id, path in self.__blocks]
+
+    def close(self):
+        """Closes the file
+        """
+        if self.__handle is not None:
+            self.__handle.close()
+            self.__handle = None
+
+    def __len__(self) -> int:
+        return sum(n_records for _, _, n_records, _, _ in self.__blocks)
+
+    def __iter__(self) -> Iterator[Dict]:
+        """Iterates over the records in order, as JSON lines hash file documents
+        """
+        for idx in range(len(self.__blocks)):
+            yield from self.__read_block(idx)
+
+    def find(self, host: str, path: str) -> List[Dict]:
+        """Retrieves the records of a path on a host
+
+        Args:
+            host (str): Hostname
+            path (str): Posix path
+
+        Returns:
+            List[Dict]: Matching records, as JSON lines hash file documents
+        """
+        key = (host, os.fsencode(path))
+        # Records of the path may start at the end of the block before the first block that
+        # starts with it
+        idx = max(bisect_left(self.__first_keys, key) - 1, 0)
+        matches: List[Dict] = []
+        for block_idx in range(idx, len(self.__blocks)):
+            if self.__first_keys[block_idx] > key:
+                break
+            matches.extend(document
+                           for document in self.__read_block(block_idx)
+                           if (document['host'], document['path']) == (host, path))
+        return matches
+
+    def __read_block(self, idx: int) -> Iterator[Dict]:
+        # pylint: disable=too-many-locals
+        # Record decoder
+        offset, length, n_records, _, _ = self.__blocks[idx]
+        self.__handle.seek(offset)
+        data = self.__decompress(self.__handle.read(length))
+        position = 0
+        prev_path = b''
+        for _ in range(n_records):
+            host_id, position = _read_varint(data, position)
+            n_shared, position = _read_varint(data, position)
+            n_suffix, position = _read_varint(data, position)
+            path = prev_path[:n_shared] + data[position:position + n_suffix]
+            position += n_suffix
+            prev_path = path
+            digest, position = _read_text(data, position)
+            partial, position = _read_text(data, position)
+            algorithm_id, position = _read_varint(data, position)
+            present, position = _read_varint(data, position)
+            document = {
+                'digest': digest,
+                'path': os.fsdecode(path),
+                'host': self.__strings[host_id]
+            }
+            for field_idx, field in enumerate(_INT_FIELDS):
+                if present & (1 << field_idx):
+                    document[field], position = _read_varint(data, position)
+            if partial is not None:
+                document['partial'] = partial
+            if algorithm_id:
+                document['algorithm'] = self.__strings[algorithm_id - 1]
+            yield document
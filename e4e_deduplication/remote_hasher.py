@@ -0,0 +1,383 @@
+'''Remote Hasher
+
+Farms hashing out to worker processes, possibly on other hosts that mount the same share, over a
+TCP or Unix socket.  Messages are pickled by multiprocessing.connection, and both ends
+authenticate with a shared key before any message is read, so only run workers on trusted
+networks.
+'''
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import AuthenticationError, cpu_count
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Condition, Thread
+from typing import Any, Callable, List, Optional, Tuple, Union
+
+from e4e_deduplication.parallel_hasher import ParallelHasher
+
+AUTHKEY_ENV = 'E4E_DEDUP_AUTHKEY'
+BATCH_SIZE = 64
+WAIT_LOG_INTERVAL = 30
+_SENTINEL = None
+
+Address = Union[str, Tuple[str, int]]
+Job = Tuple[Path, Optional[int]]
+
+
+def parse_address(spec: str) -> Address:
+    """Parses a socket address
+
+    Args:
+        spec (str): host:port for a TCP socket, or the path of a Unix socket
+
+    Returns:
+        Address: Address for multiprocessing.connection
+    """
+    host, _, port = spec.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return spec
+
+
+def load_authkey() -> bytes:
+    """Loads the key shared by the coordinator and workers from the AUTHKEY_ENV environment
+    variable
+
+    Raises:
+        RuntimeError: Key not set
+
+    Returns:
+        bytes: Authentication key
+    """
+    authkey = os.environ.get(AUTHKEY_ENV, '')
+    if not authkey:
+        raise RuntimeError(f'Set {AUTHKEY_ENV} to a secret shared by the coordinator and workers')
+    return authkey.encode()
+
+
+def _hash_path(hash_fn: Callable[[Path], str],
+               path_map: Optional[Tuple[str, str]],
+               path: str) -> Optional[str]:
+    if path_map and path.startswith(path_map[0]):
+        path = path_map[1] + path[len(path_map[0]):]
+    try:
+        return hash_fn(Path(path))
+    except Exception:  # pylint: disable=broad-except
+        logging.getLogger('Hasher').exception('Hash Function emitted exception')
+        return None
+
+
+def run_worker(address: Address,
+               authkey: bytes,
+               *,
+               n_threads: Optional[int] = None,
+               path_map: Optional[Tuple[str, str]] = None) -> None:
+    """Connects to a coordinator and hashes the batches of paths it sends until it disconnects
+
+    Args:
+        address (Address): Coordinator address
+        authkey (bytes): Key shared with the coordinator
+        n_threads (Optional[int], optional): Number of hashing threads.  Defaults to the number
+        of CPUs.
+        path_map (Optional[Tuple[str, str]], optional): Prefix of the coordinator's paths, and
+        the prefix to replace it with on this host, for shares mounted at different paths.
+        Defaults to None.
+    """
+    logger = logging.getLogger('Worker')
+    with Client(address, authkey=authkey) as connection, \
+            ThreadPoolExecutor(max_workers=n_threads or cpu_count()) as executor:
+        logger.info(f'Connected to {address}')
+        n_files = 0
+        while True:
+            try:
+                message = connection.recv()
+            except EOFError:
+                break
+            if message is _SENTINEL:
+                break
+            hash_fn, paths = message
+            connection.send(list(executor.map(partial(_hash_path, hash_fn, path_map), paths)))
+            n_files += len(paths)
+        logger.info(f'Hashed {n_files} files')
+
+
+class _RemoteRun:
+    """Jobs of a single ParallelHasher run
+    """
+    # pylint: disable=too-few-public-methods
+    # Run state
+
+    def __init__(self, hash_fn: Callable[[Path], str], job_queue: Queue, result_queue: Queue):
+        self.hash_fn = hash_fn
+        self.job_queue = job_queue
+        self.result_queue = result_queue
+        # Batches of workers that disconnected, hashed before any new jobs
+        self.retries: List[List[Job]] = []
+        self.n_outstanding = 0
+        self.input_done = False
+
+    @property
+    def done(self) -> bool:
+        """Whether every job has been hashed
+        """
+        return self.input_done and self.n_outstanding == 0 and not self.retries
+
+    def take(self) -> List[Job]:
+        """Takes up to BATCH_SIZE jobs from the job queue, blocking for the first
+
+        Returns:
+            List[Job]: Jobs, empty once the job queue is exhausted
+        """
+        batch: List[Job] = []
+        job = self.job_queue.get()
+        while job is not _SENTINEL:
+            batch.append(job)
+            if len(batch) >= BATCH_SIZE:
+                return batch
+            try:
+                job = self.job_queue.get_nowait()
+            except Empty:
+                return batch
+        # Leave the sentinel for the other connections
+        self.input_done = True
+        self.job_queue.put(_SENTINEL)
+        return batch
+
+
+class Coordinator:
+    """Accepts hashing workers on a socket, and hands each connected worker batches of
+    BATCH_SIZE paths from the running RemoteHasher.  Workers may connect and disconnect at any
+    time, and the batch of a worker that disconnects is hashed by another.
+    """
+    # pylint: disable=too-many-instance-attributes
+    # Listener, worker and run state
+
+    def __init__(self, address: Address, authkey: bytes, *, n_local_workers: int = 0):
+        """Initializes the coordinator
+
+        Args:
+            address (Address): Address to listen on, as from parse_address.  Port 0 listens on
+            any free port.
+            authkey (bytes): Key shared with the workers
+            n_local_workers (int, optional): Number of worker processes to start on this host.
+            Defaults to 0.
+        """
+        self.__address = address
+        self.__authkey = authkey
+        self.__n_local_workers = n_local_workers
+        self.__listener: Optional[Listener] = None
+        self.__accept_thread: Optional[Thread] = None
+        self.__servers: List[Thread] = []
+        self.__local_workers: List[Any] = []
+        self.__condition = Condition()
+        self.__run: Optional[_RemoteRun] = None
+        self.__n_workers = 0
+        self.__closing = False
+        self.__log = logging.getLogger('Coordinator')
+
+    @property
+    def address(self) -> Address:
+        """Address the coordinator is listening on
+        """
+        return self.__listener.address
+
+    def __enter__(self) -> Coordinator:
+        self.start()
+        return self
+
+    def __exit__(self, exc, exv, exp) -> None:
+        self.close()
+
+    def start(self):
+        """Starts listening for workers, and starts the local workers
+        """
+        self.__listener = Listener(self.__address, authkey=self.__authkey)
+        self.__accept_thread = Thread(target=self.__accept, daemon=True)
+        self.__accept_thread.start()
+        self.__log.info(f'Listening for workers on {self.address}')
+        context = multiprocessing.get_context('spawn')
+        for _ in range(self.__n_local_workers):
+            worker = context.Process(target=run_worker,
+                                     args=(self.__local_address(), self.__authkey))
+            worker.start()
+            self.__local_workers.append(worker)
+
+    def close(self):
+        """Disconnects the workers and stops listening
+        """
+        with self.__condition:
+            self.__closing = True
+            self.__condition.notify_all()
+        try:
+            # Wake the accept thread, which is not interrupted by closing the listener
+            Client(self.__local_address(), authkey=self.__authkey).close()
+        except OSError:
+            pass
+        self.__accept_thread.join()
+        self.__listener.close()
+        for server in self.__servers:
+            server.join()
+        for worker in self.__local_workers:
+            worker.join()
+
+    def start_run(self, hash_fn: Callable[[Path], str], job_queue: Queue, result_queue: Queue):
+        """Starts handing out the jobs of a run to the workers
+
+        Args:
+            hash_fn (Callable[[Path], str]): Picklable hash function
+            job_queue (Queue): Path and size of each file to hash, ended by a sentinel
+            result_queue (Queue): Queue for the path, digest and size of each hashed file
+        """
+        with self.__condition:
+            self.__run = _RemoteRun(hash_fn, job_queue, result_queue)
+            self.__condition.notify_all()
+            if self.__n_workers == 0:
+                self.__log_waiting()
+
+    def finish_run(self):
+        """Ends the run's jobs with a sentinel, and waits for the workers to hash them all
+        """
+        run = self.__run
+        run.job_queue.put(_SENTINEL)
+        with self.__condition:
+            while not run.done:
+                if not self.__condition.wait(timeout=WAIT_LOG_INTERVAL) and \
+                        self.__n_workers == 0:
+                    self.__log_waiting()
+            self.__run = None
+
+    def __local_address(self) -> Address:
+        # Connecting to a wildcard address fails on some platforms
+        address = self.address
+        if isinstance(address, tuple) and address[0] in ('', '0.0.0.0', '::'):
+            return 'localhost', address[1]
+        return address
+
+    def __log_waiting(self):
+        self.__log.warning(f'No workers connected, waiting for workers on {self.address}')
+
+    def __accept(self):
+        while True:
+            try:
+                connection = self.__listener.accept()
+            except AuthenticationError:
+                self.__log.warning('Rejected a worker with the wrong key')
+                continue
+            except (OSError, EOFError):
+                with self.__condition:
+                    if self.__closing:
+                        return
+                self.__log.exception('Unable to accept worker')
+                continue
+            with self.__condition:
+                if self.__closing:
+                    connection.close()
+                    return
+                server = Thread(target=self.__serve, args=(connection,), daemon=True)
+                self.__servers.append(server)
+            server.start()
+
+    def __next_batch(self) -> Optional[Tuple[_RemoteRun, List[Job]]]:
+        with self.__condition:
+            while True:
+                if self.__closing:
+                    return None
+                run = self.__run
+                if run is not None and run.retries:
+                    run.n_outstanding += 1
+                    return run, run.retries.pop()
+                if run is not None and not run.input_done:
+                    # Reserved before taking, so the run is not done while jobs are in hand
+                    run.n_outstanding += 1
+                    break
+                self.__condition.wait()
+        batch = run.take()
+        if not batch:
+            self.__complete(run)
+            return self.__next_batch()
+        return run, batch
+
+    def __complete(self, run: _RemoteRun, failed: Optional[List[Job]] = None):
+        with self.__condition:
+            run.n_outstanding -= 1
+            if failed:
+                run.retries.append(failed)
+            self.__condition.notify_all()
+
+    def __serve(self, connection: Connection):
+        with self.__condition:
+            self.__n_workers += 1
+        try:
+            self.__serve_batches(connection)
+        finally:
+            with self.__condition:
+                self.__n_workers -= 1
+                if self.__n_workers == 0 and self.__run is not None and not self.__closing:
+                    self.__log_waiting()
+
+    def __serve_batches(self, connection: Connection):
+        n_files = 0
+        with connection:
+            while (work := self.__next_batch()) is not None:
+                run, batch = work
+                try:
+                    connection.send((run.hash_fn, [path.as_posix() for path, _ in batch]))
+                    digests = connection.recv()
+                except (OSError, EOFError):
+                    self.__log.warning(f'Worker disconnected after {n_files} files, '
+                                       f'requeueing {len(batch)} files')
+                    self.__complete(run, batch)
+                    return
+                for (path, size), digest in zip(batch, digests):
+                    if digest is not None:
+                        run.result_queue.put((path, digest, size))
+                n_files += len(batch)
+                self.__complete(run)
+            try:
+                connection.send(_SENTINEL)
+            except OSError:
+                pass
+        self.__log.info(f'Worker hashed {n_files} files')
+
+
+class RemoteHasher(ParallelHasher):
+    """Parallel hasher that hashes on the workers of a coordinator instead of local threads.
+    The hash function must be picklable, and importable by the workers.
+    """
+    # pylint: disable=too-few-public-methods
+    # This is meant to be a single method class
+
+    def __init__(self,
+                 process_fn: Optional[Callable[[Path, str], None]],
+                 ignore_pattern: Any,
+                 *,
+                 coordinator: Coordinator,
+                 **kwargs):
+        """Initializes the remote hasher
+
+        Args:
+            process_fn (Optional[Callable[[Path, str], None]]): As in ParallelHasher
+            ignore_pattern (Any): As in ParallelHasher
+            coordinator (Coordinator): Started coordinator to hash with
+            **kwargs: Other ParallelHasher arguments.  The backend is ignored.
+        """
+        kwargs['backend'] = 'threads'
+        super().__init__(process_fn, ignore_pattern, **kwargs)
+        self.__coordinator = coordinator
+
+    def _start_hashers(self,
+                       job_queue: Queue,
+                       result_queue: Queue,
+                       budget: Any = None) -> List[Thread]:
+        # Only the threads backend is used, so no files are prefetched into budget
+        self.__coordinator.start_run(self._hash_fn, job_queue, result_queue)
+        return []
+
+    def _stop_hashers(self, job_queue: Queue, workers: List[Thread]) -> None:
+        self.__coordinator.finish_run()
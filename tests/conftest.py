@@ -9,13 +9,15 @@ from dataclasses import dataclass
 from pathlib import Path
 from random import randbytes, randint
 from tempfile import TemporaryDirectory
-from typing import Dict
+from typing import Dict, List
 
 import pytest
 from nas_unzip.nas import nas_unzip
 from utils import create_random_file
 
+from e4e_deduplication import analyzer
 from e4e_deduplication.analyzer import Analyzer
+from e4e_deduplication.hasher import compute_sha256
 
 
 @pytest.fixture(name='creds', scope='session')
@@ -78,6 +80,25 @@ def create_test_analyzer():
             yield app
 
 
+@pytest.fixture(name='hashed_paths')
+def count_hashed_paths(monkeypatch: pytest.MonkeyPatch) -> List[Path]:
+    """Records every file the analyzer fully hashes
+
+    Args:
+        monkeypatch (pytest.MonkeyPatch): Monkeypatch fixture
+
+    Yields:
+        List[Path]: Paths passed to compute_sha256, in call order
+    """
+    hashed_paths = []
+
+    def counting_sha256(path: Path) -> str:
+        hashed_paths.append(path)
+        return compute_sha256(path)
+    monkeypatch.setattr(analyzer, 'compute_sha256', counting_sha256)
+    yield hashed_paths
+
+
 @pytest.fixture(name='test_file', params=['size'])
 def create_test_file(request: pytest.FixtureRequest) -> Path:
     """Creates a test file with the specified size
@@ -5,6 +5,7 @@ import subprocess
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
+import pytest
 from conftest import MockAppDirs, TestDuplicatedSet
 
 from e4e_deduplication.app import Deduplicator
@@ -90,3 +91,20 @@ def test_dedup_same_dir_ps1(subdir_dup: TestDuplicatedSet, temp_appdirs: MockApp
                 )
                 for dupe in subdir_dup.duplicate_map:
                     assert not dupe.exists()
+
+
+def test_export_unknown_job(temp_appdirs: MockAppDirs):
+    """Tests that exporting a job that does not exist fails without creating it
+
+    Args:
+        temp_appdirs (MockAppDirs): Temporary AppDirs
+    """
+    with Deduplicator(app_dirs=temp_appdirs) as app:
+        with TemporaryDirectory() as tmpdir:
+            # pylint: disable=protected-access
+            # Test to evaluate this behavior
+            output = Path(tmpdir).joinpath('export.json')
+            with pytest.raises(FileNotFoundError):
+                app._export_cache(job_name='no_such_job', output=output)
+            assert not output.exists()
+            assert not Path(temp_appdirs.user_data_dir, 'no_such_job').exists()
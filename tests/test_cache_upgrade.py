@@ -4,7 +4,9 @@ from pathlib import Path
 from tempfile import TemporaryDirectory
 import json
 from e4e_deduplication import (cache_0_7_to_1_0_upgrade,
-                               cache_1_2_to_1_3_upgrade)
+                               cache_1_2_to_1_3_upgrade,
+                               cache_1_5_to_1_6_upgrade)
+from e4e_deduplication.job_cache import JobCache
 
 
 def test_0_7_to_1_0_upgrade():
@@ -69,3 +71,35 @@ def test_1_2_to_1_3_upgrade():
                 assert 'host' in document
                 assert 'path' in document
                 assert Path(document['path'])
+
+
+def test_1_5_to_1_6_upgrade():
+    """Tests v1.5.0 to v1.6.0 upgrade
+    """
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        hash_file = temp_dir / 'hashes.csv'
+        dest_path = temp_dir / 'job'
+
+        with open(hash_file, 'w', encoding='utf-8') as handle:
+            for idx in range(16):
+                handle.write(json.dumps({
+                    'digest': f'{idx % 8:064x}',
+                    'path': temp_dir.joinpath(f'{idx:08d},comma.bin').as_posix(),
+                    'host': 'old_hostname'
+                }) + '\n')
+
+        cache_1_5_to_1_6_upgrade.upgrade_cache(
+            hash_file=hash_file,
+            dest_path=dest_path
+        )
+
+        with JobCache(dest_path) as cache:
+            assert cache.n_records == 16
+            duplicates = cache.get_duplicates()
+            assert len(duplicates) == 8
+            for paths in duplicates.values():
+                assert len(paths) == 2
+                for path, host in paths:
+                    assert path.parent == temp_dir
+                    assert host == 'old_hostname'
@@ -5,9 +5,18 @@ import shutil
 from pathlib import Path
 from random import randbytes, randint
 import socket
+from functools import partialmethod
 from tempfile import TemporaryDirectory
+from typing import List
+from unittest.mock import patch
+
+import pytest
 
 from e4e_deduplication.analyzer import Analyzer
+from e4e_deduplication.digest_index import DigestIndex
+from e4e_deduplication.hasher import HASH_ALGORITHMS, compute_digest, compute_sha256
+from e4e_deduplication.job_cache import JobCache
+from e4e_deduplication.parallel_hasher import ParallelHasher
 
 
 def test_same_dir_dedup(test_analyzer: Analyzer):
@@ -97,3 +106,268 @@ def test_separate_dir_dedup(test_analyzer: Analyzer):
         assert len(list(dupe_dir.rglob('*'))) == total_files
         assert len(results) == n_dupes
         assert len(list(working_dir.rglob('*'))) == n_files
+
+
+def test_incremental_analyze(test_analyzer: Analyzer, hashed_paths: List[Path],
+                             monkeypatch: pytest.MonkeyPatch):
+    """Tests that incremental analysis only hashes new and modified files, and replaces the
+    records of modified files
+
+    Args:
+        test_analyzer (Analyzer): Test Analyzer
+        hashed_paths (List[Path]): Files fully hashed by the analyzer
+        monkeypatch (pytest.MonkeyPatch): Monkeypatch fixture
+    """
+    # Look up fingerprints over several batches
+    monkeypatch.setattr(JobCache, 'LOOKUP_BATCH_SIZE', 4)
+    with TemporaryDirectory() as reference_dir:
+        working_dir = Path(reference_dir).resolve()
+        n_files = 16
+        for idx in range(n_files):
+            with open(working_dir.joinpath(f'{idx:06d}.bin'), 'wb') as handle:
+                handle.write(randbytes(randint(1024, 4096)))
+
+        test_analyzer.analyze(working_dir, incremental=True)
+        assert len(hashed_paths) == n_files
+
+        hashed_paths.clear()
+        test_analyzer.analyze(working_dir, incremental=True)
+        assert len(hashed_paths) == 0
+
+        modified_file = working_dir.joinpath(f'{0:06d}.bin')
+        # Would match the old record of the modified file if it were kept
+        original_copy = working_dir.joinpath('original.bin')
+        shutil.copy(modified_file, original_copy)
+        with open(modified_file, 'ab') as handle:
+            handle.write(randbytes(16))
+        removed_file = working_dir.joinpath(f'{1:06d}.bin')
+        removed_file.unlink()
+        new_file = working_dir.joinpath('new.bin')
+        shutil.copy(working_dir.joinpath(f'{2:06d}.bin'), new_file)
+
+        test_analyzer.analyze(working_dir, incremental=True)
+        assert sorted(hashed_paths) == sorted([modified_file, new_file, original_copy])
+        results = test_analyzer.get_duplicates()
+        assert len(results) == 1
+        for file_set in results.values():
+            assert {file for file, _ in file_set} == {
+                new_file, working_dir.joinpath(f'{2:06d}.bin')}
+
+
+def test_resume_analyze(test_analyzer: Analyzer, hashed_paths: List[Path],
+                        monkeypatch: pytest.MonkeyPatch):
+    """Tests that resuming a crashed analysis only hashes the files it did not record
+
+    Args:
+        test_analyzer (Analyzer): Test Analyzer
+        hashed_paths (List[Path]): Files fully hashed by the analyzer
+        monkeypatch (pytest.MonkeyPatch): Monkeypatch fixture
+    """
+    recorded_paths = []
+    crash_after = 8
+
+    def crashing_add_many(self: JobCache, entries):
+        entries = list(entries)
+        original_add_many(self, entries)
+        recorded_paths.extend(path for path, _, _, _ in entries)
+        if len(recorded_paths) >= crash_after:
+            raise RuntimeError('Crashed')
+
+    original_add_many = JobCache.add_many
+    monkeypatch.setattr(Analyzer, 'CHECKPOINT_INTERVAL', 0)
+    with TemporaryDirectory() as reference_dir:
+        working_dir = Path(reference_dir).resolve()
+        n_files = 32
+        for idx in range(n_files):
+            with open(working_dir.joinpath(f'{idx:06d}.bin'), 'wb') as handle:
+                handle.write(randbytes(randint(1024, 4096)))
+
+        with monkeypatch.context() as patch_context:
+            patch_context.setattr(JobCache, 'add_many', crashing_add_many)
+            patch_context.setattr(ParallelHasher, '__init__',
+                                  partialmethod(ParallelHasher.__init__, batch_size=4))
+            with pytest.raises(RuntimeError):
+                test_analyzer.analyze(working_dir)
+        assert crash_after <= len(recorded_paths) < n_files
+
+        hashed_paths.clear()
+        test_analyzer.analyze(working_dir, resume=True)
+        assert sorted(hashed_paths) == sorted(set(working_dir.iterdir()) - set(recorded_paths))
+        assert not test_analyzer.get_duplicates()
+
+
+def test_analyze_many(test_analyzer: Analyzer, hashed_paths: List[Path]):
+    """Tests analyzing several directories in one pass, including a nested directory
+
+    Args:
+        test_analyzer (Analyzer): Test Analyzer
+        hashed_paths (List[Path]): Files fully hashed by the analyzer
+    """
+    with TemporaryDirectory() as first_dir, TemporaryDirectory() as second_dir:
+        first_path = Path(first_dir).resolve()
+        second_path = Path(second_dir).resolve()
+        nested_path = first_path.joinpath('nested')
+        nested_path.mkdir()
+        for idx in range(8):
+            with open(first_path.joinpath(f'{idx:06d}.bin'), 'wb') as handle:
+                handle.write(randbytes(randint(1024, 4096)))
+        shutil.copy(first_path.joinpath(f'{0:06d}.bin'), nested_path.joinpath('dupe.bin'))
+        shutil.copy(first_path.joinpath(f'{1:06d}.bin'), second_path.joinpath('dupe.bin'))
+
+        test_analyzer.analyze_many([first_path, nested_path, second_path])
+        assert len(hashed_paths) == len(set(hashed_paths)) == 10
+        results = test_analyzer.get_duplicates()
+        assert sorted(len(file_set) for file_set in results.values()) == [2, 2]
+
+
+def test_size_filter(test_analyzer: Analyzer, hashed_paths: List[Path]):
+    """Tests that size filtering only hashes files with a matching size
+
+    Args:
+        test_analyzer (Analyzer): Test Analyzer
+        hashed_paths (List[Path]): Files fully hashed by the analyzer
+    """
+    # pylint: disable=too-many-locals
+    # Locals for debugging and result assessment
+    with TemporaryDirectory() as reference_dir, TemporaryDirectory() as duplicate_dir:
+        working_dir = Path(reference_dir).resolve()
+        dupe_dir = Path(duplicate_dir).resolve()
+        n_files = 16
+        for idx in range(n_files):
+            with open(working_dir.joinpath(f'{idx:06d}.bin'), 'wb') as handle:
+                handle.write(randbytes(1024 + idx))
+        same_size_files = [working_dir.joinpath(f'same_{idx}.bin') for idx in range(2)]
+        for file in same_size_files:
+            with open(file, 'wb') as handle:
+                handle.write(randbytes(512))
+
+        test_analyzer.analyze(working_dir, size_filter=True)
+        assert sorted(hashed_paths) == sorted(same_size_files)
+        assert len(test_analyzer.get_duplicates()) == 0
+
+        # Earlier records of the same files are not a size match
+        hashed_paths.clear()
+        test_analyzer.analyze(working_dir, size_filter=True)
+        assert sorted(hashed_paths) == sorted(same_size_files)
+
+        hashed_paths.clear()
+        dupe_file = dupe_dir.joinpath('dupe.bin')
+        shutil.copy(working_dir.joinpath(f'{3:06d}.bin'), dupe_file)
+        results = test_analyzer.delete(dupe_dir, size_filter=True)
+        assert sorted(hashed_paths) == sorted([working_dir.joinpath(f'{3:06d}.bin'), dupe_file])
+        assert list(results) == [dupe_file]
+
+        hashed_paths.clear()
+        test_analyzer.analyze(dupe_dir, size_filter=True)
+        assert hashed_paths == [dupe_file]
+        results = test_analyzer.get_duplicates()
+        assert len(results) == 1
+        for file_set in results.values():
+            assert {file for file, _ in file_set} == {
+                dupe_file, working_dir.joinpath(f'{3:06d}.bin')}
+
+
+def test_size_filter_then_unfiltered(test_analyzer: Analyzer):
+    """Tests that records without a digest from a size filtered analysis match files analyzed or
+    deleted without size filtering
+
+    Args:
+        test_analyzer (Analyzer): Test Analyzer
+    """
+    with TemporaryDirectory() as reference_dir, TemporaryDirectory() as duplicate_dir, \
+            TemporaryDirectory() as delete_dir:
+        working_dir = Path(reference_dir).resolve()
+        reference_file = working_dir.joinpath('x.bin')
+        reference_file.write_bytes(randbytes(1024))
+        delete_file = working_dir.joinpath('y.bin')
+        delete_file.write_bytes(randbytes(2048))
+        test_analyzer.analyze(working_dir, size_filter=True)
+        assert not test_analyzer.get_duplicates()
+
+        dupe_file = Path(duplicate_dir).resolve().joinpath('x_copy.bin')
+        shutil.copy(reference_file, dupe_file)
+        test_analyzer.analyze(dupe_file.parent)
+        results = test_analyzer.get_duplicates()
+        assert len(results) == 1
+        for file_set in results.values():
+            assert {file for file, _ in file_set} == {reference_file, dupe_file}
+
+        delete_copy = Path(delete_dir).resolve().joinpath('y_copy.bin')
+        shutil.copy(delete_file, delete_copy)
+        assert list(test_analyzer.delete(delete_copy.parent)) == [delete_copy]
+
+
+def test_partial_hash(test_analyzer: Analyzer, hashed_paths: List[Path]):
+    """Tests that the partial digest stage only fully hashes files with a partial match
+
+    Args:
+        test_analyzer (Analyzer): Test Analyzer
+        hashed_paths (List[Path]): Files fully hashed by the analyzer
+    """
+    with TemporaryDirectory() as reference_dir, TemporaryDirectory() as duplicate_dir:
+        working_dir = Path(reference_dir).resolve()
+        dupe_dir = Path(duplicate_dir).resolve()
+        n_files = 16
+        for idx in range(n_files):
+            with open(working_dir.joinpath(f'{idx:06d}.bin'), 'wb') as handle:
+                handle.write(randbytes(4096))
+        dupe_file = working_dir.joinpath('dupe.bin')
+        shutil.copy(working_dir.joinpath(f'{0:06d}.bin'), dupe_file)
+
+        test_analyzer.analyze(working_dir, partial_hash=True)
+        assert sorted(hashed_paths) == sorted([working_dir.joinpath(f'{0:06d}.bin'), dupe_file])
+        assert len(test_analyzer.get_duplicates()) == 1
+
+        hashed_paths.clear()
+        delete_file = dupe_dir.joinpath('delete.bin')
+        shutil.copy(working_dir.joinpath(f'{3:06d}.bin'), delete_file)
+        results = test_analyzer.delete(dupe_dir, partial_hash=True)
+        assert sorted(hashed_paths) == sorted([working_dir.joinpath(f'{3:06d}.bin'), delete_file])
+        assert list(results) == [delete_file]
+
+
+def test_delete_stale_index(test_analyzer: Analyzer):
+    """Tests that a file is kept if its digest is only in a stale digest index
+
+    Args:
+        test_analyzer (Analyzer): Test Analyzer
+    """
+    with TemporaryDirectory() as duplicate_dir:
+        dupe_dir = Path(duplicate_dir).resolve()
+        dupe_file = dupe_dir.joinpath('copy_of_a.bin')
+        dupe_file.write_bytes(randbytes(4096))
+        # The reference copy was dropped from the cache after the index was saved
+        stale_index = DigestIndex.build([(compute_sha256(dupe_file), 1)])
+        with patch.object(JobCache, 'get_digest_index', return_value=stale_index), \
+                patch.object(JobCache, 'discard_digest_index') as discard_digest_index:
+            assert not test_analyzer.delete(dupe_dir)
+        discard_digest_index.assert_called_once()
+
+
+def test_algorithm():
+    """Tests that jobs record their hash algorithm and reject other algorithms
+    """
+    with TemporaryDirectory() as cache_dir, TemporaryDirectory() as reference_dir:
+        job_path = Path(cache_dir, 'test')
+        working_dir = Path(reference_dir).resolve()
+        reference_file = working_dir.joinpath('reference.bin')
+        reference_file.write_bytes(randbytes(4096))
+        shutil.copy(reference_file, working_dir.joinpath('dupe.bin'))
+
+        with Analyzer(ignore_pattern=None, job_path=job_path, algorithm='blake2b') as app:
+            app.analyze(working_dir)
+            assert list(app.get_duplicates()) == [compute_digest(reference_file, 'blake2b')]
+
+        with Analyzer(ignore_pattern=None, job_path=job_path, algorithm='sha256') as app:
+            with pytest.raises(ValueError):
+                app.analyze(working_dir)
+
+        with Analyzer(ignore_pattern=None, job_path=job_path) as app:
+            assert len(app.delete(working_dir)) == 2
+
+        with patch.dict(HASH_ALGORITHMS), \
+                Analyzer(ignore_pattern=None, job_path=job_path) as app:
+            # Job algorithm not installed on this host
+            del HASH_ALGORITHMS['blake2b']
+            with pytest.raises(ValueError):
+                app.analyze(working_dir)
@@ -0,0 +1,48 @@
+'''Tests the compact digest index
+'''
+from hashlib import sha256
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from e4e_deduplication.digest_index import KEY_SIZE, DigestIndex
+
+
+def test_digest_index():
+    """Tests lookups in the digest index, including unsorted and repeated digests
+    """
+    n_digests = 1024
+    digests = [sha256(f'{idx}'.encode()).hexdigest() for idx in range(n_digests)]
+    records = [(digest, idx) for idx, digest in enumerate(digests)]
+    records.append((digests[0], n_digests))
+    records.append(('baadf00d', n_digests + 1))
+    index = DigestIndex.build(records)
+
+    assert len(index) == n_digests + 2
+    assert index.nbytes == (KEY_SIZE + 8) * len(index)
+    for idx, digest in enumerate(digests[1:], start=1):
+        assert digest in index
+        assert index.lookup(digest) == [idx]
+    assert sorted(index.lookup(digests[0])) == [0, n_digests]
+    assert index.lookup('baadf00d') == [n_digests + 1]
+    assert sha256(b'missing').hexdigest() not in index
+    assert index.lookup('missing') == []
+
+
+def test_digest_index_append():
+    """Tests saving and memory mapping an index with appended records
+    """
+    digests = [sha256(f'{idx}'.encode()).hexdigest() for idx in range(64)]
+    index = DigestIndex.build((digest, idx) for idx, digest in enumerate(digests[:32]))
+    assert index.append((digest, idx) for idx, digest in enumerate(digests[32:], start=32)) == 32
+    assert all(digest in index for digest in digests)
+
+    with TemporaryDirectory() as tmpdir:
+        sidecar = Path(tmpdir).joinpath('digests.idx')
+        index.save(sidecar, 64, 3)
+        loaded, max_row_id, generation = DigestIndex.load(sidecar)
+        assert max_row_id == 64
+        assert generation == 3
+        assert len(loaded) == 64
+        for idx, digest in enumerate(digests):
+            assert loaded.lookup(digest) == [idx]
+        loaded.close()
@@ -1,10 +1,12 @@
 '''Tests File Sort
 '''
+import json
+from functools import partial
 from pathlib import Path
 from random import randbytes
 from tempfile import TemporaryDirectory
 
-from e4e_deduplication.file_sort import sort_file
+from e4e_deduplication.file_sort import json_field, sort_file
 
 
 def test_file_sort():
@@ -24,3 +26,38 @@ def test_file_sort():
             for line in handle:
                 assert line >= prev_line
                 prev_line = line
+
+
+def test_file_sort_key():
+    """Tests sorting JSON lines by a field over multiple merge passes
+    """
+    n_lines = 4096
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir)
+        file_to_sort = temp_dir.joinpath('hashes.json')
+        sorted_file = temp_dir.joinpath('sorted.json')
+        lines = [json.dumps({'path': randbytes(8).hex(), 'digest': randbytes(4).hex()}) + '\n'
+                 for _ in range(n_lines)]
+        file_to_sort.write_text(''.join(lines), encoding='utf-8')
+        sort_file(file_to_sort, sorted_file,
+                  key=partial(json_field, field='digest'),
+                  memory_budget=4096,
+                  n_workers=2,
+                  max_fan_in=4)
+        expected = sorted(lines, key=lambda line: json.loads(line)['digest'])
+        assert sorted_file.read_text(encoding='utf-8') == ''.join(expected)
+
+
+def test_file_sort_control_characters():
+    """Tests that lines with characters below the newline merge in the same order as in runs
+    """
+    lines = [f'a{chr(idx)}\n' for idx in range(1, 10)] + ['a\n'] * 8
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir)
+        file_to_sort = temp_dir.joinpath('lines.txt')
+        sorted_file = temp_dir.joinpath('sorted.txt')
+        with open(file_to_sort, 'w', encoding='utf-8', newline='\n') as handle:
+            handle.writelines(reversed(lines))
+        sort_file(file_to_sort, sorted_file, memory_budget=8, n_workers=1, max_fan_in=4)
+        with open(sorted_file, 'r', encoding='utf-8', newline='\n') as handle:
+            assert handle.read() == ''.join(sorted(lines, key=lambda line: line[:-1]))
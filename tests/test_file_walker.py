@@ -0,0 +1,92 @@
+'''Tests the directory walker
+'''
+import os
+import re
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import List
+from unittest.mock import patch
+
+import pytest
+from utils import create_random_file
+
+from e4e_deduplication.file_walker import walk_files
+
+
+def test_walk_files():
+    """Tests that the walker finds the same files as rglob, with their stat results
+    """
+    with TemporaryDirectory() as tmpdir:
+        root_dir = Path(tmpdir).resolve()
+        for dir_idx in range(4):
+            directory = root_dir.joinpath(f'{dir_idx:02d}', 'nested')
+            directory.mkdir(parents=True)
+            for file_idx in range(8):
+                create_random_file(directory.joinpath(f'{file_idx:02d}.bin'), file_idx)
+        ignored = root_dir.joinpath('@eaDir')
+        ignored.mkdir()
+        create_random_file(ignored.joinpath('thumb.jpg'), 16)
+
+        files = dict(walk_files(root_dir, re.compile('@eaDir')))
+        assert set(files) == {path
+                              for path in root_dir.rglob('*')
+                              if path.is_file() and '@eaDir' not in path.as_posix()}
+        for path, stat_result in files.items():
+            assert stat_result.st_size == path.stat().st_size
+
+
+@pytest.mark.parametrize('n_workers', [2, 8])
+def test_parallel_walk_files(n_workers: int):
+    """Tests that the parallel walker finds the same files as the serial walker, and prunes
+    ignored directories without listing them
+
+    Args:
+        n_workers (int): Number of walk workers
+    """
+    with TemporaryDirectory() as tmpdir:
+        root_dir = Path(tmpdir).resolve()
+        for dir_idx in range(16):
+            directory = root_dir.joinpath(f'{dir_idx:02d}', *[f'{depth}' for depth in range(4)])
+            directory.mkdir(parents=True)
+            for file_idx in range(4):
+                create_random_file(directory.joinpath(f'{file_idx:02d}.bin'), file_idx)
+        root_dir.joinpath('@eaDir', 'nested').mkdir(parents=True)
+        ignore_pattern = re.compile('@eaDir')
+
+        listed: List[str] = []
+        scandir = os.scandir
+
+        def tracking_scandir(path):
+            listed.append(Path(path).as_posix())
+            return scandir(path)
+
+        with patch('os.scandir', tracking_scandir):
+            files = sorted(path for path, _ in walk_files(root_dir, ignore_pattern,
+                                                         n_workers=n_workers))
+        assert files == sorted(path for path, _ in walk_files(root_dir, ignore_pattern))
+        assert len(files) == 16 * 4
+        assert not any('@eaDir' in directory for directory in listed)
+
+
+@pytest.mark.parametrize('n_workers', [1, 4])
+def test_walk_multiple_roots(n_workers: int):
+    """Tests walking several roots together
+
+    Args:
+        n_workers (int): Number of walking workers
+    """
+    with TemporaryDirectory() as tmpdir:
+        root_dir = Path(tmpdir).resolve()
+        roots = [root_dir.joinpath(f'root_{idx}') for idx in range(3)]
+        for root in roots:
+            root.joinpath('nested').mkdir(parents=True)
+            create_random_file(root.joinpath('a.bin'), 16)
+            create_random_file(root.joinpath('nested', 'b.bin'), 16)
+        create_random_file(root_dir.joinpath('outside.bin'), 16)
+
+        files = [path for path, _ in walk_files(roots, n_workers=n_workers)]
+        assert sorted(files) == sorted(path
+                                       for root in roots
+                                       for path in root.rglob('*.bin'))
+        if n_workers == 1:
+            assert [path.parent.name for path in files[::2]] == [root.name for root in roots]
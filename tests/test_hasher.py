@@ -0,0 +1,86 @@
+'''Tests the file hashers
+'''
+import hashlib
+import mmap
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Optional
+
+import pytest
+from utils import create_random_file
+
+from e4e_deduplication import hasher
+from e4e_deduplication.hasher import (compute_digest, compute_partial_digest,
+                                      compute_sha256, prefetch)
+
+
+@pytest.mark.parametrize('file_size', [0, 1, 4096, 3*1024*1024 + 7])
+def test_compute_digest(file_size: int):
+    """Tests that reading into reused buffers of any size matches hashlib
+
+    Args:
+        file_size (int): Size of the test file
+    """
+    with TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir).joinpath('test.bin')
+        create_random_file(path, file_size)
+        data = path.read_bytes()
+        assert compute_sha256(path) == hashlib.sha256(data).hexdigest()
+        for block_size in [1024, 4096, 1024*1024]:
+            assert compute_digest(path, block_size=block_size) == hashlib.sha256(data).hexdigest()
+            assert compute_digest(path, 'blake2b', block_size=block_size) == \
+                hashlib.blake2b(data, digest_size=32).hexdigest()
+        assert compute_partial_digest(path, block_size=1024, n_samples=0) == \
+            hashlib.sha256(data[:1024] + data[-1024:] if file_size > 2048 else data).hexdigest()
+
+
+@pytest.mark.parametrize('filesystem, n_windows', [('ext4', 4), ('nfs4', 0), (None, 0)])
+def test_mmap_digest(monkeypatch: pytest.MonkeyPatch, filesystem: Optional[str], n_windows: int):
+    """Tests that large files on local filesystems are hashed through memory mapped windows, and
+    that other files are read
+
+    Args:
+        monkeypatch (pytest.MonkeyPatch): Monkeypatch fixture
+        filesystem (Optional[str]): Filesystem type of the test file
+        n_windows (int): Expected number of mapped windows
+    """
+    windows = []
+    mmap_class = mmap.mmap
+
+    def tracking_mmap(*args, **kwargs):
+        windows.append(args)
+        return mmap_class(*args, **kwargs)
+    monkeypatch.setattr(hasher, 'MMAP_WINDOW_SIZE', mmap.ALLOCATIONGRANULARITY)
+    monkeypatch.setattr(hasher, 'MMAP_MIN_AGE', 0)
+    monkeypatch.setattr(hasher, '_filesystem_type', lambda _: filesystem)
+    monkeypatch.setattr(mmap, 'mmap', tracking_mmap)
+    with TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir).joinpath('test.bin')
+        create_random_file(path, 3 * mmap.ALLOCATIONGRANULARITY + 7)
+        digest = compute_digest(path, mmap_min_size=1)
+        assert digest == hashlib.sha256(path.read_bytes()).hexdigest()
+        assert len(windows) == n_windows
+
+        # Recently modified files may still be written
+        windows.clear()
+        monkeypatch.setattr(hasher, 'MMAP_MIN_AGE', 3600)
+        assert compute_digest(path, mmap_min_size=1) == digest
+        assert not windows
+
+
+@pytest.mark.parametrize('file_size', [0, 4096, 3*4096 + 7])
+def test_prefetched_digest(file_size: int):
+    """Tests hashing files kept open by prefetch, whole or from the open handle
+
+    Args:
+        file_size (int): Size of the test file
+    """
+    with TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir).joinpath('test.bin')
+        create_random_file(path, file_size)
+        prefetched = prefetch(path, 4096, keep_open=True)
+        assert (prefetched.handle is None) == (file_size <= 4096)
+        assert compute_sha256(path, prefetched=prefetched) == \
+            hashlib.sha256(path.read_bytes()).hexdigest()
+        assert prefetched.handle is None or prefetched.handle.closed
+        assert prefetch(Path(tmpdir).joinpath('missing.bin'), keep_open=True) is None
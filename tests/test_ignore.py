@@ -3,7 +3,9 @@
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
-from e4e_deduplication.file_filter import load_ignore_pattern
+from e4e_deduplication.file_filter import (IgnoreFilter, load_ignore_filter,
+                                              load_ignore_pattern)
+from e4e_deduplication.file_walker import walk_files
 
 
 def test_synology():
@@ -20,3 +22,31 @@ def test_synology():
         assert len(list(root_dir.glob('*'))) > 1
         assert pattern.search(ea_dir.as_posix())
         assert pattern.search(recycle.as_posix())
+
+
+def test_ignore_filter():
+    """Tests that directory rules only match directories, and that name rules only match names
+    """
+    ignore_filter = IgnoreFilter(['@eaDir/', r'\.DS_Store', 'share/tmp'])
+    assert ignore_filter.ignore_directory('/volume1/share/@eaDir', '@eaDir')
+    assert not ignore_filter.ignore_file('/volume1/share/@eaDir', '@eaDir')
+    assert ignore_filter.ignore_file('/volume1/share/.DS_Store', '.DS_Store')
+    assert not ignore_filter.ignore_file('/volume1/.DS_Store/file', 'file')
+    assert ignore_filter.ignore_directory('/volume1/share/tmp', 'tmp')
+    assert ignore_filter.ignore_file('/volume1/share/tmp.txt', 'tmp.txt')
+    assert not ignore_filter.ignore_directory('/volume1/share', 'share')
+
+
+def test_synology_pruning():
+    """Tests that the synology special folders are pruned from the walk
+    """
+    ignore_filter = load_ignore_filter(Path('dedup_ignore.txt'))
+    with TemporaryDirectory() as temp_dir:
+        root_dir = Path(temp_dir).resolve()
+        for name in ['@eaDir', '#recycle']:
+            directory = root_dir.joinpath(name)
+            directory.mkdir()
+            directory.joinpath('file.bin').write_bytes(b'')
+        root_dir.joinpath('file.bin').write_bytes(b'')
+        assert [path for path, _ in walk_files(root_dir, ignore_filter)] == \
+            [root_dir.joinpath('file.bin')]
@@ -1,13 +1,19 @@
 '''Testing Job Cache
 '''
+import json
+import os
 import socket
+import sqlite3
 from hashlib import sha256
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
+import pytest
 from tqdm import tqdm
 
-from e4e_deduplication.job_cache import JobCache
+from e4e_deduplication.digest_index import DigestIndex
+from e4e_deduplication.job_cache import Checkpoint, FileStat, JobCache
 
 
 def test_create_db():
@@ -101,5 +107,300 @@ def test_comma_filepaths():
                 assert f'c_{idx:06d}' not in job_cache
 
 
+def test_add_many():
+    """Tests that buffered records are visible before and persisted after closing
+    """
+    n_files = JobCache.BUFFER_SIZE + 5
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        job_cache_path = temp_dir.joinpath('test')
+
+        with JobCache(job_cache_path) as job_cache:
+            job_cache.add_many((temp_dir.joinpath(f'{idx:06d}.bin'), f'{idx % 2}', None, None)
+                               for idx in range(n_files))
+            assert job_cache.n_records == n_files
+            assert len(job_cache['0']) == (n_files + 1) // 2
+
+        with JobCache(job_cache_path) as job_cache:
+            assert job_cache.n_records == n_files
+            assert len(job_cache.get_duplicates()) == 2
+
+
+def test_interrupted_migration():
+    """Tests that a legacy hash file whose migration failed part way is migrated again in full
+    """
+    documents = [json.dumps({'digest': f'{idx}', 'path': f'/data/{idx}.bin', 'host': 'host'})
+                 for idx in range(8)]
+    with TemporaryDirectory() as tmpdir, \
+            patch.object(JobCache, 'BUFFER_SIZE', 2):
+        legacy_path = Path(tmpdir, JobCache.LEGACY_NAME)
+        legacy_path.write_text('\n'.join(documents[:4] + ['{'] + documents[4:]) + '\n',
+                               encoding='utf-8')
+        with pytest.raises(ValueError):
+            with JobCache(Path(tmpdir)):
+                pass
+        assert not Path(tmpdir, JobCache.DB_NAME).exists()
+
+        legacy_path.write_text('\n'.join(documents) + '\n', encoding='utf-8')
+        with JobCache(Path(tmpdir)) as job_cache:
+            assert job_cache.n_records == len(documents)
+
+
+def test_upgrade_records():
+    """Tests converting a job from v1.6.x, with text digests, paths and hostnames in each record
+    """
+    digest = sha256(b'data').hexdigest()
+    with TemporaryDirectory() as tmpdir:
+        connection = sqlite3.connect(Path(tmpdir, JobCache.DB_NAME))
+        connection.executescript('''
+            CREATE TABLE records (id INTEGER PRIMARY KEY, digest TEXT, path TEXT NOT NULL,
+                host TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, inode INTEGER,
+                device INTEGER, partial TEXT);
+            CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+            CREATE INDEX records_digest ON records(digest);
+            CREATE INDEX records_host_path ON records(host, path);
+            CREATE INDEX records_size ON records(size);
+        ''')
+        connection.executemany(
+            'INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(3, digest, '/data/a.bin', 'host-a', 4, 1, 2, 3, 'ABCDEF'),
+             (5, digest, '/data/b.bin', 'host-b', None, None, None, None, None),
+             (7, None, '/data/c.bin', 'host-a', 8, 1, 2, 3, None),
+             (9, 'not-hex', '/data/d.bin', 'host-b', None, None, None, None, None)])
+        connection.commit()
+        connection.close()
+
+        with patch('socket.gethostname', return_value='host-a'), \
+                JobCache(Path(tmpdir)) as job_cache:
+            assert job_cache.n_records == 4
+            assert job_cache.algorithm == 'sha256'
+            assert job_cache[digest] == {(Path('/data/a.bin'), 'host-a'),
+                                         (Path('/data/b.bin'), 'host-b')}
+            assert job_cache['not-hex'] == {(Path('/data/d.bin'), 'host-b')}
+            assert job_cache.get_stat(Path('/data/a.bin')) == FileStat(4, 1, 2, 3)
+            assert job_cache.get_tree(Path('/data')) == {Path('/data/a.bin'),
+                                                         Path('/data/c.bin')}
+            index = job_cache.get_digest_index()
+            assert sorted(index.lookup(digest)) == [3, 5]
+            index.close()
+            job_cache.export_json(Path(tmpdir, 'export.jsonl'))
+        documents = [json.loads(line)
+                     for line in Path(tmpdir, 'export.jsonl').read_text('utf-8').splitlines()]
+        assert documents[0] == {'digest': digest, 'path': '/data/a.bin', 'host': 'host-a',
+                                'size': 4, 'mtime_ns': 1, 'inode': 2, 'device': 3,
+                                'partial': 'ABCDEF', 'algorithm': 'sha256'}
+        assert [document['digest'] for document in documents[1:]] == [digest, None, 'not-hex']
+
+
+def test_undecodable_paths():
+    """Tests storing paths that are not valid UTF-8, and recovering from a batch that cannot be
+    written
+    """
+    path = Path(os.fsdecode(b'/data/invalid\xff.bin'))
+    with TemporaryDirectory() as tmpdir:
+        with JobCache(Path(tmpdir)) as job_cache:
+            job_cache.add(path, '0')
+            job_cache.add(Path('/data/valid.bin'), '0')
+            job_cache.flush()
+            assert job_cache['0'] == {(path, socket.gethostname()),
+                                      (Path('/data/valid.bin'), socket.gethostname())}
+            assert path in job_cache.get_tree(Path('/data'))
+
+            job_cache.add(Path('/data/bad_digest.bin'), '\udcff')
+            with pytest.raises(UnicodeEncodeError):
+                job_cache.flush()
+            job_cache.add(Path('/data/later.bin'), '1')
+        with JobCache(Path(tmpdir)) as job_cache:
+            assert job_cache.n_records == 3
+
+
+def test_iter_duplicates():
+    """Tests that duplicate groups are generated most duplicated first
+    """
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        hostname = socket.gethostname()
+
+        with JobCache(temp_dir.joinpath('test')) as job_cache:
+            for digest, n_files in [('a', 2), ('b', 1), ('c', 4), ('d', 3)]:
+                job_cache.add_many((temp_dir.joinpath(f'{digest}_{idx}.bin'), digest, None, None)
+                                   for idx in range(n_files))
+            groups = job_cache.iter_duplicates()
+            digest, files = next(groups)
+            assert digest == 'c'
+            assert files == {(temp_dir.joinpath(f'c_{idx}.bin'), hostname) for idx in range(4)}
+            assert [digest for digest, _ in groups] == ['d', 'a']
+
+
+def test_get_many():
+    """Tests batched digest lookups across several queries
+    """
+    n_digests = 2 * JobCache.LOOKUP_BATCH_SIZE + 1
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        hostname = socket.gethostname()
+
+        with JobCache(temp_dir.joinpath('test')) as job_cache:
+            job_cache.add_many((temp_dir.joinpath(f'{idx}.bin'), f'{idx // 2}', None, None)
+                               for idx in range(2 * n_digests))
+            result = job_cache.get_many([f'{idx}' for idx in range(n_digests)] + ['missing'])
+            assert len(result) == n_digests
+            assert result['7'] == {(temp_dir.joinpath('14.bin'), hostname),
+                                   (temp_dir.joinpath('15.bin'), hostname)}
+            assert 'missing' not in result
+
+
+def test_get_stats():
+    """Tests batched fingerprint lookups across several queries
+    """
+    n_paths = 2 * JobCache.LOOKUP_BATCH_SIZE + 1
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+
+        with JobCache(temp_dir.joinpath('test')) as job_cache:
+            job_cache.add_many((temp_dir.joinpath(f'{idx}.bin'), None,
+                                FileStat(idx, 1, 2, 3), None)
+                               for idx in range(n_paths))
+            job_cache.add(temp_dir.joinpath('0.bin'), None, file_stat=FileStat(5, 6, 7, 8))
+            job_cache.add(temp_dir.joinpath('unfingerprinted.bin'), None)
+            # Only committed records are read
+            job_cache.flush()
+            result = job_cache.get_stats([temp_dir.joinpath(f'{idx}.bin')
+                                          for idx in range(n_paths)] +
+                                         [temp_dir.joinpath('unfingerprinted.bin'),
+                                          temp_dir.joinpath('missing.bin')])
+            assert len(result) == n_paths
+            assert result[temp_dir.joinpath('0.bin')] == FileStat(5, 6, 7, 8)
+            assert result[temp_dir.joinpath(f'{n_paths - 1}.bin')] == \
+                FileStat(n_paths - 1, 1, 2, 3)
+
+
+def test_digest_index_sidecar():
+    """Tests that the digest index sidecar is reused, replays added records, and is discarded
+    when records are dropped, even if the sidecar is left in place
+    """
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        job_path = temp_dir.joinpath('test')
+        digests = [sha256(f'{idx}'.encode()).hexdigest() for idx in range(16)]
+
+        with JobCache(job_path) as job_cache:
+            job_cache.add_many((temp_dir.joinpath(f'{idx}.bin'), digest, None, None)
+                               for idx, digest in enumerate(digests))
+            job_cache.get_digest_index().close()
+            assert job_path.joinpath(JobCache.INDEX_NAME).is_file()
+
+        with JobCache(job_path) as job_cache:
+            with patch.object(DigestIndex, 'build', side_effect=AssertionError):
+                index = job_cache.get_digest_index()
+            assert all(digest in index for digest in digests)
+            index.close()
+
+            job_cache.add(temp_dir.joinpath('new.bin'), 'baadf00d')
+            with patch.object(DigestIndex, 'build', side_effect=AssertionError):
+                index = job_cache.get_digest_index()
+            assert 'baadf00d' in index
+            assert len(index) == len(digests) + 1
+            index.close()
+
+            sidecar = job_path.joinpath(JobCache.INDEX_NAME).read_bytes()
+            job_cache.drop_paths(socket.gethostname(), [temp_dir.joinpath('new.bin')])
+            assert not job_path.joinpath(JobCache.INDEX_NAME).exists()
+            index = job_cache.get_digest_index()
+            assert 'baadf00d' not in index
+            index.close()
+
+            # A sidecar that could not be removed, over records that reuse the dropped ids
+            job_cache.drop_tree(socket.gethostname(), temp_dir)
+            job_cache.add_many((temp_dir.joinpath(f'{idx}.bin'), f'new{idx}', None, None)
+                               for idx in range(len(digests) + 1))
+            job_path.joinpath(JobCache.INDEX_NAME).write_bytes(sidecar)
+            index = job_cache.get_digest_index()
+            assert not any(digest in index for digest in digests + ['baadf00d'])
+            assert len(index) == len(digests) + 1
+            index.close()
+
+
+def test_checkpoint():
+    """Tests recording and clearing analysis checkpoints
+    """
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        root = temp_dir.joinpath('root')
+        checkpoint = Checkpoint(started=1., updated=2., n_files=3, last_path='root/a')
+        with JobCache(temp_dir.joinpath('test')) as cache:
+            assert cache.get_checkpoint(root) is None
+            cache.add(root.joinpath('a'), 'baadf00d')
+            cache.save_checkpoint(root, checkpoint)
+        with JobCache(temp_dir.joinpath('test')) as cache:
+            assert cache.get_checkpoint(root) == checkpoint
+            assert cache.get_checkpoint(temp_dir) is None
+            assert cache.get_tree(root) == {root.joinpath('a')}
+            cache.clear_checkpoint(root)
+            assert cache.get_checkpoint(root) is None
+            cache.save_checkpoint(root, checkpoint)
+            cache.clear()
+            assert cache.get_checkpoint(root) is None
+
+
+def test_merge_shards():
+    """Tests merging host shards and unsorted exports, skipping identical records
+    """
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        shards = []
+        for host in ['site-b', 'site-a']:
+            with patch('socket.gethostname', return_value=host), \
+                    JobCache(temp_dir.joinpath(host)) as job_cache:
+                job_cache.add_many((Path(f'/data/{idx}.bin'), f'{idx % 4}', None, None)
+                                   for idx in reversed(range(8)))
+                job_cache.add(Path('/data/0.bin'), '0')
+                job_cache.add(Path('/data/unhashed.bin'), None)
+                shards.append(temp_dir.joinpath(f'{host}.jsonl'))
+                job_cache.export_shard(shards[-1])
+        unsorted_path = temp_dir.joinpath('unsorted.jsonl')
+        with patch('socket.gethostname', return_value='site-c'), \
+                JobCache(temp_dir.joinpath('site-c')) as job_cache:
+            job_cache.add_many((Path(f'/data/{idx}.bin'), 'c', None, None)
+                               for idx in reversed(range(4)))
+            job_cache.export_json(unsorted_path)
+
+        with JobCache(temp_dir.joinpath('combined')) as job_cache:
+            assert job_cache.merge_json(shards) == 2 * 9
+            assert job_cache.merge_json(shards + [unsorted_path]) == 4
+            assert job_cache.merge_json(shards + [unsorted_path]) == 0
+            assert job_cache.n_records == 2 * 9 + 4
+            assert job_cache['1'] == {(Path(f'/data/{idx}.bin'), host)
+                                      for idx in [1, 5]
+                                      for host in ['site-a', 'site-b']}
+
+
+def test_merge_mixed_algorithms():
+    """Tests that a merge that fails part way, from a shard of another algorithm, adds nothing
+    """
+    with TemporaryDirectory() as tmpdir, \
+            patch.object(JobCache, 'BUFFER_SIZE', 2):
+        temp_dir = Path(tmpdir).resolve()
+        shards = []
+        for algorithm in ['sha256', 'blake2b']:
+            with JobCache(temp_dir.joinpath(algorithm)) as job_cache:
+                job_cache.use_algorithm(algorithm)
+                job_cache.add_many((Path(f'/{algorithm}/{idx}.bin'), f'{idx}', None, None)
+                                   for idx in range(8))
+                shards.append(temp_dir.joinpath(f'{algorithm}.jsonl'))
+                job_cache.export_shard(shards[-1])
+
+        with JobCache(temp_dir.joinpath('combined')) as job_cache:
+            with pytest.raises(ValueError):
+                job_cache.merge_json(shards)
+            job_cache.import_json(shards[0])
+            with pytest.raises(ValueError):
+                job_cache.import_json(shards[1])
+            assert job_cache.n_records == 8
+            assert job_cache.algorithm == 'sha256'
+        with JobCache(temp_dir.joinpath('combined')) as job_cache:
+            assert job_cache.n_records == 8
+
+
 if __name__ == '__main__':
     test_loading()
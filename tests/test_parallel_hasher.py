@@ -2,9 +2,15 @@
 '''
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from threading import Lock
+from unittest.mock import patch
 
+import pytest
 from utils import create_random_file
 
+from e4e_deduplication import hasher as hasher_module
+from e4e_deduplication import parallel_hasher as parallel_hasher_module
+from e4e_deduplication.hasher import compute_digest, compute_sha256
 from e4e_deduplication.parallel_hasher import ParallelHasher
 
 
@@ -44,5 +50,173 @@ def test_c_parallel_hasher():
     assert len(test_class.data) == n_files
 
 
+def test_batched_parallel_hasher():
+    """Tests that the parallel hasher delivers every result in bounded batches
+    """
+    n_files = 1000
+    batch_size = 64
+    batches = []
+    hasher = ParallelHasher(None, None, batch_fn=batches.append, batch_size=batch_size)
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        file_paths = [temp_dir.joinpath(
+            f'{idx:06d}.bin') for idx in range(n_files)]
+        for file in file_paths:
+            create_random_file(file, 1024)
+        hasher.run(temp_dir.rglob('*'), n_files)
+    assert all(len(batch) <= batch_size for batch in batches)
+    assert sorted(path for batch in batches for path, _ in batch) == file_paths
+
+
+def test_process_parallel_hasher():
+    """Tests the process pool backend
+    """
+    n_files = 200
+    test_class = ParallelHashTester()
+    hasher = ParallelHasher(test_class.process_fn, None, backend='processes')
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        file_paths = [temp_dir.joinpath(
+            f'{idx:06d}.bin') for idx in range(n_files)]
+        for file in file_paths:
+            create_random_file(file, 1024)
+        hasher.run(temp_dir.rglob('*'), n_files)
+        assert test_class.data == {file: compute_sha256(file) for file in file_paths}
+
+
+def test_pipeline_parallel_hasher():
+    """Tests the prefetching pipeline backend with more files in flight than hashers, and that
+    each file is only opened once
+    """
+    n_files = 200
+    test_class = ParallelHashTester()
+    hasher = ParallelHasher(test_class.process_fn, None, backend='pipeline',
+                            n_hash_workers=2, n_in_flight=16)
+    # pylint: disable=protected-access
+    # Counts opens
+    with TemporaryDirectory() as tmpdir, \
+            patch.object(hasher_module, '_open_for_hashing',
+                         wraps=hasher_module._open_for_hashing) as open_for_hashing:
+        temp_dir = Path(tmpdir).resolve()
+        file_paths = [temp_dir.joinpath(
+            f'{idx:06d}.bin') for idx in range(n_files)]
+        for file in file_paths:
+            create_random_file(file, 1024)
+        hasher.run_files((file, 1024) for file in file_paths)
+        assert open_for_hashing.call_count == n_files
+        assert test_class.data == {file: compute_sha256(file) for file in file_paths}
+
+
+def test_pipeline_buffer_budget():
+    """Tests that the pipeline backend holds at most PIPELINE_BUFFER_SIZE bytes of prefetched
+    file contents at once, and releases them once hashed
+    """
+    n_files = 64
+    file_size = 16*1024
+    held = {'now': 0, 'max': 0}
+    held_lock = Lock()
+
+    class TrackedBudget(parallel_hasher_module._ByteBudget):
+        # pylint: disable=protected-access
+        # Tracks the budget
+        """Byte budget that records the bytes held
+        """
+
+        def acquire(self, n_bytes: int) -> None:
+            super().acquire(n_bytes)
+            with held_lock:
+                held['now'] += n_bytes
+                held['max'] = max(held['max'], held['now'])
+
+        def release(self, n_bytes: int) -> None:
+            with held_lock:
+                held['now'] -= n_bytes
+            super().release(n_bytes)
+
+    test_class = ParallelHashTester()
+    hasher = ParallelHasher(test_class.process_fn, None, backend='pipeline',
+                            hash_fn=compute_digest, n_hash_workers=2, n_in_flight=32)
+    with TemporaryDirectory() as tmpdir, \
+            patch.object(parallel_hasher_module, '_ByteBudget', TrackedBudget), \
+            patch.object(parallel_hasher_module, 'PREFETCH_SIZE', 4 * file_size), \
+            patch.object(ParallelHasher, 'PIPELINE_BUFFER_SIZE', 4 * file_size):
+        temp_dir = Path(tmpdir).resolve()
+        file_paths = [temp_dir.joinpath(f'{idx:06d}.bin') for idx in range(n_files)]
+        for file in file_paths:
+            create_random_file(file, file_size)
+        hasher.run_files((file, file_size) for file in file_paths)
+        assert test_class.data == {file: compute_sha256(file) for file in file_paths}
+    assert 0 < held['max'] <= 4 * file_size
+    assert held['now'] == 0
+
+
+@pytest.mark.parametrize('file_size,backend', [(1024, 'processes'), (4096, 'threads')])
+def test_auto_streamed_files(file_size: int, backend: str):
+    """Tests that the auto backend decides from the files discovered when streaming
+
+    Args:
+        file_size (int): Size of each file
+        backend (str): Expected backend
+    """
+    n_files = 64
+    test_class = ParallelHashTester()
+    hasher = ParallelHasher(test_class.process_fn, None, backend='auto')
+    with TemporaryDirectory() as tmpdir, \
+            patch.object(ParallelHasher, 'AUTO_MIN_FILES', 32), \
+            patch.object(ParallelHasher, 'AUTO_MAX_MEAN_SIZE', 2048), \
+            patch.object(ParallelHasher, f'_run_{backend}',
+                         autospec=True, return_value=n_files) as run_backend:
+        temp_dir = Path(tmpdir).resolve()
+        file_paths = [temp_dir.joinpath(f'{idx:06d}.bin') for idx in range(n_files)]
+        hasher.run_files((file, file_size) for file in file_paths)
+        assert list(run_backend.call_args.args[1]) == [(file, file_size) for file in file_paths]
+
+
+@pytest.mark.parametrize('backend', ['threads', 'pipeline'])
+def test_process_fn_exception(backend: str):
+    """Tests that an exception in the processing function is raised instead of stalling the
+    hashers once the result queue fills
+    """
+    n_files = ParallelHasher.QUEUE_SIZE * 2
+
+    def failing_process_fn(path: Path, digest: str):
+        raise RuntimeError(f'{path}: {digest}')
+    hasher = ParallelHasher(failing_process_fn, None, backend=backend)
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        for idx in range(n_files):
+            create_random_file(temp_dir.joinpath(f'{idx:06d}.bin'), 16)
+        with pytest.raises(RuntimeError):
+            hasher.run(temp_dir.rglob('*'), n_files)
+
+
+@pytest.mark.parametrize('backend', ['threads', 'pipeline'])
+def test_batch_fn_exception_stops_discovery(backend: str):
+    """Tests that files stop being discovered and hashed once results cannot be delivered
+    """
+    n_files = ParallelHasher.QUEUE_SIZE * 64
+    n_discovered = 0
+    hashed_paths = []
+
+    def failing_batch_fn(results):
+        raise RuntimeError(f'{len(results)} results')
+
+    def hash_fn(path: Path) -> str:
+        hashed_paths.append(path)
+        return path.name
+
+    def files():
+        nonlocal n_discovered
+        for idx in range(n_files):
+            n_discovered += 1
+            yield Path(f'/missing/{idx:06d}.bin'), 0
+    hasher = ParallelHasher(None, None, hash_fn=hash_fn, batch_fn=failing_batch_fn,
+                            batch_size=1, backend=backend)
+    with pytest.raises(RuntimeError):
+        hasher.run_files(files())
+    assert n_discovered < n_files // 4
+    assert len(hashed_paths) < n_files // 4
+
+
 if __name__ == '__main__':
     test_c_parallel_hasher()
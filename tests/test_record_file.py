@@ -0,0 +1,103 @@
+'''Tests the compact record file format
+'''
+from hashlib import sha256
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import pytest
+
+from e4e_deduplication.job_cache import JobCache
+from e4e_deduplication.record_file import RecordFile, is_record_file, write_records
+
+
+def create_documents():
+    """Creates sorted records covering unhashed files, hex and text digests, and stat fields
+
+    Returns:
+        List[Dict]: Records as written to JSON lines hash files
+    """
+    documents = []
+    for host in ['host-a', 'host-b']:
+        documents.append({'digest': None, 'path': '/data/0000/unhashed.bin', 'host': host})
+        for idx in range(100):
+            document = {
+                'digest': sha256(f'{host}{idx}'.encode()).hexdigest(),
+                'path': f'/data/{idx // 10:04d}/{idx:06d}.bin',
+                'host': host,
+                'algorithm': 'sha256'
+            }
+            if idx % 2:
+                document.update({
+                    'size': idx,
+                    'mtime_ns': -idx,
+                    'inode': (1 << 64) - 1 - idx,
+                    'device': 0
+                })
+            if idx % 3 == 0:
+                document['partial'] = 'ABCDEF'
+            documents.append(document)
+        documents.append({'digest': 'not-hex', 'path': '/data/äöü.bin', 'host': host})
+    return sorted(documents, key=lambda doc: (doc['host'], doc['path'], doc['digest'] or ''))
+
+
+@pytest.mark.parametrize('block_records', [7, 4096])
+def test_roundtrip(block_records: int):
+    """Tests reading back records, across block boundaries
+    """
+    documents = create_documents()
+    with TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir, 'records.bin')
+        assert write_records(path, documents, block_records=block_records) == len(documents)
+        assert is_record_file(path)
+        with RecordFile(path) as records:
+            assert len(records) == len(documents)
+            assert list(records) == documents
+            for document in documents[::13]:
+                assert document in records.find(document['host'], document['path'])
+            assert not records.find('host-c', '/data/0000/000000.bin')
+
+
+def test_duplicate_paths_across_blocks():
+    """Tests finding the records of a path that span several blocks
+    """
+    documents = [{'digest': f'{idx:02x}', 'path': '/data/a.bin', 'host': 'host'}
+                 for idx in range(10)]
+    documents.append({'digest': '00', 'path': '/data/b.bin', 'host': 'host'})
+    with TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir, 'records.bin')
+        write_records(path, documents, block_records=3)
+        with RecordFile(path) as records:
+            assert records.find('host', '/data/a.bin') == documents[:10]
+            assert records.find('host', '/data/b.bin') == documents[10:]
+
+
+def test_unsorted():
+    """Tests that unsorted records are rejected
+    """
+    documents = create_documents()
+    with TemporaryDirectory() as tmpdir, pytest.raises(ValueError):
+        write_records(Path(tmpdir, 'records.bin'), reversed(documents))
+
+
+def test_export_compact():
+    """Tests importing and merging compact exports
+    """
+    with TemporaryDirectory() as tmpdir:
+        temp_dir = Path(tmpdir).resolve()
+        compact_path = temp_dir.joinpath('export.bin')
+        json_path = temp_dir.joinpath('export.jsonl')
+        with patch('socket.gethostname', return_value='site-a'), \
+                JobCache(temp_dir.joinpath('site-a')) as job_cache:
+            job_cache.add_many((Path(f'/data/{idx}.bin'), f'{idx % 4}', None, None)
+                               for idx in reversed(range(8)))
+            job_cache.add(Path('/data/unhashed.bin'), None)
+            assert job_cache.export_compact(compact_path) == 9
+            job_cache.export_json(json_path)
+        assert not is_record_file(json_path)
+
+        with JobCache(temp_dir.joinpath('imported')) as job_cache:
+            job_cache.import_json(compact_path)
+            assert job_cache.n_records == 9
+            assert job_cache['1'] == {(Path(f'/data/{idx}.bin'), 'site-a') for idx in [1, 5]}
+            assert job_cache.merge_json([compact_path, json_path]) == 0
@@ -0,0 +1,104 @@
+'''Tests the coordinator and remote workers
+'''
+import sys
+from multiprocessing.connection import Client
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from typing import Dict, List
+
+import pytest
+from utils import create_random_file
+
+from e4e_deduplication.analyzer import Analyzer
+from e4e_deduplication.hasher import compute_sha256
+from e4e_deduplication.remote_hasher import (Coordinator, RemoteHasher, parse_address,
+                                             run_worker)
+
+AUTHKEY = b'test'
+
+
+def create_files(directory: Path, n_files: int) -> List[Path]:
+    """Creates small random files
+
+    Args:
+        directory (Path): Directory to create the files in
+        n_files (int): Number of files
+
+    Returns:
+        List[Path]: Created files
+    """
+    paths = [directory.joinpath(f'{idx:06d}.bin') for idx in range(n_files)]
+    for path in paths:
+        create_random_file(path, 256)
+    return paths
+
+
+def test_parse_address():
+    """Tests parsing TCP and Unix socket addresses
+    """
+    assert parse_address('localhost:6000') == ('localhost', 6000)
+    assert parse_address('/tmp/dedup.sock') == '/tmp/dedup.sock'
+
+
+def test_local_workers():
+    """Tests hashing on local worker processes over several runs
+    """
+    with TemporaryDirectory() as tmpdir:
+        paths = create_files(Path(tmpdir).resolve(), 300)
+        with Coordinator(('localhost', 0), AUTHKEY, n_local_workers=2) as coordinator:
+            for _ in range(2):
+                results: Dict[Path, str] = {}
+                hasher = RemoteHasher(results.__setitem__, None, coordinator=coordinator)
+                hasher.run_files((path, 256) for path in paths)
+                assert results == {path: compute_sha256(path) for path in paths}
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='Unix sockets are not supported on Windows')
+def test_worker_disconnect():
+    """Tests that the batch of a worker that disconnects is hashed by another worker
+    """
+    received = Event()
+
+    def disconnecting_worker(address):
+        with Client(address, authkey=AUTHKEY) as connection:
+            connection.recv()
+        received.set()
+
+    def late_worker(address):
+        received.wait()
+        run_worker(address, AUTHKEY, n_threads=2)
+
+    with TemporaryDirectory() as tmpdir:
+        paths = create_files(Path(tmpdir).resolve(), 200)
+        results: Dict[Path, str] = {}
+        with Coordinator(Path(tmpdir, 'dedup.sock').as_posix(), AUTHKEY) as coordinator:
+            workers = [Thread(target=worker, args=(coordinator.address,))
+                       for worker in [disconnecting_worker, late_worker]]
+            for worker in workers:
+                worker.start()
+            hasher = RemoteHasher(results.__setitem__, None, coordinator=coordinator)
+            hasher.run_files((path, 256) for path in paths)
+        for worker in workers:
+            worker.join()
+        assert results == {path: compute_sha256(path) for path in paths}
+
+
+def test_remote_analyze():
+    """Tests analyzing with remote workers
+    """
+    with TemporaryDirectory() as tmpdir, TemporaryDirectory() as cache_dir:
+        working_dir = Path(tmpdir).resolve()
+        paths = create_files(working_dir, 32)
+        dupe = working_dir.joinpath('dupe.bin')
+        dupe.write_bytes(paths[0].read_bytes())
+        with Coordinator(('localhost', 0), AUTHKEY) as coordinator:
+            worker = Thread(target=run_worker, args=(coordinator.address, AUTHKEY))
+            worker.start()
+            with Analyzer(ignore_pattern=None,
+                          job_path=Path(cache_dir, 'test'),
+                          coordinator=coordinator) as app:
+                app.analyze(working_dir)
+                results = app.get_duplicates()
+        worker.join()
+        assert {file for file, _ in results[compute_sha256(dupe)]} == {paths[0], dupe}